@@ -1,19 +1,25 @@
 from json import JSONDecodeError
-from typing import Optional
+from typing import Dict, List, Optional
 import requests
 import urllib3
 import logging
 
-from model import NewsResponseList, OrderCriteria, OrderRequest, OrderList, PositionResponseList, Side, StatusResponse, \
-    OrderResponse
-from order_book import OrderBook
+from codec import News, Order, Status, decode_news, decode_order, decode_order_book, decode_orders, decode_positions, \
+    decode_status, encode_order
+from model import OrderCriteria, OrderRequest, Side
+from order_book import Book
 from model import ProductResponseList
 
 logger = logging.getLogger(__name__)
 
 urllib3.disable_warnings(category=urllib3.exceptions.InsecureRequestWarning)
 
+# Enough pooled connections for every gateway worker and the feed to keep their own connection alive
+POOL_SIZE = 16
+
 s = requests.Session()
+s.mount("https://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=POOL_SIZE))
+s.mount("http://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=POOL_SIZE))
 
 
 class BearerAuth(requests.auth.AuthBase):
@@ -26,6 +32,7 @@ class BearerAuth(requests.auth.AuthBase):
 
 
 ENDPOINT = "https://staging-cmi-exchange/api"
+JSON_HEADERS = {"Content-Type": "application/json"}
 
 
 def ensure_success(response: requests.Response, message: str, *, fail_hard=False):
@@ -67,15 +74,16 @@ def sign_in(username: str, password: str) -> BearerAuth:
     return BearerAuth(bearer_token)
 
 
-def get_status(auth: BearerAuth) -> Optional[StatusResponse]:
+def get_status(auth: BearerAuth) -> Optional[Status]:
     path = "/status"
     logger.debug(f"Getting status")
     res = s.get(
         ENDPOINT + path, auth=auth, verify=False
     )
     if ensure_success(res, "Getting status failed!"):
-        status = StatusResponse(**res.json())
-        logger.debug(f"Getting status success: {status}")
+        status = decode_status(res.content)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Getting status success: {status}")
         return status
     return None
 
@@ -90,34 +98,46 @@ def get_all_products(auth: BearerAuth) -> ProductResponseList:
     return product_list
 
 
-def get_order_book(auth: BearerAuth, product_name: str) -> Optional[OrderBook]:
+def get_order_book(auth: BearerAuth, product_name: str) -> Optional[Book]:
     path = f"/product/{product_name}/order-book/current-user"
     logger.debug(f"Getting the order book for product: {product_name}")
     res = s.get(ENDPOINT + path, auth=auth, verify=False)
     if ensure_success(res, "Get order book failed!"):
-        order_book = OrderBook(**res.json())
-        logger.debug(f"Getting order book success: {order_book}")
+        order_book = decode_order_book(res.content)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Getting order book success: {order_book}")
         return order_book
     return None
 
 
-def send_order(auth: BearerAuth, order: OrderRequest):
+def send_order(auth: BearerAuth, order: OrderRequest) -> Optional[Order]:
+    return send_new_order(auth, order.product, order.side, order.price, order.volume)
+
+
+def send_new_order(auth: BearerAuth, product: str, side: Side, price: float, volume: int) -> Optional[Order]:
+    """
+    Send an order encoded from a template, without building an OrderRequest.
+    """
     path = "/order"
-    logger.debug(f"Sending new order: {order}")
-    res = s.post(ENDPOINT + path, json=order.model_dump(), auth=auth, verify=False)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Sending new order: {side.value} {volume} {product} at {price}")
+    res = s.post(
+        ENDPOINT + path, data=encode_order(product, side, price, volume), headers=JSON_HEADERS, auth=auth, verify=False
+    )
     if res.ok:
         logger.debug("Sending new order success")
-        return OrderResponse(**res.json())
+        return decode_order(res.content)
     return None
 
 
-def get_current_orders(auth: BearerAuth) -> Optional[OrderList]:
+def get_current_orders(auth: BearerAuth) -> Optional[List[Order]]:
     path = "/order/current-user"
     logger.debug("Getting current orders")
     res = s.get(ENDPOINT + path, auth=auth, verify=False)
     if ensure_success(res, "Get current orders failed!"):
-        order_list = OrderList(res.json())
-        logger.debug(f"Getting current orders success: {order_list}")
+        order_list = decode_orders(res.content)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Getting current orders success: {order_list}")
         return order_list
     return None
 
@@ -137,24 +157,26 @@ def delete_order_by_criteria(auth: BearerAuth, criteria: OrderCriteria):
     ensure_success(res, "Delete order by criteria failed!")
 
 
-def get_position(auth: BearerAuth):
+def get_position(auth: BearerAuth) -> Optional[Dict[str, int]]:
     path = "/position/current-user"
     logger.debug("Getting position")
     res = s.get(ENDPOINT + path, auth=auth, verify=False)
     if ensure_success(res, "Get position failed!"):
-        positions = PositionResponseList(res.json())
-        logger.debug(f"Getting position success: {positions}")
+        positions = decode_positions(res.content)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Getting position success: {positions}")
         return positions
     return None
 
 
-def get_news(auth: BearerAuth):
+def get_news(auth: BearerAuth) -> Optional[List[News]]:
     path = "/news"
     logger.debug("Getting news")
     res = s.get(ENDPOINT + path, auth=auth, verify=False)
     if ensure_success(res, "Get news failed!"):
-        news = NewsResponseList(res.json())
-        logger.debug(f"Getting news success: {news}")
+        news = decode_news(res.content)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Getting news success: {news}")
         return news
     return None
 
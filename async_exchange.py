@@ -0,0 +1,245 @@
+import asyncio
+import datetime
+import logging
+import time
+from typing import Dict, List, Optional, Tuple
+
+import aiohttp
+
+from api import ENDPOINT, JSON_HEADERS
+from codec import News, Order, decode_news, decode_order, decode_order_book, decode_orders, decode_positions, \
+    decode_status, encode_order
+from model import OrderCriteria, OrderStatus, PriceBook, PriceVolume, ProductResponse, ProductResponseList, Side
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = 2.0
+DEFAULT_CONNECTION_LIMIT = 16
+
+NewOrder = Tuple[str, float, int, Side]
+
+
+class AsyncExchange:
+    """
+    Exchange with the same methods as Exchange as coroutines, over one pooled keep-alive connector.
+
+    Independent requests can be awaited together, e.g. with insert_orders or delete_all_orders, so they share one
+    round trip instead of queueing behind each other. Every request has its own timeout; a failed or timed out
+    request is logged and returns None like the blocking client. Construct it inside a running event loop.
+    """
+
+    def __init__(
+        self,
+        token: str,
+        endpoint: str = ENDPOINT,
+        timeout: float = DEFAULT_TIMEOUT,
+        connection_limit: int = DEFAULT_CONNECTION_LIMIT,
+    ) -> None:
+        self.endpoint = endpoint
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.products: Dict[str, ProductResponse] = {}
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=connection_limit, ssl=False, keepalive_timeout=60),
+            headers={"Authorization": token},
+            timeout=self.timeout,
+        )
+
+    @classmethod
+    async def create(
+        cls,
+        username: str,
+        password: str,
+        sign_up_for_new_account=True,
+        endpoint: str = ENDPOINT,
+        timeout: float = DEFAULT_TIMEOUT,
+    ) -> "AsyncExchange":
+        async with aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(ssl=False), timeout=aiohttp.ClientTimeout(total=timeout)
+        ) as session:
+            credentials = {"username": username, "password": password}
+            if sign_up_for_new_account:
+                async with session.post(f"{endpoint}/user", json=credentials) as response:
+                    if not response.ok:
+                        raise Exception(f"Sign up failed!\n{await response.text()}")
+            async with session.post(f"{endpoint}/user/authenticate", json=credentials) as response:
+                if not response.ok:
+                    raise Exception(f"Sign in failed!\n{await response.text()}")
+                token = response.headers["Authorization"]
+        logger.info(f"Signing in success with bearer token {token}")
+        exchange = cls(token, endpoint, timeout)
+        await exchange.update_products()
+        await exchange.delete_all_orders()
+        return exchange
+
+    async def close(self):
+        await self._session.close()
+
+    async def _request(self, method: str, path: str, message: str, **kwargs) -> Optional[bytes]:
+        start_time = time.perf_counter()
+        try:
+            async with self._session.request(method, self.endpoint + path, **kwargs) as response:
+                body = await response.read()
+                if not response.ok:
+                    logger.error(f"{message}\n{body.decode(errors='replace')}")
+                    return None
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(f"{method} {path} took {(time.perf_counter() - start_time) * 1000:.1f} ms")
+                return body
+        except asyncio.TimeoutError:
+            logger.error(f"{message} Timed out after {self.timeout.total} seconds")
+        except aiohttp.ClientError as error:
+            logger.error(f"{message} {error}")
+        return None
+
+    async def insert_order(self, instrument_id: str, *, price: float, volume: int, side: Side) -> Optional[Order]:
+        """
+        Insert a limit order on an instrument.
+        """
+        body = await self._request(
+            "POST",
+            "/order",
+            "Sending new order failed!",
+            data=encode_order(instrument_id, side, price, volume),
+            headers=JSON_HEADERS,
+        )
+        return None if body is None else decode_order(body)
+
+    async def insert_orders(self, orders: List[NewOrder]) -> List[Optional[Order]]:
+        """
+        Insert every (instrument_id, price, volume, side) order concurrently.
+        """
+        return await asyncio.gather(
+            *(self.insert_order(instrument_id, price=price, volume=volume, side=side)
+              for instrument_id, price, volume, side in orders)
+        )
+
+    async def insert_ioc_order(self, instrument_id: str, price: float, volume: int, side: Side):
+        res = await self.insert_order(instrument_id, price=price, volume=volume, side=side)
+        if res is not None:
+            await self.delete_order(res.id)
+
+    async def delete_order(self, order_id: str):
+        """
+        Delete a specific outstanding limit order on an instrument.
+        """
+        await self._request("DELETE", f"/order/{order_id}", "Delete order failed!")
+
+    async def _delete_order_by_criteria(self, criteria: OrderCriteria):
+        params = {key: str(value.value if isinstance(value, Side) else value)
+                  for key, value in criteria.model_dump().items() if value is not None}
+        await self._request("DELETE", "/order", "Delete order by criteria failed!", params=params)
+
+    async def delete_orders(self, instrument_id: str):
+        await asyncio.gather(
+            self._delete_order_by_criteria(OrderCriteria(product=instrument_id, side=Side.BUY, price=None)),
+            self._delete_order_by_criteria(OrderCriteria(product=instrument_id, side=Side.SELL, price=None)),
+        )
+
+    async def delete_all_orders(self):
+        await asyncio.gather(*(self.delete_orders(product) for product in self.products))
+
+    async def get_outstanding_orders(self) -> Optional[Dict[str, OrderStatus]]:
+        body = await self._request("GET", "/order/current-user", "Get current orders failed!")
+        if body is None:
+            return None
+        return {
+            order.id: OrderStatus(order.product, order.id, order.price, order.volume, order.side)
+            for order in decode_orders(body)
+        }
+
+    async def get_last_price_book(self, instrument_id: str) -> Optional[PriceBook]:
+        body = await self._request(
+            "GET", f"/product/{instrument_id}/order-book/current-user", "Get order book failed!"
+        )
+        if body is None:
+            return None
+        order_book = decode_order_book(body)
+        bids = [PriceVolume(price=price, volume=volume) for price, volume in order_book.bids]
+        asks = [PriceVolume(price=price, volume=volume) for price, volume in order_book.asks]
+        return PriceBook(timestamp=datetime.datetime.now(), instrument_id=instrument_id, bids=bids, asks=asks, )
+
+    async def get_positions(self) -> Optional[Dict[str, int]]:
+        body = await self._request("GET", "/position/current-user", "Get position failed!")
+        return None if body is None else decode_positions(body)
+
+    async def get_news(self) -> List[News]:
+        body = await self._request("GET", "/news", "Get news failed!")
+        return [] if body is None else decode_news(body)
+
+    def get_product(self, product: str) -> ProductResponse:
+        return self.products[product]
+
+    async def update_products(self) -> None:
+        body = await self._request("GET", "/product", "Get product failed!")
+        if body is None:
+            raise Exception("Get product failed!")
+        for product in ProductResponseList.model_validate_json(body).root:
+            self.products[product.symbol] = product
+
+    async def get_rank(self) -> Optional[int]:
+        body = await self._request("GET", "/status", "Getting status failed!")
+        return None if body is None else decode_status(body).userRanking
+
+
+def test_concurrent_requote():
+    from aiohttp import web
+
+    delay = 0.2
+    received = []
+
+    async def new_order(request: web.Request):
+        order = await request.json()
+        received.append((order, request.headers["Authorization"]))
+        await asyncio.sleep(delay)
+        return web.json_response(
+            {
+                "id": str(len(received)),
+                "status": "ACTIVE",
+                "product": order["product"],
+                "side": order["side"],
+                "price": order["price"],
+                "volume": order["volume"],
+                "filled": 0,
+                "message": "",
+                "user": "test",
+                "timestamp": "2024-08-05T16:13:56.704080677Z",
+            }
+        )
+
+    async def slow(request: web.Request):
+        await asyncio.sleep(10)
+        return web.json_response([])
+
+    async def run():
+        app = web.Application()
+        app.router.add_post("/order", new_order)
+        app.router.add_get("/news", slow)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        exchange = AsyncExchange("token", endpoint=f"http://127.0.0.1:{port}", timeout=1.0)
+        try:
+            orders = [
+                (product, price, 10, side)
+                for product in ("FUTURE", "150 CALL", "130 PUT")
+                for price, side in ((1.0, Side.BUY), (2.0, Side.SELL))
+            ]
+            start_time = time.perf_counter()
+            results = await exchange.insert_orders(orders)
+            elapsed = time.perf_counter() - start_time
+            assert elapsed < 2 * delay
+            assert [(result.product, result.price, result.side) for result in results] == [
+                (product, price, side) for product, price, _, side in orders
+            ]
+            assert all(token == "token" for _, token in received)
+
+            start_time = time.perf_counter()
+            assert await exchange.get_news() == []
+            assert time.perf_counter() - start_time < 2.0
+        finally:
+            await exchange.close()
+            await runner.cleanup()
+
+    asyncio.run(run())
@@ -0,0 +1,255 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import statistics
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import psutil
+
+from cards import Cards
+from option_pricing import (
+    OptionPricingBuild,
+    OptionPricingServer,
+    option_pricing,
+    option_pricing_cpp,
+    option_pricing_exact,
+    option_pricing_exact_next_table,
+    option_pricing_next_table,
+)
+from pricing_table import PricingTable
+
+logger = logging.getLogger(__name__)
+
+CORPUS: Dict[str, List[float]] = {
+    "empty deck": [],
+    "mid round": [13.0, 12.0, 1.0, 5.0, 6.0, 7.0, 8.0, 9.0, 10.0, 2.0],
+    "19 cards drawn": [13.0] * 4 + [12.0] * 4 + [11.0] * 4 + [10.0] * 4 + [1.0] * 3,
+}
+
+
+def price_error(result, reference) -> float:
+    """
+    Largest absolute difference over the four prices, or over every branch of a next card table.
+    """
+    if isinstance(reference, list):
+        return max(
+            (price_error(branch, reference_branch) for branch, reference_branch in zip(result, reference)
+             if reference_branch is not None),
+            default=0.0,
+        )
+    return max(abs(price - reference_price) for price, reference_price in zip(result[:4], reference))
+
+
+class Engine:
+    """
+    One way of pricing a card state. children_cpu_time reports CPU spent outside this process, e.g. by a pricing server.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        price: Callable[[Cards], object],
+        reference: Callable[[Cards], object],
+        children_cpu_time: Callable[[], float] = lambda: 0.0,
+    ) -> None:
+        self.name = name
+        self.price = price
+        self.reference = reference
+        self.children_cpu_time = children_cpu_time
+
+
+def exited_children_cpu_time() -> float:
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def server_cpu_time(server: OptionPricingServer) -> Callable[[], float]:
+    process = psutil.Process(server.process.pid)
+
+    def cpu_time():
+        times = process.cpu_times()
+        return times.user + times.system
+
+    return cpu_time
+
+
+def run_engine(engine: Engine, cards: Cards, repeat: int) -> Dict[str, float]:
+    reference = engine.reference(cards)
+    engine.price(cards)
+
+    latencies = []
+    errors = []
+    cpu_start = time.process_time() + engine.children_cpu_time()
+    wall_start = time.perf_counter()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = engine.price(cards)
+        latencies.append(time.perf_counter() - start)
+        errors.append(price_error(result, reference))
+    wall_time = time.perf_counter() - wall_start
+    cpu_time = time.process_time() + engine.children_cpu_time() - cpu_start
+
+    return {
+        "p50_ms": float(np.percentile(latencies, 50)) * 1000,
+        "p99_ms": float(np.percentile(latencies, 99)) * 1000,
+        "throughput_per_second": repeat / wall_time,
+        "cpu_ms_per_call": cpu_time / repeat * 1000,
+        "mean_abs_error": statistics.fmean(errors),
+        "max_abs_error": max(errors),
+    }
+
+
+CPP_ENGINES = {"cpp", "cpp_server", "cpp_server_next_table"}
+
+
+def make_engines(
+    threads: int, iterations: int, table: Optional[PricingTable], engine_names: Optional[List[str]] = None
+) -> Tuple[List[Engine], List[Callable]]:
+    """
+    The engines named in engine_names, or all of them. The C++ binary is only compiled and served when a cpp engine
+    is selected.
+    """
+    engines = [
+        Engine("exact", option_pricing_exact, option_pricing_exact),
+        Engine("numpy", lambda cards: option_pricing(150, 130, cards, iterations * threads), option_pricing_exact),
+        Engine("exact_next_table", option_pricing_exact_next_table, option_pricing_exact_next_table),
+        Engine(
+            "numpy_next_table",
+            lambda cards: option_pricing_next_table(150, 130, cards, iterations * threads),
+            option_pricing_exact_next_table,
+        ),
+    ]
+    cleanups = []
+    if not engine_names or CPP_ENGINES & set(engine_names):
+        binary = OptionPricingBuild().build()
+        server = OptionPricingServer(binary)
+        cleanups.append(server.close)
+        engines += [
+            Engine(
+                "cpp",
+                lambda cards: option_pricing_cpp(cards, threads, iterations, binary=binary),
+                option_pricing_exact,
+                exited_children_cpu_time,
+            ),
+            Engine(
+                "cpp_server",
+                lambda cards: server.option_pricing(cards, threads, iterations),
+                option_pricing_exact,
+                server_cpu_time(server),
+            ),
+            Engine(
+                "cpp_server_next_table",
+                lambda cards: server.option_pricing_next_table(cards, threads, iterations),
+                option_pricing_exact_next_table,
+                server_cpu_time(server),
+            ),
+        ]
+    if table is not None:
+        engines.append(Engine("table", table.get, option_pricing_exact))
+    if engine_names:
+        engines = [engine for engine in engines if engine.name in engine_names]
+    return engines, cleanups
+
+
+def run_benchmark(threads: int, iterations: int, repeat: int, engine_names: Optional[List[str]] = None) -> Dict:
+    engines, cleanups = make_engines(threads, iterations, PricingTable.load(), engine_names)
+    results = []
+    try:
+        for engine in engines:
+            for state, chosen_cards in CORPUS.items():
+                cards = Cards()
+                cards.set_chosen_cards(chosen_cards)
+                if engine.name == "table" and engine.price(cards) is None:
+                    logger.info(f"Skipping {state} for table, state is deeper than the table")
+                    continue
+                result = {"engine": engine.name, "state": state, **run_engine(engine, cards, repeat)}
+                logger.info(
+                    f"{engine.name:>22} {state:>15} p50 {result['p50_ms']:9.3f} ms  p99 {result['p99_ms']:9.3f} ms  "
+                    f"{result['throughput_per_second']:10.1f}/s  cpu {result['cpu_ms_per_call']:9.3f} ms  "
+                    f"max error {result['max_abs_error']:.5f}"
+                )
+                results.append(result)
+    finally:
+        for cleanup in cleanups:
+            cleanup()
+
+    return {
+        "timestamp": time.time(),
+        "machine": {"platform": platform.platform(), "cpu_count": os.cpu_count()},
+        "config": {"threads": threads, "iterations": iterations, "repeat": repeat},
+        "results": results,
+    }
+
+
+def compare(report: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """
+    Describe every engine and state that got slower than baseline by more than tolerance, or less accurate.
+
+    Monte Carlo errors move from run to run, so an error only counts as a regression when an exact result stopped
+    being exact or a sampled error more than tripled.
+    """
+    baseline_results = {(result["engine"], result["state"]): result for result in baseline["results"]}
+    regressions = []
+    for result in report["results"]:
+        previous = baseline_results.get((result["engine"], result["state"]))
+        if previous is None:
+            continue
+        for metric in ("p50_ms", "cpu_ms_per_call"):
+            if result[metric] > previous[metric] * (1 + tolerance):
+                regressions.append(
+                    f"{result['engine']} {result['state']} {metric}: {previous[metric]:.6g} -> {result[metric]:.6g}"
+                )
+        error, previous_error = result["max_abs_error"], previous["max_abs_error"]
+        if error > 1e-9 and error > 3 * previous_error:
+            regressions.append(
+                f"{result['engine']} {result['state']} max_abs_error: {previous_error:.6g} -> {error:.6g}"
+            )
+    return regressions
+
+
+def test_price_error():
+    assert price_error((1.0, 2.0, 0.5, -0.5), (1.5, 2.0, 0.5, -0.25)) == 0.5
+    assert price_error([None, (1.0, 1.0, 0.0, 0.0)], [None, (1.0, 0.5, 0.0, 0.0)]) == 0.5
+
+
+def test_compare():
+    previous = {"engine": "exact", "state": "empty deck", "p50_ms": 1.0, "cpu_ms_per_call": 1.0, "max_abs_error": 0.0}
+    slower = {**previous, "p50_ms": 1.5}
+    assert compare({"results": [slower]}, {"results": [previous]}, 0.2) == ["exact empty deck p50_ms: 1 -> 1.5"]
+    assert compare({"results": [slower]}, {"results": [previous]}, 0.6) == []
+
+    inexact = {**previous, "max_abs_error": 0.01}
+    assert compare({"results": [inexact]}, {"results": [previous]}, 0.2) == [
+        "exact empty deck max_abs_error: 0 -> 0.01"
+    ]
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Benchmark the option pricing engines")
+    parser.add_argument("--threads", type=int, default=1, help="Threads for the cpp engines")
+    parser.add_argument("--iterations", type=int, default=100000, help="Monte Carlo iterations per thread")
+    parser.add_argument("--repeat", type=int, default=20, help="Timed calls per engine and state")
+    parser.add_argument("--engine", action="append", help="Only run these engines")
+    parser.add_argument("--output", default="benchmark_results.json", help="Where to write the results")
+    parser.add_argument("--baseline", help="Previous results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative slowdown against the baseline")
+    args = parser.parse_args()
+
+    report = run_benchmark(args.threads, args.iterations, args.repeat, args.engine)
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=2)
+    logger.info(f"Wrote {args.output}")
+
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            regressions = compare(report, json.load(file), args.tolerance)
+        for regression in regressions:
+            logger.warning(f"Regression: {regression}")
+        if regressions:
+            raise SystemExit(1)
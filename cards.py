@@ -1,43 +1,102 @@
-from typing import List
+from typing import List, Tuple
 
 
 class Cards:
+    """
+    The cards chosen so far, backed by a count per card value so that every statistic is kept up to date as cards
+    are chosen instead of being recomputed from the whole deck.
+    """
+
+    __slots__ = (
+        "_chosen_cards",
+        "_total_cards_to_choose",
+        "_counts",
+        "_chosen_sum",
+        "_remaining_num",
+        "_remaining_sum",
+        "_state_key",
+    )
+
     all_cards = [1.0, 1.0, 1.0, 1.0, 2.0, 2.0, 2.0, 2.0, 3.0, 3.0, 3.0, 3.0, 4.0, 4.0, 4.0, 4.0, 5.0, 5.0, 5.0, 5.0,
                  6.0, 6.0, 6.0, 6.0, 7.0, 7.0, 7.0, 7.0, 8.0, 8.0, 8.0, 8.0, 9.0, 9.0, 9.0, 9.0, 10.0, 10.0, 10.0, 10.0,
                  11.0, 11.0, 11.0, 11.0, 12.0, 12.0, 12.0, 12.0, 13.0, 13.0, 13.0, 13.0, ]
+    all_counts = (0, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4)
 
     def __init__(self, total_cards_to_choose=20):
-        self._chosen_cards = []
         self._total_cards_to_choose = total_cards_to_choose
+        self.set_chosen_cards([])
 
     def choose_card(self, card: float):
         self._chosen_cards.append(card)
+        self._remove_from_deck(card)
+
+    def _remove_from_deck(self, card: float):
+        if self._counts[int(card)] == 0:
+            raise ValueError(f"No {card} left in the deck")
+        self._counts[int(card)] -= 1
+        self._chosen_sum += card
+        self._remaining_num -= 1
+        self._remaining_sum -= card
+        self._state_key = None
 
     def get_chosen_cards_num(self) -> int:
         return len(self._chosen_cards)
 
     def set_chosen_cards(self, cards: List[float]):
-        self._chosen_cards = cards
+        self._chosen_cards = list(cards)
+        self._counts = list(self.all_counts)
+        self._chosen_sum = 0.0
+        self._remaining_num = len(self.all_cards)
+        self._remaining_sum = sum(self.all_cards)
+        self._state_key = None
+        for card in self._chosen_cards:
+            self._remove_from_deck(card)
+
+    def copy(self) -> "Cards":
+        cards = Cards.__new__(Cards)
+        cards._chosen_cards = self._chosen_cards.copy()
+        cards._total_cards_to_choose = self._total_cards_to_choose
+        cards._counts = self._counts.copy()
+        cards._chosen_sum = self._chosen_sum
+        cards._remaining_num = self._remaining_num
+        cards._remaining_sum = self._remaining_sum
+        cards._state_key = self._state_key
+        return cards
 
     def get_chosen_cards_sum(self) -> float:
-        return sum(self._chosen_cards)
+        return self._chosen_sum
 
     def get_remaining_cards(self) -> List[float]:
-        remaining_cards = self.all_cards.copy()
-        for x in self._chosen_cards:
-            remaining_cards.remove(x)
+        remaining_cards = []
+        for card, count in enumerate(self._counts):
+            remaining_cards.extend([float(card)] * count)
         return remaining_cards
 
+    def get_remaining_counts(self) -> List[int]:
+        """
+        Number of cards of each value left in the deck, indexed by card value.
+        """
+        return self._counts
+
     def get_remaining_cards_to_choose(self) -> int:
         return self._total_cards_to_choose - len(self._chosen_cards)
 
     def get_expected_value(self) -> float:
-        cards = self.get_remaining_cards()
-        return sum(cards) / len(cards)
+        return self._remaining_sum / self._remaining_num
 
     def get_theoretical_price(self) -> float:
         return self.get_expected_value() * self.get_remaining_cards_to_choose() + self.get_chosen_cards_sum()
 
+    @property
+    def state_key(self) -> Tuple[int, ...]:
+        """
+        Hashable key of the remaining deck. Prices only depend on the chosen cards through the deck, so this is the key
+        for any pricing cache.
+        """
+        if self._state_key is None:
+            self._state_key = tuple(self._counts)
+        return self._state_key
+
 
 def test_choose_cards():
     cards = Cards()
@@ -66,3 +125,25 @@ def test_theoretical_price():
     cards2 = Cards()
     assert cards2.get_expected_value() == 7.0
     assert cards2.get_theoretical_price() == 140
+
+
+def test_incremental_statistics():
+    cards = Cards()
+    cards.choose_card(13.0)
+    cards.choose_card(1.0)
+    cards.choose_card(13.0)
+    remaining_cards = cards.get_remaining_cards()
+    assert cards.get_chosen_cards_sum() == 27.0
+    assert cards.get_remaining_counts()[13] == 2
+    assert cards.get_expected_value() == sum(remaining_cards) / len(remaining_cards)
+    assert cards.get_theoretical_price() == 27.0 + cards.get_expected_value() * 17
+
+    other = Cards()
+    other.set_chosen_cards([13.0, 13.0, 1.0])
+    assert other.state_key == cards.state_key
+    assert hash(other.state_key) == hash(cards.state_key)
+
+    copy = cards.copy()
+    copy.choose_card(2.0)
+    assert copy.state_key != cards.state_key
+    assert cards.get_chosen_cards_num() == 3
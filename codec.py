@@ -0,0 +1,225 @@
+import argparse
+import json
+import math
+import os
+import timeit
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from model import (
+    CARD_VALUES,
+    NewsResponseList,
+    OrderList,
+    OrderRequest,
+    OrderResponse,
+    PositionResponseList,
+    Side,
+    StatusResponse,
+)
+from order_book import Book, Level, OrderBook
+
+# Validate every response against the pydantic models before converting it, for debugging a changed exchange.
+# Functions take strict=None to follow this switch.
+STRICT_VALIDATION = os.environ.get("CMI_STRICT_VALIDATION") == "1"
+
+SIDES = {side.value: side for side in Side}
+
+
+class Order(NamedTuple):
+    id: str
+    status: str
+    product: str
+    side: Side
+    price: float
+    volume: int
+    filled: int
+
+
+class News(NamedTuple):
+    time: str
+    message: str
+
+    def to_card(self) -> Optional[int]:
+        return CARD_VALUES.get(self.message)
+
+
+class PositionLimit(NamedTuple):
+    productSymbol: str
+    shortLimit: int
+    longLimit: int
+
+
+class Status(NamedTuple):
+    activeRoundName: str
+    acceptingOrders: bool
+    username: str
+    userRanking: int
+    positionLimits: List[PositionLimit]
+
+
+# tuple.__new__ skips the Python level __new__ of a NamedTuple, which costs more than the tuple itself
+_new = tuple.__new__
+
+
+def _book(data: Dict) -> Book:
+    bids = [_new(Level, (level["price"], level["volume"])) for level in data["buy"]]
+    asks = [_new(Level, (level["price"], level["volume"])) for level in data["sell"]]
+    bids.sort(reverse=True)
+    asks.sort()
+    return Book(data["product"], data["tickSize"], data["midPrice"] or 0.0, bids, asks)
+
+
+def _order(data: Dict) -> Order:
+    return Order(
+        data["id"], data["status"], data["product"], SIDES[data["side"]], data["price"], data["volume"], data["filled"]
+    )
+
+
+def _status(data: Dict) -> Status:
+    return Status(
+        data["activeRoundName"],
+        data["acceptingOrders"],
+        data["username"],
+        data["userRanking"],
+        [PositionLimit(limit["productSymbol"], limit["shortLimit"], limit["longLimit"]) for limit in data["positionLimits"]],
+    )
+
+
+def decode_order_book(raw: bytes, strict: Optional[bool] = None) -> Book:
+    strict = STRICT_VALIDATION if strict is None else strict
+    if strict:
+        return _book(OrderBook.model_validate_json(raw).model_dump())
+    return _book(json.loads(raw))
+
+
+def decode_orders(raw: bytes, strict: Optional[bool] = None) -> List[Order]:
+    strict = STRICT_VALIDATION if strict is None else strict
+    if strict:
+        return [_order(order) for order in OrderList.model_validate_json(raw).model_dump()]
+    return [_order(order) for order in json.loads(raw)]
+
+
+def decode_order(raw: bytes, strict: Optional[bool] = None) -> Order:
+    strict = STRICT_VALIDATION if strict is None else strict
+    if strict:
+        return _order(OrderResponse.model_validate_json(raw).model_dump())
+    return _order(json.loads(raw))
+
+
+def decode_positions(raw: bytes, strict: Optional[bool] = None) -> Dict[str, int]:
+    """
+    Net position of every product.
+    """
+    strict = STRICT_VALIDATION if strict is None else strict
+    positions = PositionResponseList.model_validate_json(raw).model_dump() if strict else json.loads(raw)
+    return {position["product"]: position["volume"] for position in positions}
+
+
+def decode_news(raw: bytes, strict: Optional[bool] = None) -> List[News]:
+    """
+    News in the order the exchange sent it, with the time left as the exchange's ISO 8601 string.
+    """
+    strict = STRICT_VALIDATION if strict is None else strict
+    if strict:
+        NewsResponseList.model_validate_json(raw)
+    return [_new(News, (news["time"], news["message"])) for news in json.loads(raw)]
+
+
+def decode_status(raw: bytes, strict: Optional[bool] = None) -> Status:
+    strict = STRICT_VALIDATION if strict is None else strict
+    if strict:
+        return _status(StatusResponse.model_validate_json(raw).model_dump())
+    return _status(json.loads(raw))
+
+
+# Everything of an order body but the price and volume, per product and side
+_order_templates: Dict[Tuple[str, Side], Tuple[str, str]] = {}
+
+
+def encode_order(product: str, side: Side, price: float, volume: int, strict: Optional[bool] = None) -> bytes:
+    """
+    JSON body of a new order, the same as OrderRequest.model_dump() would give, from a prebuilt template.
+    """
+    strict = STRICT_VALIDATION if strict is None else strict
+    if strict:
+        return OrderRequest(side=side, price=price, volume=volume, product=product).model_dump_json().encode()
+    if not math.isfinite(price) or volume != int(volume):
+        raise ValueError(f"Invalid order {side.value} {volume} {product} at {price}")
+    template = _order_templates.get((product, side))
+    if template is None:
+        head = json.dumps({"side": side.value, "product": product})[:-1]
+        template = (f'{head}, "price": ', ', "volume": ')
+        _order_templates[(product, side)] = template
+    return f"{template[0]}{float(price)!r}{template[1]}{int(volume)}}}".encode()
+
+
+ORDER_BOOK_SAMPLE = json.dumps(
+    {
+        "product": "FUTURE",
+        "tickSize": 0.5,
+        "midPrice": 140.0,
+        "buy": [{"price": 140.0 - level * 0.5, "volume": 10} for level in range(20)],
+        "sell": [{"price": 140.5 + level * 0.5, "volume": 10} for level in range(20)],
+    }
+).encode()
+NEWS_SAMPLE = json.dumps([{"time": "2024-08-05T16:13:56.704080677Z", "message": "7"}] * 20).encode()
+ORDERS_SAMPLE = json.dumps(
+    [
+        {
+            "id": str(order_id),
+            "status": "ACTIVE",
+            "product": "FUTURE",
+            "side": "BUY",
+            "price": 140.0,
+            "volume": 10,
+            "filled": 0,
+            "message": "",
+            "user": "test",
+            "timestamp": "2024-08-05T16:13:56.704080677Z",
+        }
+        for order_id in range(10)
+    ]
+).encode()
+POSITIONS_SAMPLE = json.dumps(
+    [{"product": "FUTURE", "volume": 10, "averageBuyPrice": 140.0, "averageSellPrice": 0.0}] * 3
+).encode()
+
+
+def test_decode_matches_strict():
+    for decode, sample in (
+        (decode_order_book, ORDER_BOOK_SAMPLE),
+        (decode_news, NEWS_SAMPLE),
+        (decode_orders, ORDERS_SAMPLE),
+        (decode_positions, POSITIONS_SAMPLE),
+    ):
+        assert decode(sample, strict=False) == decode(sample, strict=True)
+    assert decode_news(NEWS_SAMPLE)[0].to_card() == 7
+
+
+def test_encode_order():
+    body = encode_order("150 CALL", Side.SELL, 3.5, 20, strict=False)
+    assert json.loads(body) == OrderRequest(side=Side.SELL, price=3.5, volume=20, product="150 CALL").model_dump()
+    assert json.loads(encode_order("150 CALL", Side.SELL, 4, 1, strict=False))["price"] == 4.0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Per message cost of decoding responses and encoding orders")
+    parser.add_argument("--number", type=int, default=20000)
+    args = parser.parse_args()
+
+    def measure(name, function):
+        print(f"{name:>32} {timeit.timeit(function, number=args.number) / args.number * 1e6:8.2f} us")
+
+    measure("order book pydantic", lambda: OrderBook(**json.loads(ORDER_BOOK_SAMPLE)))
+    measure("order book fast", lambda: decode_order_book(ORDER_BOOK_SAMPLE, strict=False))
+    measure("order book strict", lambda: decode_order_book(ORDER_BOOK_SAMPLE, strict=True))
+    measure("news pydantic", lambda: NewsResponseList(json.loads(NEWS_SAMPLE)))
+    measure("news fast", lambda: decode_news(NEWS_SAMPLE, strict=False))
+    measure("orders pydantic", lambda: OrderList(json.loads(ORDERS_SAMPLE)))
+    measure("orders fast", lambda: decode_orders(ORDERS_SAMPLE, strict=False))
+    measure("positions pydantic", lambda: PositionResponseList(json.loads(POSITIONS_SAMPLE)))
+    measure("positions fast", lambda: decode_positions(POSITIONS_SAMPLE, strict=False))
+    measure(
+        "order request model_dump",
+        lambda: json.dumps(OrderRequest(side=Side.BUY, price=140.5, volume=10, product="FUTURE").model_dump()),
+    )
+    measure("order request template", lambda: encode_order("FUTURE", Side.BUY, 140.5, 10, strict=False))
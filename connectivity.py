@@ -1,13 +1,16 @@
 import logging
-import queue
 import threading
 import time
+from collections import OrderedDict, deque
 from enum import Enum
-from typing import Dict, List
+from typing import Callable, Deque, Dict, List, Optional, Tuple
 
-from api import BearerAuth, delete_order, delete_order_by_criteria, get_order_book, get_status, send_order
-from model import MarketStatus
-from order_book import OrderBook
+import api
+from api import BearerAuth
+from codec import Order
+from feed import MarketFeed
+from model import MarketStatus, OrderCriteria, PositionLimit, ProductResponse, Side
+from order_book import TickOrderBook
 
 logger = logging.getLogger(__name__)
 
@@ -16,56 +19,439 @@ class ConnectivityRequestType(Enum):
     NEW_ORDER = 0
     CANCEL_ORDER = 1
     CANCEL_ORDER_BY_CRITERIA = 2
+    IOC_ORDER = 3
+
+
+STATUS_TTL = 1.0
+PRODUCTS_TTL = 30.0
+RETRY_DELAY = 0.1
+
+# Cancels go out before anything else, then IOC orders, then quotes
+CANCEL_TYPES = {ConnectivityRequestType.CANCEL_ORDER, ConnectivityRequestType.CANCEL_ORDER_BY_CRITERIA}
+
+RequestKey = Optional[Tuple[str, Side]]
 
 
 class ConnectivityRequest:
+    """
+    A request for the gateway. key is the (product, side) the request touches, requests with the same key never run
+    concurrently, None when it can run alongside anything.
+    """
 
-    def __init__(self, type: ConnectivityRequestType, data) -> None:
+    __slots__ = ("type", "data", "key", "submit_time")
+
+    def __init__(self, type: ConnectivityRequestType, data, key: RequestKey = None) -> None:
         self.type = type
         self.data = data
+        self.key = key
+        self.submit_time = time.time()
+
+
+class OrderGateway:
+    """
+    Sends every order and cancel of the bot through a pool of workers sharing the pooled api session.
+
+    New orders wait in a latest-wins slot per product and side: a newer order for the same slot replaces a pending
+    one, and a cancel for the slot drops it. Workers take cancels first, then quotes, and never run two requests for
+    the same product and side at once, so a cancel cannot overtake the order it was meant for. IOC orders have their
+    own lane and hedge workers, so a hedge never waits behind quote traffic.
+    """
+
+    def __init__(
+        self,
+        auth: BearerAuth,
+        worker_count: int = 4,
+        client=api,
+        hedge_worker_count: int = 1,
+    ) -> None:
+        self.auth = auth
+        self.client = client
+        self.listeners: List[Callable[[ConnectivityRequest, Order], None]] = []
+        self.sent_count = 0
+        self.coalesced_count = 0
+        self.dropped_count = 0
+        self.max_wait = 0.0
+        self.mean_wait = 0.0
+        self._cancels: Deque[ConnectivityRequest] = deque()
+        self._iocs: Deque[ConnectivityRequest] = deque()
+        self._orders: "OrderedDict[RequestKey, ConnectivityRequest]" = OrderedDict()
+        self._in_flight: Dict[RequestKey, int] = {}
+        self._condition = threading.Condition()
+        self.workers = [
+            threading.Thread(target=self._work, args=(False,), daemon=True, name=f"OrderGateway {index}")
+            for index in range(worker_count)
+        ] + [
+            threading.Thread(target=self._work, args=(True,), daemon=True, name=f"OrderGateway hedge {index}")
+            for index in range(hedge_worker_count)
+        ]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, request: ConnectivityRequest):
+        with self._condition:
+            if request.type == ConnectivityRequestType.NEW_ORDER:
+                if request.key in self._orders:
+                    self.coalesced_count += 1
+                    # Keep the age of the slot so a product that requotes constantly is not starved
+                    request.submit_time = self._orders[request.key].submit_time
+                self._orders[request.key] = request
+            elif request.type == ConnectivityRequestType.IOC_ORDER:
+                self._iocs.append(request)
+            else:
+                if request.key in self._orders:
+                    del self._orders[request.key]
+                    self.dropped_count += 1
+                self._cancels.append(request)
+            # Hedge and order workers wait on the same condition, so wake all of them
+            self._condition.notify_all()
+
+    def insert_order(self, instrument_id: str, *, price: float, volume: int, side: Side):
+        self.submit(
+            ConnectivityRequest(
+                ConnectivityRequestType.NEW_ORDER, (instrument_id, side, price, volume), (instrument_id, side)
+            )
+        )
+
+    def insert_ioc_order(self, instrument_id: str, price: float, volume: int, side: Side):
+        self.submit(ConnectivityRequest(ConnectivityRequestType.IOC_ORDER, (instrument_id, side, price, volume)))
+
+    def delete_order(self, order_id: str):
+        self.submit(ConnectivityRequest(ConnectivityRequestType.CANCEL_ORDER, order_id))
+
+    def delete_orders(self, instrument_id: str, side: Optional[Side] = None):
+        for side in (Side.BUY, Side.SELL) if side is None else (side,):
+            self.submit(
+                ConnectivityRequest(
+                    ConnectivityRequestType.CANCEL_ORDER_BY_CRITERIA,
+                    OrderCriteria(product=instrument_id, side=side, price=None),
+                    (instrument_id, side),
+                )
+            )
 
+    def depth(self) -> int:
+        with self._condition:
+            return len(self._cancels) + len(self._iocs) + len(self._orders)
 
-def connectivity(queue: queue.Queue[ConnectivityRequest], auth: BearerAuth):
-    while True:
-        request = queue.get()
+    def metrics(self) -> Dict[str, float]:
+        """
+        Queue depth per lane, age of the oldest pending request and how long sent requests waited, in seconds.
+        """
+        with self._condition:
+            pending = [*self._cancels, *self._iocs, *self._orders.values()]
+            return {
+                "cancel_depth": len(self._cancels),
+                "ioc_depth": len(self._iocs),
+                "order_depth": len(self._orders),
+                "in_flight": sum(self._in_flight.values()),
+                "oldest_age": time.time() - min(request.submit_time for request in pending) if pending else 0.0,
+                "mean_wait": self.mean_wait,
+                "max_wait": self.max_wait,
+                "sent": self.sent_count,
+                "coalesced": self.coalesced_count,
+                "dropped": self.dropped_count,
+            }
+
+    def wait_idle(self, timeout: Optional[float] = None) -> bool:
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: not (self._cancels or self._iocs or self._orders or self._in_flight), timeout
+            )
+
+    def _take(self, hedge: bool) -> Optional[ConnectivityRequest]:
+        if hedge:
+            return self._iocs.popleft() if self._iocs else None
+        for index, request in enumerate(self._cancels):
+            if request.key is None or request.key not in self._in_flight:
+                del self._cancels[index]
+                return request
+        for key, request in self._orders.items():
+            if key not in self._in_flight:
+                del self._orders[key]
+                return request
+        return None
+
+    def _work(self, hedge: bool):
+        while True:
+            with self._condition:
+                request = self._take(hedge)
+                while request is None:
+                    self._condition.wait()
+                    request = self._take(hedge)
+                self._in_flight[request.key] = self._in_flight.get(request.key, 0) + 1
+                wait = time.time() - request.submit_time
+                self.max_wait = max(self.max_wait, wait)
+                self.mean_wait += 0.05 * (wait - self.mean_wait)
+            try:
+                self._send(request)
+            except Exception as error:
+                logger.exception(f"Gateway request {request.type.name} {request.data} failed: {error}")
+            finally:
+                with self._condition:
+                    self.sent_count += 1
+                    self._in_flight[request.key] -= 1
+                    if self._in_flight[request.key] == 0:
+                        del self._in_flight[request.key]
+                    self._condition.notify_all()
+
+    def _send(self, request: ConnectivityRequest):
         if request.type == ConnectivityRequestType.NEW_ORDER:
-            logger.info(f"Sending order {request.data}")
-            send_order(auth, request.data)
+            product, side, price, volume = request.data
+            self._acknowledge(request, self.client.send_new_order(self.auth, product, side, price, volume))
+        elif request.type == ConnectivityRequestType.IOC_ORDER:
+            product, side, price, volume = request.data
+            res = self.client.send_new_order(self.auth, product, side, price, volume)
+            # The fill is known from the acknowledgement, so pass it on before the cancel round trip, and skip the
+            # cancel when nothing is left resting
+            self._acknowledge(request, res)
+            if res is not None and res.filled < res.volume:
+                self.client.delete_order(self.auth, res.id)
         elif request.type == ConnectivityRequestType.CANCEL_ORDER:
-            logger.info(f"Cancelling order {request.data}")
-            delete_order(auth, request.data)
+            self.client.delete_order(self.auth, request.data)
         elif request.type == ConnectivityRequestType.CANCEL_ORDER_BY_CRITERIA:
-            delete_order_by_criteria(auth, request.data)
-        queue.task_done()
+            self.client.delete_order_by_criteria(self.auth, request.data)
+
+    def _acknowledge(self, request: ConnectivityRequest, order: Optional[Order]):
+        if order is None:
+            return
+        for listener in self.listeners:
+            listener(request, order)
+
+
+def market_feeder(products: Dict[str, float], order_books: Dict[str, TickOrderBook], auth: BearerAuth, ):
+    """
+    Fill order_books with the books of every product, given with its tick size, kept up to date in place by the
+    order book streams.
+    """
+    feed = MarketFeed(auth, products)
+    order_books.update(feed.order_books)
+    feed.start()
+    return feed
+
+
+class ReferenceData:
+    """
+    Status, ranking, position limits and product definitions of the exchange, refreshed when older than their TTL.
+
+    Readers get the latest snapshot without a request: the status is replaced by a new MarketStatus on every refresh,
+    and products is one dict updated in place, so a reference to it stays current. Once started, a background thread
+    keeps both fresh; before that a stale read refreshes on the calling thread. Products listed by a new round are
+    passed to the on_new_products callbacks.
+    """
+
+    def __init__(
+        self,
+        auth: BearerAuth,
+        status_ttl: float = STATUS_TTL,
+        products_ttl: float = PRODUCTS_TTL,
+        client=api,
+    ) -> None:
+        self.auth = auth
+        self.status_ttl = status_ttl
+        self.products_ttl = products_ttl
+        self.client = client
+        self.status = MarketStatus()
+        self.products: Dict[str, ProductResponse] = {}
+        self.status_time = 0.0
+        self.products_time = 0.0
+        self.refresh_count = 0
+        self._new_products_callbacks: List[Callable[[List[ProductResponse]], None]] = []
+        self._lock = threading.Lock()
+        self._started = False
+        self._stopped = threading.Event()
+
+    def on_new_products(self, callback: Callable[[List[ProductResponse]], None]):
+        self._new_products_callbacks.append(callback)
+
+    def start(self):
+        self._started = True
+        threading.Thread(target=self._refresh_loop, daemon=True, name="ReferenceData").start()
 
+    def stop(self):
+        self._stopped.set()
 
-def market_feeder(lock: threading.Lock, products: List[str], order_books: Dict[str, OrderBook], auth: BearerAuth, ):
-    while True:
-        for product in products:
-            res = get_order_book(auth, product)
-            if res is not None:
-                with lock:
-                    order_books[product] = res
-        time.sleep(0.01)
+    def get_status(self) -> MarketStatus:
+        if not self._started and time.time() - self.status_time > self.status_ttl:
+            self.refresh_status()
+        return self.status
 
+    def get_products(self) -> Dict[str, ProductResponse]:
+        if not self._started and time.time() - self.products_time > self.products_ttl:
+            self.refresh_products()
+        return self.products
 
-def market_status(status: MarketStatus, auth: BearerAuth):
-    success = False
-    while True:
+    def rank(self) -> Optional[int]:
+        status = self.get_status()
+        return status.userRanking if self.status_time else None
 
-        res = get_status(auth)
+    def accepting_orders(self) -> Optional[bool]:
+        """
+        Whether the exchange accepts orders, None while no status has been fetched yet.
+        """
+        status = self.get_status()
+        return status.acceptingOrders if self.status_time else None
+
+    def position_limit(self, product: str) -> Optional[PositionLimit]:
+        return self.get_status().positionLimits.get(product)
+
+    def refresh_status(self) -> bool:
+        res = self.client.get_status(self.auth)
         if res is None:
-            success = False
-        else:
-            status.acceptingOrders = res.acceptingOrders
-            status.activeRoundName = res.activeRoundName
-            status.username = res.username
-            status.userRanking = res.userRanking
-            for product in res.positionLimits.root:
-                status.positionLimits[product.productSymbol].longLimit = (product.longLimit)
-                status.positionLimits[product.productSymbol].shortLimit = (product.shortLimit)
-            success = True
-        if success:
-            time.sleep(1)
-        else:
-            time.sleep(0.01)
+            return False
+        status = MarketStatus(
+            activeRoundName=res.activeRoundName,
+            acceptingOrders=res.acceptingOrders,
+            username=res.username,
+            userRanking=res.userRanking,
+            positionLimits={
+                limit.productSymbol: PositionLimit(shortLimit=limit.shortLimit, longLimit=limit.longLimit)
+                for limit in res.positionLimits
+            },
+        )
+        if status.activeRoundName != self.status.activeRoundName and self.status_time:
+            logger.info(f"Round changed from {self.status.activeRoundName} to {status.activeRoundName}")
+            # A new round can list new products, so look for them now
+            self.products_time = 0.0
+        self.status = status
+        self.status_time = time.time()
+        self.refresh_count += 1
+        return True
+
+    def refresh_products(self) -> List[ProductResponse]:
+        """
+        Fetch the product definitions and return the products that were not listed before.
+        """
+        products = self.client.get_all_products(self.auth).root
+        with self._lock:
+            listed = bool(self.products)
+            new_products = [product for product in products if product.symbol not in self.products]
+            for product in products:
+                self.products[product.symbol] = product
+            self.products_time = time.time()
+        if new_products and listed:
+            logger.info(f"New products listed: {[product.symbol for product in new_products]}")
+        for callback in self._new_products_callbacks:
+            callback(new_products)
+        return new_products
+
+    def _refresh_loop(self):
+        while not self._stopped.is_set():
+            now = time.time()
+            try:
+                if now - self.status_time > self.status_ttl and not self.refresh_status():
+                    self._stopped.wait(RETRY_DELAY)
+                    continue
+                if now - self.products_time > self.products_ttl:
+                    self.refresh_products()
+            except Exception as error:
+                logger.warning(f"Refreshing reference data failed: {error}")
+                self._stopped.wait(RETRY_DELAY)
+                continue
+            next_time = min(self.status_time + self.status_ttl, self.products_time + self.products_ttl)
+            self._stopped.wait(max(0.0, next_time - time.time()))
+
+
+class RecordingClient:
+    """
+    Stand-in for the api module that records requests and takes delay seconds per request.
+    """
+
+    def __init__(self, delay: float) -> None:
+        self.delay = delay
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def _record(self, request):
+        with self.lock:
+            self.requests.append(request)
+        time.sleep(self.delay)
+
+    def send_new_order(self, auth, product, side, price, volume):
+        self._record(("new", product, side, price))
+
+    def delete_order(self, auth, order_id):
+        self._record(("cancel", order_id))
+
+    def delete_order_by_criteria(self, auth, criteria):
+        self._record(("cancel", criteria.product, criteria.side))
+
+
+def test_gateway_coalesces_and_cancels_first():
+    client = RecordingClient(0.05)
+    gateway = OrderGateway(BearerAuth("token"), worker_count=1, client=client)
+    gateway.delete_order("blocker")
+    time.sleep(0.01)
+    for price in (1.0, 2.0, 3.0):
+        gateway.insert_order("FUTURE", price=price, volume=1, side=Side.BUY)
+    gateway.insert_order("FUTURE", price=9.0, volume=1, side=Side.SELL)
+    gateway.delete_orders("FUTURE")
+    gateway.insert_order("FUTURE", price=4.0, volume=1, side=Side.BUY)
+    assert gateway.metrics()["order_depth"] == 1
+    assert gateway.wait_idle(5.0)
+    assert client.requests == [
+        ("cancel", "blocker"),
+        ("cancel", "FUTURE", Side.BUY),
+        ("cancel", "FUTURE", Side.SELL),
+        ("new", "FUTURE", Side.BUY, 4.0),
+    ]
+    metrics = gateway.metrics()
+    assert (metrics["coalesced"], metrics["dropped"], metrics["sent"]) == (2, 2, 4)
+
+
+def test_gateway_workers_run_in_parallel():
+    client = RecordingClient(0.2)
+    gateway = OrderGateway(BearerAuth("token"), worker_count=6, client=client)
+    start_time = time.time()
+    for product in ("FUTURE", "150 CALL", "130 PUT"):
+        gateway.insert_order(product, price=1.0, volume=1, side=Side.BUY)
+        gateway.insert_order(product, price=2.0, volume=1, side=Side.SELL)
+    assert gateway.wait_idle(5.0)
+    assert len(client.requests) == 6 and time.time() - start_time < 0.4
+
+
+def test_gateway_hedges_skip_quote_traffic():
+    client = RecordingClient(0.1)
+    gateway = OrderGateway(BearerAuth("token"), worker_count=1, client=client)
+    for product in ("FUTURE", "150 CALL", "130 PUT"):
+        gateway.insert_order(product, price=1.0, volume=1, side=Side.BUY)
+    gateway.insert_ioc_order("FUTURE", 2.0, 5, Side.SELL)
+    assert gateway.wait_idle(5.0)
+    assert client.requests.index(("new", "FUTURE", Side.SELL, 2.0)) <= 1
+
+
+class StatusClient:
+    """
+    Stand-in for the api module serving a fixed status and a product list that can grow.
+    """
+
+    def __init__(self) -> None:
+        self.symbols = ["FUTURE"]
+        self.status_count = 0
+
+    def get_status(self, auth):
+        from codec import PositionLimit as LimitResponse, Status
+
+        self.status_count += 1
+        return Status("Round 1", True, "test", 3, [LimitResponse(symbol, 100, 100) for symbol in self.symbols])
+
+    def get_all_products(self, auth):
+        from model import ProductResponseList
+
+        return ProductResponseList(
+            [ProductResponse(symbol=symbol, tickSize=0.1, startingPrice=100, contractSize=1) for symbol in self.symbols]
+        )
+
+
+def test_reference_data_refreshes_after_ttl():
+    client = StatusClient()
+    reference = ReferenceData(BearerAuth("token"), status_ttl=60.0, products_ttl=0.0, client=client)
+    listed = []
+    reference.on_new_products(lambda products: listed.extend(product.symbol for product in products))
+    for _ in range(10):
+        assert reference.rank() == 3 and reference.accepting_orders()
+    assert client.status_count == 1
+    assert reference.position_limit("FUTURE") == PositionLimit(shortLimit=100, longLimit=100)
+
+    products = reference.get_products()
+    client.symbols.append("150 CALL")
+    reference.get_products()
+    assert listed == ["FUTURE", "150 CALL"] and "150 CALL" in products
@@ -1,9 +1,17 @@
 import datetime
-from typing import Dict, List, Optional
+import time
+from typing import Callable, Dict, List, Optional
 
 import api
-from api import get_all_products, sign_in, sign_up
-from model import (NewsResponse, OrderCriteria, OrderRequest, OrderStatus, PriceBook, PriceVolume, ProductResponse, Side, )
+from api import sign_in, sign_up
+from connectivity import ConnectivityRequest, ConnectivityRequestType, OrderGateway, ReferenceData
+from feed import MarketFeed, SSEMessage, SSEStream
+from order_book import TickOrderBook
+from codec import News, Order
+from ledger import RECONCILE_INTERVAL, PositionLedger
+from order_manager import OrderManager
+from risk import RiskGate
+from model import (OrderCriteria, OrderStatus, PriceBook, PriceVolume, ProductResponse, Side, )
 
 
 class Exchange:
@@ -11,33 +19,160 @@ class Exchange:
         if sign_up_for_new_account:
             sign_up(username, password)
         self._auth = sign_in(username, password)
-        self.products: Dict[str, ProductResponse] = {}
+        self.reference = ReferenceData(self._auth)
+        self.reference.on_new_products(self._on_new_products)
+        self.products: Dict[str, ProductResponse] = self.reference.products
+        self.feed: Optional[MarketFeed] = None
+        self.gateway: Optional[OrderGateway] = None
+        self.order_listeners: List[Callable[[Order, bool], None]] = []
+        self.orders = OrderManager(self)
+        self.ledger: Optional[PositionLedger] = None
+        self.trade_stream: Optional[SSEStream] = None
+        self.risk: Optional[RiskGate] = None
+        self.order_listeners.append(self.orders.on_order)
         self.update_products()
         self.delete_all_orders()
 
-    def insert_order(self, instrument_id: str, *, price: float, volume: int, side: Side):
+    def start_feed(self):
         """
-        Insert a limit order on an instrument.
+        Stream order books and news into a local cache, so reads stop polling the exchange.
         """
-        return api.send_order(self._auth, OrderRequest(side=side, price=price, volume=volume, product=instrument_id))
+        self.feed = MarketFeed(self._auth, {symbol: product.tickSize for symbol, product in self.products.items()})
+        self.feed.start()
 
-    def insert_ioc_order(self, instrument_id: str, price: float, volume: int, side: Side):
-        res = api.send_order(self._auth, OrderRequest(side=side, price=price, volume=volume, product=instrument_id))
+    def start_reference_data(self):
+        """
+        Refresh status, limits and products in the background, so reading them never waits on a request.
+        """
+        self.reference.start()
+
+    def _on_new_products(self, products: List[ProductResponse]):
+        if self.feed is not None:
+            for product in products:
+                self.feed.add_product(product.symbol, product.tickSize)
+
+    def start_ledger(self, reconcile_interval: float = RECONCILE_INTERVAL):
+        """
+        Keep positions locally from the trade stream and order acknowledgements, reconciled with the exchange in the
+        background.
+        """
+        if not self.reference.status_time:
+            # Our trades are told apart by the username in the status
+            self.reference.refresh_status()
+        self.ledger = PositionLedger(
+            lambda: api.get_position(self._auth),
+            reconcile_interval,
+            self.orders.resting_price,
+            lambda product: self.products[product].tickSize,
+        )
+        self.order_listeners.append(self.ledger.on_order)
+        self.ledger.start()
+        self.trade_stream = SSEStream(f"{api.ENDPOINT}/trade/stream", self._auth, self._on_trade_message)
+        self.trade_stream.start()
+
+    def _on_trade_message(self, message: SSEMessage):
+        payload = message.payload()
+        username = self.reference.status.username
+        if payload["buyer"] == payload["seller"]:
+            return
+        if payload["buyer"] == username:
+            side = Side.BUY
+        elif payload["seller"] == username:
+            side = Side.SELL
+        else:
+            return
+        self.ledger.on_trade(payload["product"], side, payload["price"], payload["volume"])
+
+    def start_risk_gate(self):
+        """
+        Check every order against the cached limits, ledger positions and resting quotes before sending it.
+        Requires start_ledger.
+        """
+        if not self.reference.status_time:
+            # Limits and the halt flag are unknown until the first status, so fetch it now rather than on the first order
+            self.reference.refresh_status()
+        self.risk = RiskGate(self.reference, self.ledger.position, self.orders.resting_volume)
+        self.orders.risk = self.risk
+
+    def start_gateway(self, worker_count: int = 4, hedge_worker_count: int = 1):
+        """
+        Send orders and cancels through an OrderGateway. Order methods then queue the request and return None at once.
+        """
+        self.gateway = OrderGateway(self._auth, worker_count, hedge_worker_count=hedge_worker_count)
+        self.gateway.listeners.append(self._on_gateway_order)
+
+    def _on_gateway_order(self, request: ConnectivityRequest, order: Order):
+        self._notify_order(order, request.type == ConnectivityRequestType.IOC_ORDER)
+
+    def _notify_order(self, order: Order, ioc: bool):
+        """
+        Pass an insert acknowledgement to every order listener, ioc tells whether it was an immediate-or-cancel order.
+        """
+        for listener in self.order_listeners:
+            listener(order, ioc)
+
+    def insert_order(self, instrument_id: str, *, price: float, volume: int, side: Side, risk_checked=False):
+        """
+        Insert a limit order on an instrument. Returns None without sending when the risk gate rejects it.
+        """
+        if self.risk is not None and not risk_checked:
+            volume = self.risk.check(instrument_id, side, volume)
+            if volume <= 0:
+                return None
+        if self.ledger is not None:
+            self.ledger.on_send(instrument_id, side, price, volume, False)
+        if self.gateway is not None:
+            return self.gateway.insert_order(instrument_id, price=price, volume=volume, side=side)
+        res = api.send_new_order(self._auth, instrument_id, side, price, volume)
         if res is not None:
-            self.delete_order(res.id)
+            self._notify_order(res, False)
+        return res
+
+    def insert_ioc_order(self, instrument_id: str, price: float, volume: int, side: Side) -> int:
+        """
+        Insert an order and cancel whatever of it did not fill at once. Returns the volume sent, 0 when the risk gate
+        stopped it.
+        """
+        if self.risk is not None:
+            # An IOC never rests, so only the position counts against the limit, not the quotes resting on its side
+            volume = self.risk.check(instrument_id, side, volume, resting=0)
+            if volume <= 0:
+                return 0
+        if self.ledger is not None:
+            self.ledger.on_send(instrument_id, side, price, volume, True)
+        if self.gateway is not None:
+            self.gateway.insert_ioc_order(instrument_id, price, volume, side)
+            return volume
+        res = api.send_new_order(self._auth, instrument_id, side, price, volume)
+        if res is not None:
+            self._notify_order(res, True)
+            if res.filled < res.volume:
+                api.delete_order(self._auth, res.id)
+        return volume
 
     def delete_order(self, order_id: str):
         """
         Delete a specific outstanding limit order on an instrument.
         """
+        if self.gateway is not None:
+            self.gateway.delete_order(order_id)
+            return
         api.delete_order(self._auth, order_id)
 
-    def delete_orders(self, instrument_id: str):
-        api.delete_order_by_criteria(self._auth, OrderCriteria(product=instrument_id, side=Side.BUY, price=None))
-        api.delete_order_by_criteria(self._auth, OrderCriteria(product=instrument_id, side=Side.SELL, price=None))
+    def delete_orders(self, instrument_id: str, side: Optional[Side] = None):
+        """
+        Delete every outstanding order on an instrument, or only those on one side.
+        """
+        self.orders.forget(instrument_id, side)
+        if self.gateway is not None:
+            self.gateway.delete_orders(instrument_id, side)
+            return
+        for side in (Side.BUY, Side.SELL) if side is None else (side,):
+            api.delete_order_by_criteria(self._auth, OrderCriteria(product=instrument_id, side=side, price=None))
 
     def delete_all_orders(self):
-        for product in self.products:
+        # A snapshot, products is the reference data's dict, which its refresh thread can add to meanwhile
+        for product in list(self.products):
             self.delete_orders(product)
 
     def get_outstanding_orders(self, ) -> Optional[Dict[str, OrderStatus]]:
@@ -45,41 +180,55 @@ class Exchange:
         if orders is None:
             return None
         res = {}
-        for order in orders.root:
+        for order in orders:
             res[order.id] = OrderStatus(order.product, order.id, order.price, order.volume, order.side)
         return res
 
+    def get_book(self, instrument_id: str) -> Optional[TickOrderBook]:
+        """
+        The streamed order book of an instrument, updated in place. Requires start_feed.
+        """
+        if self.feed is None:
+            return None
+        return self.feed.get_order_book(instrument_id)
+
     def get_last_price_book(self, instrument_id: str) -> Optional[PriceBook]:
+        book = self.get_book(instrument_id)
+        if book is not None:
+            bids = [PriceVolume(price=price, volume=volume) for price, volume in book.levels(Side.BUY)]
+            asks = [PriceVolume(price=price, volume=volume) for price, volume in book.levels(Side.SELL)]
+            return PriceBook(timestamp=datetime.datetime.now(), instrument_id=instrument_id, bids=bids, asks=asks, )
         order_book = api.get_order_book(self._auth, instrument_id)
         if order_book is None:
             return None
-        bids: List[PriceVolume] = []
-        asks: List[PriceVolume] = []
-        buys = order_book.buy.root
-        sells = order_book.sell.root
-        for buy in buys:
-            bids.append(PriceVolume(price=buy.price, volume=buy.volume))
-        for sell in sells:
-            asks.append(PriceVolume(price=sell.price, volume=sell.volume))
-        bids.sort(key=lambda bid: bid.price, reverse=True)
-        asks.sort(key=lambda ask: ask.price, reverse=False)
+        bids = [PriceVolume(price=price, volume=volume) for price, volume in order_book.bids]
+        asks = [PriceVolume(price=price, volume=volume) for price, volume in order_book.asks]
         price_book = PriceBook(timestamp=datetime.datetime.now(), instrument_id=instrument_id, bids=bids, asks=asks, )
         return price_book
 
     def get_positions(self) -> Optional[Dict[str, int]]:
-        positions = api.get_position(self._auth)
-        if positions is None:
-            return None
-        res = {}
-        for position in positions.root:
-            res[position.product] = position.volume
-        return res
-
-    def get_news(self) -> List[NewsResponse]:
+        if self.ledger is not None:
+            positions = self.ledger.positions()
+            if positions is not None:
+                return positions
+        return api.get_position(self._auth)
+
+    def get_news(self) -> List[News]:
+        if self.feed is not None:
+            return self.feed.get_news()
         res = api.get_news(self._auth)
         if res is None:
             return []
-        return res.root
+        return res
+
+    def wait_for_news(self, news_version: int, timeout: float) -> int:
+        """
+        Block until the news changes or timeout passes. Without a feed there is nothing to wait on, so just sleep.
+        """
+        if self.feed is not None:
+            return self.feed.wait_for_news(news_version, timeout)
+        time.sleep(timeout)
+        return news_version
 
     def get_product(self, product: str) -> ProductResponse:
         """
@@ -91,15 +240,10 @@ class Exchange:
         """
         Update all products on the exchange.
         """
-        products = get_all_products(self._auth).root
-        for product in products:
-            self.products[product.symbol] = product
+        self.reference.refresh_products()
 
     def get_rank(self) -> Optional[int]:
-        res = api.get_status(self._auth)
-        if res is None:
-            return None
-        return res.userRanking
+        return self.reference.rank()
 
 
 if __name__ == "__main__":
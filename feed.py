@@ -0,0 +1,430 @@
+import json
+import logging
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+
+import requests
+
+from api import ENDPOINT, BearerAuth
+from codec import News, decode_news
+from order_book import TickOrderBook
+
+logger = logging.getLogger(__name__)
+
+RECONNECT_DELAY = 0.1
+MAX_RECONNECT_DELAY = 5.0
+
+
+class SSEMessage:
+    __slots__ = ("id", "event", "data", "retry")
+
+    def __init__(self) -> None:
+        self.id: Optional[str] = None
+        self.event: Optional[str] = None
+        self.data: Optional[str] = None
+        self.retry: Optional[int] = None
+
+    def payload(self):
+        """
+        The JSON body of the message. The exchange sends it in the event field, see generic_bot_example.ipynb.
+        """
+        if self.data:
+            return json.loads(self.data)
+        return json.loads(self.event)
+
+
+def parse_sse(lines: Iterable[str]) -> Iterator[SSEMessage]:
+    """
+    Split a text/event-stream into messages, one per blank line terminated block.
+    """
+    message = SSEMessage()
+    has_fields = False
+    for line in lines:
+        if not line:
+            if has_fields:
+                yield message
+            message = SSEMessage()
+            has_fields = False
+            continue
+        if line.startswith(":"):
+            continue
+        field, _, value = line.partition(":")
+        if value.startswith(" "):
+            value = value[1:]
+        if field == "data":
+            message.data = value if message.data is None else f"{message.data}\n{value}"
+        elif field == "event":
+            message.event = value
+        elif field == "id":
+            message.id = value
+        elif field == "retry" and value.isdigit():
+            message.retry = int(value)
+        else:
+            continue
+        has_fields = True
+    if has_fields:
+        yield message
+
+
+class SSEStream(threading.Thread):
+    """
+    Follow one event stream, reconnecting with exponential backoff and resuming from the last event id.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        auth: BearerAuth,
+        handler: Callable[[SSEMessage], None],
+        read_timeout: float = 30.0,
+    ) -> None:
+        super().__init__(daemon=True, name=f"SSEStream {url}")
+        self.url = url
+        self.auth = auth
+        self.handler = handler
+        self.read_timeout = read_timeout
+        self.reconnect_delay = RECONNECT_DELAY
+        self.last_event_id: Optional[str] = None
+        self.connect_count = 0
+        self.connected = threading.Event()
+        self._stopped = threading.Event()
+        self._response: Optional[requests.Response] = None
+
+    def run(self):
+        delay = self.reconnect_delay
+        while not self._stopped.is_set():
+            try:
+                self._stream()
+                delay = self.reconnect_delay
+                self._stopped.wait(delay)
+            except Exception as error:
+                if self._stopped.is_set():
+                    break
+                logger.warning(f"Stream {self.url} failed, reconnecting in {delay:.2f} seconds: {error}")
+                self._stopped.wait(delay)
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+    def _stream(self):
+        headers = {"Accept": "text/event-stream; charset=utf-8", "Cache-Control": "no-cache"}
+        if self.last_event_id is not None:
+            headers["Last-Event-ID"] = self.last_event_id
+        with requests.get(
+            self.url, headers=headers, auth=self.auth, stream=True, verify=False, timeout=(5.0, self.read_timeout)
+        ) as response:
+            response.raise_for_status()
+            self._response = response
+            self.connect_count += 1
+            self.connected.set()
+            logger.info(f"Connected to stream {self.url}")
+            try:
+                for message in parse_sse(response.iter_lines(chunk_size=None, decode_unicode=True)):
+                    if message.id is not None:
+                        self.last_event_id = message.id
+                    if message.retry is not None:
+                        self.reconnect_delay = message.retry / 1000
+                    if message.data is None and message.event is None:
+                        continue
+                    try:
+                        self.handler(message)
+                    except Exception as error:
+                        logger.exception(f"Handler of stream {self.url} failed: {error}")
+            finally:
+                self.connected.clear()
+                self._response = None
+        logger.info(f"Stream {self.url} ended")
+
+    def stop(self):
+        self._stopped.set()
+        response = self._response
+        if response is not None:
+            response.close()
+
+
+class MarketFeed:
+    """
+    Last value cache of order books and news, fed by the exchange streams and fanned out to subscribers.
+
+    Every product has one TickOrderBook that stream messages update in place, so readers keep a reference to it.
+
+    Order books come from the per product streams. News is polled at news_interval unless news_stream is set, since
+    only the order and trade streams are documented; subscribers are only called when the news changes.
+    """
+
+    def __init__(
+        self,
+        auth: BearerAuth,
+        tick_sizes: Dict[str, float],
+        endpoint: str = ENDPOINT,
+        news_stream: bool = False,
+        news_interval: float = 0.2,
+    ) -> None:
+        self.auth = auth
+        self.tick_sizes = tick_sizes
+        self.endpoint = endpoint
+        self.news_stream = news_stream
+        self.news_interval = news_interval
+        self.order_books: Dict[str, TickOrderBook] = {
+            product: TickOrderBook(product, tick_size) for product, tick_size in tick_sizes.items()
+        }
+        self.news: List[News] = []
+        self.version = 0
+        self.news_version = 0
+        self._condition = threading.Condition()
+        self._order_book_subscribers: List[Callable[[TickOrderBook], None]] = []
+        self._news_subscribers: List[Callable[[List[News]], None]] = []
+        self._streams: List[SSEStream] = []
+        self._stopped = threading.Event()
+        self._started = False
+        self._session = requests.Session()
+
+    def subscribe_order_book(self, callback: Callable[[TickOrderBook], None]):
+        self._order_book_subscribers.append(callback)
+
+    def subscribe_news(self, callback: Callable[[List[News]], None]):
+        self._news_subscribers.append(callback)
+
+    def start(self):
+        for product in self.tick_sizes:
+            self._streams.append(
+                SSEStream(f"{self.endpoint}/order/{product}/stream", self.auth, self._on_order_book_message)
+            )
+        self._started = True
+        if self.news_stream:
+            self._streams.append(SSEStream(f"{self.endpoint}/news/stream", self.auth, self._on_news_message))
+        else:
+            threading.Thread(target=self._poll_news, daemon=True, name="MarketFeed news").start()
+        for stream in self._streams:
+            stream.start()
+
+    def stop(self):
+        self._stopped.set()
+        for stream in self._streams:
+            stream.stop()
+
+    def add_product(self, product: str, tick_size: float):
+        """
+        Follow the order book of a product listed after the feed was created.
+        """
+        if product in self.order_books:
+            return
+        self.tick_sizes[product] = tick_size
+        self.order_books[product] = TickOrderBook(product, tick_size)
+        if self._started:
+            stream = SSEStream(f"{self.endpoint}/order/{product}/stream", self.auth, self._on_order_book_message)
+            self._streams.append(stream)
+            stream.start()
+
+    def get_order_book(self, product: str) -> Optional[TickOrderBook]:
+        return self.order_books.get(product)
+
+    def get_news(self) -> List[News]:
+        with self._condition:
+            return self.news
+
+    def wait_for_news(self, news_version: int, timeout: Optional[float] = None) -> int:
+        """
+        Block until the news is newer than news_version or timeout passes, and return the current news version.
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self.news_version != news_version, timeout)
+            return self.news_version
+
+    def _on_order_book_message(self, message: SSEMessage):
+        payload = message.payload()
+        order_book = self.order_books.get(payload["productsymbol"])
+        if order_book is None:
+            logger.warning(f"Order book of unknown product {payload['productsymbol']}")
+            return
+        with self._condition:
+            order_book.apply_stream_snapshot(payload)
+            self.version += 1
+            self._condition.notify_all()
+        for callback in self._order_book_subscribers:
+            callback(order_book)
+
+    def _on_news_message(self, message: SSEMessage):
+        payload = message.payload()
+        news = News(payload["time"], payload["message"])
+        self._set_news(self.news + [news])
+
+    def _poll_news(self):
+        while not self._stopped.is_set():
+            try:
+                response = self._session.get(f"{self.endpoint}/news", auth=self.auth, verify=False, timeout=5.0)
+                if response.ok:
+                    news = decode_news(response.content)
+                    if news != self.news:
+                        self._set_news(news)
+                else:
+                    logger.warning(f"Polling news failed with status {response.status_code}")
+            except Exception as error:
+                logger.warning(f"Polling news failed: {error}")
+            self._stopped.wait(self.news_interval)
+
+    def _set_news(self, news: List[News]):
+        with self._condition:
+            self.news = news
+            self.version += 1
+            self.news_version += 1
+            self._condition.notify_all()
+        for callback in self._news_subscribers:
+            callback(news)
+
+
+class LocalFeedServer:
+    """
+    Stand-in for the exchange streams to test feeds offline: serves /order/{product}/stream, /news/stream and /news.
+    """
+
+    def __init__(self, heartbeat_interval: float = 0.5) -> None:
+        self.heartbeat_interval = heartbeat_interval
+        self.news: List[Dict] = []
+        self._clients: Dict[str, List[queue.Queue]] = {}
+        self._lock = threading.Lock()
+        self._event_id = 0
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True, name="LocalFeedServer").start()
+
+    @property
+    def endpoint(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def client_count(self, path: str) -> int:
+        with self._lock:
+            return len(self._clients.get(path, []))
+
+    def publish(self, path: str, payload: Dict):
+        with self._lock:
+            self._event_id += 1
+            message = f"id: {self._event_id}\nevent: {json.dumps(payload)}\n\n"
+            for client in self._clients.get(path, []):
+                client.put(message)
+
+    def publish_order_book(self, product: str, buy: Dict[float, int], sell: Dict[float, int], mid_price: float):
+        self.publish(
+            f"/order/{product}/stream",
+            {
+                "productsymbol": product,
+                "buyOrders": {str(price): {"marketVolume": volume, "userVolume": 0} for price, volume in buy.items()},
+                "sellOrders": {str(price): {"marketVolume": volume, "userVolume": 0} for price, volume in sell.items()},
+                "midPrice": mid_price,
+            },
+        )
+
+    def publish_news(self, message: str):
+        news = {"time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()), "message": message}
+        with self._lock:
+            self.news.append(news)
+        self.publish("/news/stream", news)
+
+    def disconnect_all(self):
+        with self._lock:
+            for clients in self._clients.values():
+                for client in clients:
+                    client.put(None)
+
+    def close(self):
+        self.disconnect_all()
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+            def do_GET(self):
+                if self.path == "/news":
+                    with server._lock:
+                        body = json.dumps(server.news).encode()
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                    return
+                if not self.path.endswith("/stream"):
+                    self.send_error(404)
+                    return
+                # Register before the headers go out, so a client that sees them connected cannot miss a publish
+                client: queue.Queue = queue.Queue()
+                with server._lock:
+                    server._clients.setdefault(self.path, []).append(client)
+                try:
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/event-stream")
+                    self.send_header("Transfer-Encoding", "chunked")
+                    self.end_headers()
+                    while True:
+                        try:
+                            message = client.get(timeout=server.heartbeat_interval)
+                        except queue.Empty:
+                            message = ":\n\n"
+                        if message is None:
+                            break
+                        data = message.encode()
+                        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                        self.wfile.flush()
+                    self.wfile.write(b"0\r\n\r\n")
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+                finally:
+                    with server._lock:
+                        server._clients[self.path].remove(client)
+                    self.close_connection = True
+
+        return Handler
+
+
+def test_parse_sse():
+    lines = [": comment", "id: 1", "event: {\"a\": 1}", "", "data: {\"b\":", "data: 2}", "retry: 100", ""]
+    messages = list(parse_sse(lines))
+    assert len(messages) == 2
+    assert (messages[0].id, messages[0].payload()) == ("1", {"a": 1})
+    assert (messages[1].payload(), messages[1].retry) == ({"b": 2}, 100)
+
+
+def wait_until(condition: Callable[[], bool], timeout: float = 5.0) -> bool:
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_market_feed_reconnects():
+    server = LocalFeedServer()
+    feed = MarketFeed(BearerAuth("token"), {"FUTURE": 0.5}, endpoint=server.endpoint, news_interval=0.01)
+    received = []
+    feed.subscribe_order_book(received.append)
+    feed.start()
+    try:
+        assert wait_until(lambda: server.client_count("/order/FUTURE/stream") == 1)
+        server.publish_order_book("FUTURE", {140.0: 5, 140.5: 1}, {141.0: 2}, 140.75)
+        assert wait_until(lambda: len(received) == 1)
+        order_book = feed.get_order_book("FUTURE")
+        assert (order_book.best_bid(), order_book.best_ask()) == (140.5, 141.0)
+
+        server.disconnect_all()
+        assert wait_until(lambda: feed._streams[0].connect_count == 2)
+        server.publish_order_book("FUTURE", {}, {141.0: 3}, 141.0)
+        assert wait_until(lambda: len(received) == 2)
+        assert feed.get_order_book("FUTURE") is order_book
+        assert (order_book.best_bid(), order_book.best_ask_volume()) == (None, 3)
+
+        server.publish_news("K")
+        version = feed.wait_for_news(0, timeout=5.0)
+        assert version == 1 and feed.get_news()[0].to_card() == 13
+    finally:
+        feed.stop()
+        server.close()
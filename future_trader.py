@@ -2,30 +2,43 @@
 from cards import Cards
 from exchange import Exchange
 from model import Side
-from trade import news_to_cards
+from news import NewsCursor
 from util import round_down_to_tick, round_up_to_tick
 import logging
 
 logger = logging.getLogger(__name__)
 
+def make_market(cmi: Exchange, cards: Cards):
+    cmi.delete_all_orders()
+    theo = cards.get_theoretical_price()
+    bid_price = round_down_to_tick(theo, 0.5)
+    ask_price = round_up_to_tick(theo, 0.5)
+    if bid_price == ask_price:
+        ask_price += 0.5
+    logging.info(f"Making market at {bid_price} - {ask_price}")
+    cmi.insert_order("FUTURE", price=bid_price, volume=200, side=Side.BUY)
+    cmi.insert_order("FUTURE", price=ask_price, volume=200, side=Side.SELL)
+
+
 def main():
     cmi = Exchange("FutureTrader", "FutureTrader", sign_up_for_new_account=False)
+    cmi.start_feed()
     cards = Cards()
+    cursor = NewsCursor()
+    cursor.on_card(lambda card, time: cards.choose_card(float(card)))
+
+    def on_reset():
+        cards.set_chosen_cards([])
+        make_market(cmi, cards)
+
+    cursor.on_reset(on_reset)
+    make_market(cmi, cards)
+    news_version = 0
     while True:
-        news = news_to_cards(cmi.get_news())
-        size = len(news)
-        if size != cards.get_chosen_cards_num() or size == 0:
-            cmi.delete_all_orders()
-            cards.set_chosen_cards(news)
-            theo = cards.get_theoretical_price()
-            bid_price = round_down_to_tick(theo, 0.5)
-            ask_price = round_up_to_tick(theo, 0.5)
-            if bid_price == ask_price:
-                ask_price += 0.5
-            logging.info(f"Making market at {bid_price} - {ask_price}")
-            cmi.insert_order("FUTURE", price=bid_price, volume=200, side=Side.BUY)
-            cmi.insert_order("FUTURE", price=ask_price, volume=200, side=Side.SELL)
-    
+        news_version = cmi.wait_for_news(news_version, 1.0)
+        if cursor.update(cmi.get_news()):
+            make_market(cmi, cards)
+
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO)
     main()
\ No newline at end of file
@@ -0,0 +1,316 @@
+import logging
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+from codec import Order
+from model import Side
+from util import to_ticks
+
+logger = logging.getLogger(__name__)
+
+RECONCILE_INTERVAL = 5.0
+
+FillPrice = Callable[[str, Side], Optional[float]]
+
+
+class SentOrder:
+    """
+    An order sent to the exchange, with the fills its acknowledgement and the trade stream have reported so far.
+    """
+
+    __slots__ = ("product", "side", "price", "volume", "ioc", "generation", "order_id", "filled", "streamed",
+                 "acked_generation")
+
+    def __init__(self, product: str, side: Side, price: float, volume: int, ioc: bool, generation: int) -> None:
+        self.product = product
+        self.side = side
+        self.price = price
+        self.volume = volume
+        self.ioc = ioc
+        self.generation = generation
+        self.order_id: Optional[str] = None
+        self.filled = 0
+        self.streamed = 0
+        self.acked_generation: Optional[int] = None
+
+    def booked(self) -> int:
+        # Both sources report the same fills, so the one that has seen more is booked
+        return max(self.filled, self.streamed)
+
+
+class PositionLedger:
+    """
+    Positions and cash kept locally from the exchange's trade stream and insert acknowledgements, so reading them
+    costs no request.
+
+    Each trade of ours from the stream is booked as it arrives at its execution price, fills of resting quotes
+    included. The fill in an insert acknowledgement is booked at once as well, at the limit price, since the trade of
+    an IOC can arrive before or after its acknowledgement. on_send records every order before it goes out and both
+    sources are attributed to it, so each fill is booked once, and a trade reported after the acknowledgement only
+    corrects the cash to its execution price.
+
+    As a safety net for trades the stream missed, a background thread fetches the exchange positions every
+    reconcile_interval seconds and takes them as the truth. Every reconciliation starts a new generation; a product
+    with a fill booked in the current generation, after the request went out, keeps its local position until the
+    next one, since the fetched one may or may not include that fill. A position that moved without a fill seen is
+    booked to cash at fill_price, the price of the quote that was resting on that side, when known.
+    """
+
+    def __init__(
+        self,
+        fetch_positions: Callable[[], Optional[Dict[str, int]]],
+        reconcile_interval: float = RECONCILE_INTERVAL,
+        fill_price: Optional[FillPrice] = None,
+        tick_size: Optional[Callable[[str], float]] = None,
+    ) -> None:
+        self.fetch_positions = fetch_positions
+        self.reconcile_interval = reconcile_interval
+        self.fill_price = fill_price
+        self.tick_size = tick_size
+        self.cash = 0.0
+        self.fill_count = 0
+        self.trade_count = 0
+        self.reconcile_count = 0
+        self.drift_count = 0
+        self.reconciled = threading.Event()
+        self.listeners: List[Callable[[], None]] = []
+        self._positions: Dict[str, int] = {}
+        self._sent: Dict[Tuple[str, Side], List[SentOrder]] = {}
+        self._fill_generations: Dict[str, int] = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def start(self):
+        self.reconcile()
+        threading.Thread(target=self._reconcile_loop, daemon=True, name="PositionLedger").start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def positions(self) -> Optional[Dict[str, int]]:
+        """
+        Net position of every product, None until the first reconciliation succeeded.
+        """
+        if not self.reconciled.is_set():
+            return None
+        with self._lock:
+            return dict(self._positions)
+
+    def position(self, product: str) -> int:
+        with self._lock:
+            return self._positions.get(product, 0)
+
+    def pnl(self, marks: Dict[str, Optional[float]]) -> Optional[float]:
+        """
+        Cash plus every position valued at its mark, None when a held product has no mark.
+        """
+        with self._lock:
+            value = self.cash
+            for product, volume in self._positions.items():
+                if volume == 0:
+                    continue
+                mark = marks.get(product)
+                if mark is None:
+                    return None
+                value += volume * mark
+            return value
+
+    def awaiting_ack(self, product: str) -> bool:
+        """
+        Whether an IOC order of the product was sent and its acknowledgement has not been booked yet.
+        """
+        with self._lock:
+            return any(
+                sent.ioc and sent.order_id is None
+                for side in (Side.BUY, Side.SELL)
+                for sent in self._sent.get((product, side), ())
+            )
+
+    def on_send(self, product: str, side: Side, price: float, volume: int, ioc: bool):
+        """
+        Record an order about to be sent, called before the request so its trades cannot arrive first.
+        """
+        with self._lock:
+            self._sent.setdefault((product, side), []).append(
+                SentOrder(product, side, price, volume, ioc, self._generation)
+            )
+
+    def on_order(self, order: Order, ioc: bool):
+        with self._lock:
+            sent = self._match(order)
+            if sent is None:
+                booked = order.filled
+            else:
+                sent.order_id = order.id
+                sent.acked_generation = self._generation
+                booked = max(0, order.filled - sent.booked())
+                sent.filled = order.filled
+            if booked > 0:
+                self._apply_fill(order.product, booked if order.side == Side.BUY else -booked, order.price)
+        # An IOC acknowledgement is passed on even without a fill, it ends a hedge in flight
+        if booked > 0 or ioc:
+            self._notify()
+
+    def on_trade(self, product: str, side: Side, price: float, volume: int):
+        """
+        Book a trade of ours from the trade stream, side being the side we traded on.
+        """
+        sign = 1 if side == Side.BUY else -1
+        remaining = volume
+        with self._lock:
+            self.trade_count += 1
+            ticks = self._ticks(product, price)
+            for sent in self._sent.get((product, side), ()):
+                if remaining == 0:
+                    break
+                limit = self._ticks(product, sent.price)
+                if sent.streamed >= sent.volume or (ticks > limit if side == Side.BUY else ticks < limit):
+                    continue
+                attributed = min(remaining, sent.volume - sent.streamed)
+                booked = sent.booked()
+                sent.streamed += attributed
+                new = sent.booked() - booked
+                if new > 0:
+                    self._apply_fill(product, sign * new, price)
+                # The rest was booked from the acknowledgement at the limit price
+                self.cash += sign * (attributed - new) * (sent.price - price)
+                remaining -= attributed
+            if remaining > 0:
+                self._apply_fill(product, sign * remaining, price)
+        self._notify()
+
+    def reconcile(self) -> bool:
+        with self._lock:
+            self._generation += 1
+            generation = self._generation
+        positions = self.fetch_positions()
+        if positions is None:
+            logger.warning("Reconciling positions failed, keeping the local ledger")
+            return False
+        with self._lock:
+            for product, fill_generation in self._fill_generations.items():
+                if fill_generation >= generation:
+                    positions[product] = self._positions.get(product, 0)
+            changed = positions != self._positions
+            for product in positions.keys() | self._positions.keys():
+                drift = positions.get(product, 0) - self._positions.get(product, 0)
+                if drift == 0 or not self.reconciled.is_set():
+                    continue
+                self.drift_count += 1
+                price = None
+                if self.fill_price is not None:
+                    price = self.fill_price(product, Side.BUY if drift > 0 else Side.SELL)
+                if price is None:
+                    logger.warning(f"Position of {product} moved by {drift} without a known price")
+                else:
+                    self.cash -= drift * price
+            self._positions = positions
+            for key, sent_orders in self._sent.items():
+                self._sent[key] = [sent for sent in sent_orders if not self._settled(sent, generation)]
+        self.reconcile_count += 1
+        self.reconciled.set()
+        if changed:
+            self._notify()
+        return True
+
+    def _settled(self, sent: SentOrder, generation: int) -> bool:
+        """
+        Whether the positions fetched in generation hold everything there is to attribute to an order.
+        """
+        if sent.acked_generation is None:
+            # Not acknowledged through a whole reconciliation, lost or never sent by the gateway
+            return sent.generation < generation - 1
+        if sent.streamed < sent.filled:
+            # Its trades may still be on their way, keep it one more reconciliation for them
+            return sent.acked_generation < generation - 1
+        return sent.acked_generation < generation
+
+    def _match(self, order: Order) -> Optional[SentOrder]:
+        ticks = self._ticks(order.product, order.price)
+        for sent in self._sent.get((order.product, order.side), ()):
+            if sent.order_id is None and sent.volume == order.volume and self._ticks(sent.product, sent.price) == ticks:
+                return sent
+        return None
+
+    def _ticks(self, product: str, price: float) -> int:
+        if self.tick_size is None:
+            return to_ticks(price)
+        return to_ticks(price, self.tick_size(product))
+
+    def _notify(self):
+        for listener in self.listeners:
+            listener()
+
+    def _apply_fill(self, product: str, volume: int, price: float):
+        self._positions[product] = self._positions.get(product, 0) + volume
+        self._fill_generations[product] = self._generation
+        self.cash -= volume * price
+        self.fill_count += 1
+
+    def _reconcile_loop(self):
+        while not self._stopped.wait(self.reconcile_interval):
+            try:
+                self.reconcile()
+            except Exception as error:
+                logger.exception(f"Reconciling positions failed: {error}")
+
+
+def test_ledger_applies_fills_and_reconciles():
+    exchange_positions = {"FUTURE": 0}
+    ledger = PositionLedger(lambda: dict(exchange_positions), fill_price=lambda product, side: 99.0)
+    assert ledger.positions() is None
+    ledger.reconcile()
+
+    ledger.on_order(Order("1", "ACTIVE", "FUTURE", Side.BUY, 100.0, 50, 20), False)
+    ledger.on_order(Order("2", "CANCELLED", "FUTURE", Side.SELL, 101.0, 5, 5), True)
+    assert ledger.positions() == {"FUTURE": 15} and ledger.cash == -1495.0
+    assert ledger.pnl({"FUTURE": 100.0}) == 5.0 and ledger.pnl({}) is None
+
+    # The exchange saw both fills plus 10 more of the resting bid
+    exchange_positions["FUTURE"] = 25
+    assert ledger.reconcile()
+    assert ledger.position("FUTURE") == 25 and ledger.cash == -2485.0 and ledger.drift_count == 1
+
+    # A fill booked while positions are fetched may be in the fetched positions or not, so it is not drift
+    def fetch_with_fill():
+        ledger.on_order(Order("3", "ACTIVE", "FUTURE", Side.BUY, 100.0, 10, 10), False)
+        return {"FUTURE": 35}
+
+    ledger.fetch_positions = fetch_with_fill
+    assert ledger.reconcile()
+    assert ledger.position("FUTURE") == 35 and ledger.cash == -3485.0 and ledger.drift_count == 1
+    ledger.fetch_positions = lambda: {"FUTURE": 35}
+    assert ledger.reconcile() and ledger.drift_count == 1
+
+
+def test_ledger_books_each_fill_once():
+    ledger = PositionLedger(lambda: {}, tick_size=lambda product: 0.1)
+    ledger.reconcile()
+
+    # The acknowledgement comes first, the trade then only corrects the cash to the execution price
+    ledger.on_send("FUTURE", Side.BUY, 101.0, 10, True)
+    assert ledger.awaiting_ack("FUTURE")
+    ledger.on_order(Order("1", "CANCELLED", "FUTURE", Side.BUY, 101.0, 10, 6), True)
+    assert not ledger.awaiting_ack("FUTURE")
+    ledger.on_trade("FUTURE", Side.BUY, 100.0, 6)
+    assert ledger.position("FUTURE") == 6 and ledger.cash == -600.0
+
+    # The trade comes first, the acknowledgement then adds nothing
+    ledger.on_send("FUTURE", Side.SELL, 99.0, 4, True)
+    ledger.on_trade("FUTURE", Side.SELL, 99.5, 4)
+    ledger.on_order(Order("2", "FILLED", "FUTURE", Side.SELL, 99.0, 4, 4), True)
+    assert ledger.position("FUTURE") == 2 and ledger.cash == -202.0
+
+    # A resting quote filled later is booked from the trade alone, whichever sent order it is attributed to
+    ledger.on_send("FUTURE", Side.BUY, 98.0, 20, False)
+    ledger.on_order(Order("3", "ACTIVE", "FUTURE", Side.BUY, 98.0, 20, 0), False)
+    ledger.on_trade("FUTURE", Side.BUY, 98.0, 5)
+    assert ledger.position("FUTURE") == 7 and ledger.cash == -692.0
+
+    # Once reconciled twice every sent order is settled, later trades are booked as they come
+    ledger.fetch_positions = lambda: {"FUTURE": 7}
+    assert ledger.reconcile() and ledger.reconcile()
+    assert not any(ledger._sent.values()) and ledger.drift_count == 0
+    ledger.on_trade("FUTURE", Side.SELL, 99.0, 7)
+    assert ledger.position("FUTURE") == 0
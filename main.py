@@ -3,6 +3,8 @@ from threading import Thread
 
 from cards import Cards
 from exchange import Exchange
+from option_pricing import PricingEngine
+from pricing_table import PricingTable
 from strategy import Call, Future, Hedger, Pricer, Put
 from trade import full_auto_trade, manual_news_trade
 from trade_config import Mode, TradeConfig
@@ -17,31 +19,50 @@ DEFAULT_FUTURE_SYMBOL = "FUTURE"
 DEFAULT_CALL_SYMBOL = "150 CALL"
 DEFAULT_PUT_SYMBOL = "130 PUT"
 DEFAULT_STRATEGY_INTERVAL = 9
-DEFAULT_HEDGER_INTERVAL = 9.1
+DEFAULT_HEDGE_BAND = 10
 DEFAULT_THREAD_COUNT = 10
 DEFAULT_ITERATION_COUNT = 200000
+DEFAULT_PRICING_ENGINE = PricingEngine.EXACT
+DEFAULT_LOOKAHEAD_DEPTH = 2
+DEFAULT_LOOKAHEAD_BUDGET = 5.0
+DEFAULT_GATEWAY_WORKERS = 4
+DEFAULT_MIN_REQUOTE_INTERVAL = 0.0
+DEFAULT_RECONCILE_INTERVAL = 5.0
 DEFAULT_MODE = Mode.FULL_AUTO
 
 cmi = Exchange(USERNAME, PASSWORD, sign_up_for_new_account=False)
 
 
 def parse_args():
+    global DEFAULT_MODE, DEFAULT_PRICING_ENGINE
     parser = argparse.ArgumentParser(description='cmi')
     parser.add_argument('--manual', action='store_true', help='Set the manual mode')
+    parser.add_argument('--engine', choices=[engine.name.lower() for engine in PricingEngine],
+                        default=DEFAULT_PRICING_ENGINE.name.lower(), help='Set the option pricing engine')
     args = parser.parse_args()
     if args.manual:
-        global DEFAULT_MODE
         DEFAULT_MODE = Mode.MANUAL_NEWS
+    DEFAULT_PRICING_ENGINE = PricingEngine[args.engine.upper()]
 
 
 def main():
     parse_args()
+    cmi.start_reference_data()
+    cmi.start_feed()
+    cmi.start_gateway(DEFAULT_GATEWAY_WORKERS)
+    cmi.orders.min_requote_interval = DEFAULT_MIN_REQUOTE_INTERVAL
+    cmi.start_ledger(DEFAULT_RECONCILE_INTERVAL)
+    cmi.start_risk_gate()
 
     cards = Cards()
     pricer = Pricer(
         cards,
         thread_count=DEFAULT_THREAD_COUNT,
         iteration_count=DEFAULT_ITERATION_COUNT,
+        engine=DEFAULT_PRICING_ENGINE,
+        table=PricingTable.load(),
+        lookahead_depth=DEFAULT_LOOKAHEAD_DEPTH,
+        lookahead_budget=DEFAULT_LOOKAHEAD_BUDGET,
     )
     future = Future(cmi, DEFAULT_FUTURE_SYMBOL, cards, DEFAULT_STRATEGY_INTERVAL)
     call = Call(cmi, DEFAULT_CALL_SYMBOL, cards, pricer, DEFAULT_STRATEGY_INTERVAL)
@@ -52,7 +73,7 @@ def main():
         future=future,
         call=call,
         put=put,
-        interval=DEFAULT_HEDGER_INTERVAL,
+        band=DEFAULT_HEDGE_BAND,
     )
     trade_config = TradeConfig(
         exchange=cmi,
@@ -79,5 +100,7 @@ if __name__ == "__main__":
         main()
     except Exception as error:
         cmi.delete_all_orders()
+        if cmi.gateway is not None:
+            cmi.gateway.wait_idle(timeout=5.0)
         logger.exception(error)
         logger.error(f"Exception thrown, cancelled all orders, quitting")
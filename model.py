@@ -143,39 +143,29 @@ PositionLimitList = RootModel[List[PositionLimitResponse]]
 # ]
 
 
+CARD_VALUES = {
+    "A": 1,
+    "2": 2,
+    "3": 3,
+    "4": 4,
+    "5": 5,
+    "6": 6,
+    "7": 7,
+    "8": 8,
+    "9": 9,
+    "10": 10,
+    "J": 11,
+    "Q": 12,
+    "K": 13,
+}
+
+
 class NewsResponse(BaseModel):
     time: datetime.datetime
     message: str
 
     def to_card(self) -> Optional[int]:
-        match self.message:
-            case "A":
-                return 1
-            case "J":
-                return 11
-            case "Q":
-                return 12
-            case "K":
-                return 13
-            case "2":
-                return 2
-            case "3":
-                return 3
-            case "4":
-                return 4
-            case "5":
-                return 5
-            case "6":
-                return 6
-            case "7":
-                return 7
-            case "8":
-                return 8
-            case "9":
-                return 9
-            case "10":
-                return 10
-        return None
+        return CARD_VALUES.get(self.message)
 
 NewsResponseList = RootModel[List[NewsResponse]]
 
@@ -0,0 +1,99 @@
+import datetime
+import logging
+from typing import Callable, List, Optional, Tuple
+
+from codec import News
+
+logger = logging.getLogger(__name__)
+
+CardCallback = Callable[[int, datetime.datetime], None]
+
+
+def parse_time(time: str) -> datetime.datetime:
+    return datetime.datetime.fromisoformat(time)
+
+
+class NewsCursor:
+    """
+    Remembers the newest news item seen and turns only the newer ones into cards.
+
+    update scans the history from its newest end and stops at the first item it has already seen, so each call only
+    parses the new items, and every card fires on_card exactly once, oldest first. A history that no longer contains
+    the newest item seen means a new round, which fires on_reset and starts over.
+    """
+
+    def __init__(self) -> None:
+        self.last_time: Optional[datetime.datetime] = None
+        self.cards: List[int] = []
+        self.seen_count = 0
+        self._card_callbacks: List[CardCallback] = []
+        self._reset_callbacks: List[Callable[[], None]] = []
+
+    def on_card(self, callback: CardCallback):
+        self._card_callbacks.append(callback)
+
+    def on_reset(self, callback: Callable[[], None]):
+        self._reset_callbacks.append(callback)
+
+    def reset(self):
+        self.last_time = None
+        self.cards = []
+        self.seen_count = 0
+        for callback in self._reset_callbacks:
+            callback()
+
+    def update(self, news: List[News]) -> List[Tuple[int, datetime.datetime]]:
+        """
+        Feed the full news history, newest first or oldest first, and return the new cards with their times.
+        """
+        if len(news) < self.seen_count:
+            logger.info(f"News history shrank from {self.seen_count} to {len(news)} items, starting a new round")
+            self.reset()
+        if len(news) == self.seen_count:
+            return []
+
+        newest_first = len(news) == 1 or parse_time(news[0].time) >= parse_time(news[-1].time)
+        new_items: List[Tuple[datetime.datetime, News]] = []
+        for item in news if newest_first else reversed(news):
+            time = parse_time(item.time)
+            if self.last_time is not None and time <= self.last_time:
+                break
+            new_items.append((time, item))
+        else:
+            if self.last_time is not None:
+                logger.info("News history no longer contains the last item seen, starting a new round")
+                self.reset()
+        self.seen_count = len(news)
+        if not new_items:
+            return []
+
+        self.last_time = new_items[0][0]
+        events = []
+        for time, item in reversed(new_items):
+            card = item.to_card()
+            if card is None:
+                logger.warning(f"Ignoring news {item.message} at {item.time}, not a card")
+                continue
+            self.cards.append(card)
+            events.append((card, time))
+            for callback in self._card_callbacks:
+                callback(card, time)
+        return events
+
+
+def test_news_cursor():
+    cursor = NewsCursor()
+    received = []
+    cursor.on_card(lambda card, time: received.append(card))
+    history = [News("2024-08-05T16:13:16.587080625Z", "J")]
+    assert cursor.update(history) == [(11, parse_time(history[0].time))]
+
+    history = [News("2024-08-05T16:13:36.648905531Z", "3"), News("2024-08-05T16:13:26.621455680Z", "A")] + history
+    assert [card for card, _ in cursor.update(history)] == [1, 3]
+    assert cursor.update(history) == []
+    assert received == [11, 1, 3] and cursor.cards == [11, 1, 3]
+
+    resets = []
+    cursor.on_reset(lambda: resets.append(True))
+    assert [card for card, _ in cursor.update([News("2024-08-05T16:20:00.0Z", "K")])] == [13]
+    assert resets == [True] and cursor.cards == [13]
@@ -1,9 +1,18 @@
 #include <algorithm>
+#include <array>
 #include <cassert>
+#include <chrono>
+#include <cmath>
+#include <cstdint>
+#include <cstdio>
+#include <cstring>
 #include <future>
 #include <iostream>
+#include <limits>
 #include <numeric>
 #include <random>
+#include <stdexcept>
+#include <string>
 #include <vector>
 
 class Cards {
@@ -15,6 +24,11 @@ class Cards {
     card_counts[static_cast<std::size_t>(card)]--;
   }
 
+  [[nodiscard]] bool can_choose_card(int card) const {
+    return card >= 1 && card <= 13 && card_counts[card] > 0 &&
+           get_remaining_cards_to_choose() > 0;
+  }
+
   [[maybe_unused]] void set_chosen_cards(const std::vector<double>& cards) {
     chosen_cards = cards;
     reset_card_counts();
@@ -38,6 +52,15 @@ class Cards {
     return remaining_cards;
   }
 
+  // One byte per remaining card, the representation the sampling kernels use.
+  [[nodiscard]] std::vector<uint8_t> get_remaining_deck() const {
+    std::vector<uint8_t> deck;
+    for (uint8_t i = 1; i <= 13; i++) {
+      deck.insert(std::end(deck), card_counts[i], i);
+    }
+    return deck;
+  }
+
   [[nodiscard]] int get_remaining_cards_to_choose() const {
     return total_cards_to_choose - chosen_cards.size();
   }
@@ -99,15 +122,305 @@ inline double put_payoff(double strike_price, double underlying_price) {
   return 0;
 }
 
+// xoshiro256** seeded through splitmix64. It is far cheaper than
+// std::mt19937 for the handful of draws each iteration needs, and seedable so
+// runs can be reproduced.
+class Xoshiro256 {
+ public:
+  explicit Xoshiro256(uint64_t seed) {
+    for (auto& word : state) {
+      word = splitmix64(seed);
+    }
+  }
+
+  uint64_t next() {
+    const uint64_t result = rotl(state[1] * 5, 7) * 9;
+    const uint64_t t = state[1] << 17;
+    state[2] ^= state[0];
+    state[3] ^= state[1];
+    state[1] ^= state[2];
+    state[0] ^= state[3];
+    state[2] ^= t;
+    state[3] = rotl(state[3], 45);
+    return result;
+  }
+
+  // Uniform in [0, range) by multiply-shift, the bias is below range / 2^32.
+  uint32_t bounded(uint32_t range) {
+    return static_cast<uint32_t>(((next() >> 32) * range) >> 32);
+  }
+
+ private:
+  static uint64_t rotl(uint64_t x, int k) { return (x << k) | (x >> (64 - k)); }
+
+  static uint64_t splitmix64(uint64_t& x) {
+    uint64_t z = (x += 0x9e3779b97f4a7c15);
+    z = (z ^ (z >> 30)) * 0xbf58476d1ce4e5b9;
+    z = (z ^ (z >> 27)) * 0x94d049bb133111eb;
+    return z ^ (z >> 31);
+  }
+
+  std::array<uint64_t, 4> state{};
+};
+
+uint64_t random_seed() {
+  std::random_device rd;
+  return (static_cast<uint64_t>(rd()) << 32) | rd();
+}
+
+// The final sum is a small integer, so every payoff is a table lookup.
+constexpr int max_final_sum = 13 * 20;
+
+struct PayoffTable {
+  PayoffTable(double call_strike, double put_strike) {
+    for (int s = 0; s <= max_final_sum; s++) {
+      call[s] = call_payoff(call_strike, s);
+      put[s] = put_payoff(put_strike, s);
+      call_itm[s] = call[s] > 0;
+      put_itm[s] = put[s] > 0;
+    }
+  }
+
+  std::array<double, max_final_sum + 1> call{};
+  std::array<double, max_final_sum + 1> put{};
+  std::array<double, max_final_sum + 1> call_itm{};
+  std::array<double, max_final_sum + 1> put_itm{};
+};
+
 struct OptionPricingResult {
   double call_price;
   double put_price;
   double call_delta;
   double put_delta;
+  double call_error = 0;
+  double put_error = 0;
+};
+
+// Running sums for a control variate estimate. Each sample is the payoff
+// vector y (call, put, call in the money, put in the money) together with
+// the control z, the final sum minus its exactly known mean.
+struct PricingMoments {
+  uint64_t n = 0;
+  double control_sum = 0;
+  double control_sq_sum = 0;
+  std::array<double, 4> sum{};
+  std::array<double, 4> sq_sum{};
+  std::array<double, 4> cross_sum{};
+
+  void add(const std::array<double, 4>& y, double z) {
+    n++;
+    control_sum += z;
+    control_sq_sum += z * z;
+    for (std::size_t i = 0; i < y.size(); i++) {
+      sum[i] += y[i];
+      sq_sum[i] += y[i] * y[i];
+      cross_sum[i] += y[i] * z;
+    }
+  }
+
+  void merge(const PricingMoments& other) {
+    n += other.n;
+    control_sum += other.control_sum;
+    control_sq_sum += other.control_sq_sum;
+    for (std::size_t i = 0; i < sum.size(); i++) {
+      sum[i] += other.sum[i];
+      sq_sum[i] += other.sq_sum[i];
+      cross_sum[i] += other.cross_sum[i];
+    }
+  }
+
+  // Regresses each payoff on the control and removes the part explained by
+  // the control's sampling error, reporting the standard error of the result.
+  [[nodiscard]] OptionPricingResult estimate() const {
+    const auto count = static_cast<double>(n);
+    const double control_mean = control_sum / count;
+    const double control_var =
+        control_sq_sum / count - control_mean * control_mean;
+    std::array<double, 4> value{};
+    std::array<double, 4> error{};
+    for (std::size_t i = 0; i < sum.size(); i++) {
+      const double mean = sum[i] / count;
+      const double var = sq_sum[i] / count - mean * mean;
+      const double cov = cross_sum[i] / count - mean * control_mean;
+      const double beta = control_var > 1e-12 ? cov / control_var : 0;
+      value[i] = mean - beta * control_mean;
+      error[i] = n > 1 ? std::sqrt(std::max(var - beta * cov, 0.0) / (count - 1))
+                       : std::numeric_limits<double>::infinity();
+    }
+    return {value[0], value[1], value[2], value[3], error[0], error[1]};
+  }
 };
 
-OptionPricingResult option_pricing(double call_strike, double put_strike,
-                                   const Cards& cards, uint64_t iterations) {
+// Each iteration draws an antithetic pair: a partial Fisher-Yates shuffle
+// of 2k swaps leaves a uniformly random ordered sample in the first 2k
+// positions, and its first k and second k cards are both valid draws. Since
+// the deck total is fixed their sums are negatively correlated, which makes
+// each pair a single sample.
+PricingMoments option_pricing(double call_strike, double put_strike,
+                              const Cards& cards, uint64_t iterations,
+                              uint64_t seed) {
+  std::vector<uint8_t> deck = cards.get_remaining_deck();
+  const auto deck_size = static_cast<uint32_t>(deck.size());
+  const int to_choose = cards.get_remaining_cards_to_choose();
+  const int chosen_sum = static_cast<int>(cards.get_chosen_cards_sum());
+  const double theoretical_price = cards.get_theoretical_price();
+  const PayoffTable payoffs(call_strike, put_strike);
+  Xoshiro256 rng(seed);
+  PricingMoments moments;
+  for (uint64_t c = 1; c <= iterations; c++) {
+    int first_price = chosen_sum;
+    for (int i = 0; i < to_choose; i++) {
+      std::swap(deck[i], deck[i + rng.bounded(deck_size - i)]);
+      first_price += deck[i];
+    }
+    int last_price = chosen_sum;
+    for (int i = to_choose; i < 2 * to_choose; i++) {
+      std::swap(deck[i], deck[i + rng.bounded(deck_size - i)]);
+      last_price += deck[i];
+    }
+    moments.add({(payoffs.call[first_price] + payoffs.call[last_price]) / 2,
+                 (payoffs.put[first_price] + payoffs.put[last_price]) / 2,
+                 (payoffs.call_itm[first_price] + payoffs.call_itm[last_price]) / 2,
+                 (payoffs.put_itm[first_price] + payoffs.put_itm[last_price]) / 2},
+                (first_price + last_price) / 2.0 - theoretical_price);
+  }
+  return moments;
+}
+
+using OptionPricingTable = std::array<OptionPricingResult, 14>;
+
+// Prices every next card branch from the same shuffles. Each branch removes
+// one designated copy of its card from the deck; a branch whose designated
+// copy lands in the first k - 1 shuffled positions takes the first k cards
+// instead, which keeps every branch an unbiased draw while the differences
+// between branches are free of independent sampling noise.
+OptionPricingTable option_pricing_next(double call_strike, double put_strike,
+                                       const Cards& cards, uint64_t iterations,
+                                       uint64_t seed) {
+  const std::vector<uint8_t> deck = cards.get_remaining_deck();
+  const auto deck_size = static_cast<uint32_t>(deck.size());
+  const int to_choose = cards.get_remaining_cards_to_choose() - 1;
+  const int chosen_sum = static_cast<int>(cards.get_chosen_cards_sum());
+  const PayoffTable payoffs(call_strike, put_strike);
+  std::array<int, 14> designated{};
+  designated.fill(-1);
+  for (int i = static_cast<int>(deck_size) - 1; i >= 0; i--) {
+    designated[deck[i]] = i;
+  }
+
+  std::vector<uint8_t> positions(deck_size);
+  std::iota(std::begin(positions), std::end(positions), 0);
+  Xoshiro256 rng(seed);
+  std::array<double, 14> call_price_sum{};
+  std::array<double, 14> put_price_sum{};
+  std::array<double, 14> call_cnt{};
+  std::array<double, 14> put_cnt{};
+  for (uint64_t c = 1; c <= iterations; c++) {
+    // The deck has at most 52 cards, so the first k - 1 fit in a bit mask
+    uint64_t in_first = 0;
+    int first_sum = chosen_sum;
+    for (int i = 0; i < to_choose; i++) {
+      std::swap(positions[i], positions[i + rng.bounded(deck_size - i)]);
+      first_sum += deck[positions[i]];
+      in_first |= uint64_t{1} << positions[i];
+    }
+    std::swap(positions[to_choose],
+              positions[to_choose + rng.bounded(deck_size - to_choose)]);
+    const int next_sum = first_sum + deck[positions[to_choose]];
+    for (int card = 1; card <= 13; card++) {
+      if (designated[card] < 0) {
+        continue;
+      }
+      const int underlying_price =
+          (in_first >> designated[card]) & 1 ? next_sum : first_sum + card;
+      call_price_sum[card] += payoffs.call[underlying_price];
+      put_price_sum[card] += payoffs.put[underlying_price];
+      call_cnt[card] += payoffs.call_itm[underlying_price];
+      put_cnt[card] += payoffs.put_itm[underlying_price];
+    }
+  }
+
+  OptionPricingTable table{};
+  const auto n = static_cast<double>(iterations);
+  for (int card = 1; card <= 13; card++) {
+    table[card] = {call_price_sum[card] / n, put_price_sum[card] / n,
+                   call_cnt[card] / n, put_cnt[card] / n};
+  }
+  return table;
+}
+
+// Runs batches of batch_iterations shuffles per thread until both prices
+// reach target_error or iterations shuffles per thread have been used. A
+// target_error of zero runs all iterations in one batch.
+OptionPricingResult option_pricing_threads(const Cards& cards,
+                                           int thread_count,
+                                           uint64_t iterations,
+                                           double target_error = 0,
+                                           uint64_t seed = random_seed()) {
+  constexpr uint64_t batch_iterations = 16384;
+  std::vector<std::future<PricingMoments>> option_threads;
+  PricingMoments moments;
+  OptionPricingResult result{};
+  uint64_t done = 0;
+
+  option_threads.reserve(thread_count);
+  while (done < iterations) {
+    const uint64_t batch = target_error > 0
+                               ? std::min(batch_iterations, iterations - done)
+                               : iterations;
+    option_threads.clear();
+    for (int i = 0; i < thread_count; i++) {
+      option_threads.push_back(std::async(std::launch::async, option_pricing,
+                                          150, 130, cards, batch, seed++));
+    }
+    for (int i = 0; i < thread_count; i++) {
+      option_threads[i].wait();
+      moments.merge(option_threads[i].get());
+    }
+    done += batch;
+
+    result = moments.estimate();
+    if (std::max(result.call_error, result.put_error) <= target_error) {
+      break;
+    }
+  }
+
+  result.put_delta *= -1;
+  return result;
+}
+
+OptionPricingTable option_pricing_next_threads(const Cards& cards,
+                                               int thread_count,
+                                               uint64_t iterations,
+                                               uint64_t seed = random_seed()) {
+  std::vector<std::future<OptionPricingTable>> option_threads;
+  OptionPricingTable table{};
+
+  option_threads.reserve(thread_count);
+  for (int i = 0; i < thread_count; i++) {
+    option_threads.push_back(std::async(std::launch::async,
+                                        option_pricing_next, 150, 130, cards,
+                                        iterations, seed + i));
+  }
+  for (int i = 0; i < thread_count; i++) {
+    option_threads[i].wait();
+    const auto ans = option_threads[i].get();
+    for (int card = 1; card <= 13; card++) {
+      table[card].call_price += ans[card].call_price / thread_count;
+      table[card].put_price += ans[card].put_price / thread_count;
+      table[card].call_delta += ans[card].call_delta / thread_count;
+      table[card].put_delta -= ans[card].put_delta / thread_count;
+    }
+  }
+  return table;
+}
+
+// The original kernel: a full std::shuffle with std::mt19937 and one sample
+// per iteration. Only kept as the baseline for --bench.
+OptionPricingResult option_pricing_shuffle(double call_strike,
+                                           double put_strike,
+                                           const Cards& cards,
+                                           uint64_t iterations) {
   std::vector<double> remaining_cards = cards.get_remaining_cards();
   std::random_device rd;
   std::mt19937 g(rd());
@@ -140,15 +453,159 @@ OptionPricingResult option_pricing(double call_strike, double put_strike,
           put_cnt / static_cast<double>(iterations)};
 }
 
+template <typename Kernel>
+double iterations_per_second(uint64_t iterations, Kernel kernel) {
+  const auto begin = std::chrono::steady_clock::now();
+  kernel();
+  const auto end = std::chrono::steady_clock::now();
+  return static_cast<double>(iterations) /
+         std::chrono::duration<double>(end - begin).count();
+}
+
+// Single threaded iterations per second of the baseline and current kernels
+// on a fixed set of card states. A current kernel iteration is an antithetic
+// pair, so it yields two samples where the baseline yields one.
+int run_bench(uint64_t iterations) {
+  const std::vector<std::pair<std::string, std::vector<double>>> corpus{
+      {"empty deck", {}},
+      {"mid round", {13, 12, 1, 5, 6, 7, 8, 9, 10, 2}},
+      {"19 cards drawn",
+       {13, 13, 13, 13, 12, 12, 12, 12, 11, 11, 11, 11, 10, 10, 10, 10, 1, 1,
+        1}}};
+  std::cout << "state,kernel,iterations_per_second,samples_per_second\n";
+  for (const auto& [name, chosen_cards] : corpus) {
+    Cards cards;
+    cards.set_chosen_cards(chosen_cards);
+    double sink = 0;
+    const double baseline = iterations_per_second(iterations, [&] {
+      sink += option_pricing_shuffle(150, 130, cards, iterations).call_price;
+    });
+    const double current = iterations_per_second(iterations, [&] {
+      sink += option_pricing(150, 130, cards, iterations, 42).n;
+    });
+    const double next_table = iterations_per_second(iterations, [&] {
+      sink += option_pricing_next(150, 130, cards, iterations, 42)[1].call_price;
+    });
+    std::cout << name << ",shuffle," << baseline << "," << baseline << "\n";
+    std::cout << name << ",partial_fisher_yates," << current << ","
+              << 2 * current << "\n";
+    std::cout << name << ",next_table," << next_table << "," << next_table
+              << "\n";
+    std::cerr << "option_pricing.cpp: " << name << " speedup "
+              << current / baseline << "x per iteration, "
+              << 2 * current / baseline << "x per sample (checksum " << sink
+              << ")\n";
+  }
+  return 0;
+}
+
+// Binary framing used by --server, native little-endian layout.
+// Every request is answered by exactly one response carrying the same id, so
+// the client can pipeline as many requests as it likes. A response header is
+// followed by value_count doubles: the four prices and the call and put
+// standard errors of a PRICE request, or four prices per card 0..13 for
+// NEXT_TABLE, NaN for cards not in the deck. target_error only applies to
+// PRICE.
+#pragma pack(push, 1)
+struct ServerRequest {
+  uint32_t id;
+  uint32_t iterations;
+  uint16_t thread_count;
+  uint8_t kind;
+  uint8_t card_count;
+  float target_error;
+};
+
+struct ServerResponse {
+  uint32_t id;
+  uint32_t status;
+  uint32_t value_count;
+};
+#pragma pack(pop)
+
+enum ServerRequestKind : uint8_t { PRICE = 0, NEXT_TABLE = 1 };
+enum ServerResponseStatus : uint32_t { OK = 0, BAD_REQUEST = 1 };
+
+bool read_exact(void* buffer, std::size_t size) {
+  return std::fread(buffer, 1, size, stdin) == size;
+}
+
+void write_response(const ServerResponse& response,
+                    const std::vector<double>& values) {
+  std::fwrite(&response, sizeof(response), 1, stdout);
+  std::fwrite(values.data(), sizeof(double), values.size(), stdout);
+  std::fflush(stdout);
+}
+
+int run_server() {
+  ServerRequest request{};
+  std::array<uint8_t, 255> request_cards{};
+  std::vector<double> values;
+  while (read_exact(&request, sizeof(request))) {
+    if (!read_exact(request_cards.data(), request.card_count)) {
+      break;
+    }
+    Cards cards;
+    bool valid = (request.kind == PRICE || request.kind == NEXT_TABLE) &&
+                 request.thread_count > 0;
+    for (int i = 0; valid && i < request.card_count; i++) {
+      valid = cards.can_choose_card(request_cards[i]);
+      if (valid) {
+        cards.choose_card(request_cards[i]);
+      }
+    }
+    if (request.kind == NEXT_TABLE) {
+      valid = valid && cards.get_remaining_cards_to_choose() > 0;
+    }
+
+    values.clear();
+    if (valid && request.kind == PRICE) {
+      const auto ans =
+          option_pricing_threads(cards, request.thread_count,
+                                 request.iterations, request.target_error);
+      values = {ans.call_price, ans.put_price, ans.call_delta,
+                ans.put_delta,  ans.call_error, ans.put_error};
+    } else if (valid && request.kind == NEXT_TABLE) {
+      const auto table = option_pricing_next_threads(
+          cards, request.thread_count, request.iterations);
+      const auto remaining_cards = cards.get_remaining_cards();
+      for (int card = 0; card <= 13; card++) {
+        const bool in_deck =
+            std::find(std::begin(remaining_cards), std::end(remaining_cards),
+                      card) != std::end(remaining_cards);
+        const auto& ans = table[card];
+        for (const double value : {ans.call_price, ans.put_price,
+                                   ans.call_delta, ans.put_delta}) {
+          values.push_back(in_deck ? value
+                                   : std::numeric_limits<double>::quiet_NaN());
+        }
+      }
+    }
+    write_response({request.id, valid ? OK : BAD_REQUEST,
+                    static_cast<uint32_t>(values.size())},
+                   values);
+  }
+  return 0;
+}
+
 int main(int argc, char* argv[]) {
-  if (argc != 3) {
-    throw std::runtime_error("Usage: option <thread_count> <iteration_count>");
+  if (argc == 2 && std::string(argv[1]) == "--server") {
+    return run_server();
+  }
+  if (argc >= 2 && std::string(argv[1]) == "--bench") {
+    return run_bench(argc == 3 ? std::stoull(argv[2]) : 1000000);
+  }
+  if (argc != 3 && argc != 4) {
+    throw std::runtime_error(
+        "Usage: option <thread_count> <iteration_count> [target_error] | "
+        "option --server | option --bench [iteration_count]");
   }
   std::ios::sync_with_stdio(false);
 
   // read thread count from command line
   const int thread_count = std::stoi(argv[1]);
   const uint64_t total_simulation_iterations = std::stoull(argv[2]);
+  const double target_error = argc == 4 ? std::stod(argv[3]) : 0;
 
   Cards cards;
 
@@ -163,35 +620,9 @@ int main(int argc, char* argv[]) {
   std::chrono::steady_clock::time_point begin =
       std::chrono::steady_clock::now();
 
-  Cards cards_delta = cards;
-  std::vector<std::future<OptionPricingResult>> option_threads;
-  double call_price_sum = 0;
-  double put_price_sum = 0;
-  double delta_call_sum = 0;
-  double delta_put_sum = 0;
-
-  option_threads.reserve(thread_count);
-  for (int i = 0; i < thread_count; i++) {
-    option_threads.push_back(std::async(std::launch::async, option_pricing, 150,
-                                        130, cards,
-                                        total_simulation_iterations));
-  }
-  for (int i = 0; i < thread_count; i++) {
-    option_threads[i].wait();
-    auto ans = option_threads[i].get();
-    call_price_sum += ans.call_price;
-    put_price_sum += ans.put_price;
-    delta_call_sum += ans.call_delta;
-    delta_put_sum += ans.put_delta;
-  }
-
-  double call_price = call_price_sum / thread_count;
-  double put_price = put_price_sum / thread_count;
-  double delta_call = delta_call_sum / thread_count;
-  double delta_put = -1 * delta_put_sum / thread_count;
+  const auto ans = option_pricing_threads(
+      cards, thread_count, total_simulation_iterations, target_error);
 
-  double delta_underlying_price =
-      cards_delta.get_theoretical_price() - cards.get_theoretical_price();
   std::chrono::steady_clock::time_point end = std::chrono::steady_clock::now();
   std::cerr << "option_pricing.cpp: duration = "
             << (std::chrono::duration_cast<std::chrono::microseconds>(end -
@@ -200,9 +631,8 @@ int main(int argc, char* argv[]) {
                    1000000.0
             << " seconds\n";
 
-  std::cerr << "option_pricing.cpp: total_iterations = "
-            << static_cast<uint64_t>(total_simulation_iterations * thread_count)
-            << "\n";
-  std::cout << (call_price) << "\n" << (put_price) << "\n";
-  std::cout << (delta_call) << "\n" << (delta_put) << "\n";
-}
\ No newline at end of file
+  std::cerr << "option_pricing.cpp: standard error = " << ans.call_error
+            << " call, " << ans.put_error << " put\n";
+  std::cout << (ans.call_price) << "\n" << (ans.put_price) << "\n";
+  std::cout << (ans.call_delta) << "\n" << (ans.put_delta) << "\n";
+}
@@ -1,8 +1,32 @@
+import hashlib
+import logging
+import os
 import numpy as np
 import time
 from cards import Cards
 import statistics
+import struct
 import subprocess
+import threading
+from concurrent.futures import Future
+from enum import Enum
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+CPP_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "option_pricing.cpp")
+CPP_BUILD_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "build")
+CPP_COMPILER = "g++"
+CPP_FLAGS = ["-std=c++20", "-O3"]
+
+
+MAX_CARD = 13
+
+
+class PricingEngine(Enum):
+    EXACT = 0
+    CPP = 1
+    NUMPY = 2
 
 
 def call_payoff(underlying, strike):
@@ -14,34 +38,183 @@ def put_payoff(underlying, strike):
 
 
 def option_pricing(
-    call_strike: float, put_strike: float, cards: Cards, iterations: int = 100000
+    call_strike: float,
+    put_strike: float,
+    cards: Cards,
+    iterations: int = 100000,
+    chunk_size: int = 8192,
+    seed: Optional[int] = None,
 ):
-    remaining_cards = np.array(cards.get_remaining_cards())
+    """
+    Monte Carlo pricing in NumPy, the fallback when there is no compiler.
 
-    # Generate a matrix of shuffled cards
-    shuffled_cards = np.apply_along_axis(
-        np.random.permutation, 1, np.tile(remaining_cards, (iterations, 1))
-    )
+    Every path draws one random key per remaining card and keeps the cards whose keys are at or below the k-th
+    smallest key, which needs a partition rather than a full shuffle per path. Paths are simulated in chunks of
+    chunk_size, so peak memory does not grow with iterations.
+    """
+    rng = np.random.default_rng(seed)
+    remaining_cards = np.array(cards.get_remaining_cards(), dtype=np.float32)
+    to_choose = cards.get_remaining_cards_to_choose()
+    chosen_sum = cards.get_chosen_cards_sum()
+
+    keys = np.empty((min(chunk_size, iterations), remaining_cards.size), dtype=np.float32)
+    call_price_sum = 0.0
+    put_price_sum = 0.0
+    call_cnt = 0
+    put_cnt = 0
+    for start in range(0, iterations, keys.shape[0]):
+        paths = min(keys.shape[0], iterations - start)
+        if to_choose == 0:
+            sums = np.full(paths, chosen_sum, dtype=np.float64)
+        else:
+            chunk_keys = keys[:paths]
+            rng.random(dtype=np.float32, out=chunk_keys)
+            # Keys are 24 bit floats, so a tie at the threshold that picks an extra card is vanishingly rare
+            threshold = np.partition(chunk_keys, to_choose - 1, axis=1)[:, to_choose - 1: to_choose]
+            drawn_sums = (chunk_keys <= threshold).astype(np.float32) @ remaining_cards
+            sums = np.add(drawn_sums, chosen_sum, dtype=np.float64)
 
-    # Sum the first 20 elements of each shuffle
-    sums = (
-        shuffled_cards[:, : cards.get_remaining_cards_to_choose()].sum(axis=1)
-        + cards.get_chosen_cards_sum()
+        call_totals = call_payoff(sums, call_strike)
+        put_totals = put_payoff(sums, put_strike)
+        call_price_sum += call_totals.sum()
+        put_price_sum += put_totals.sum()
+        call_cnt += np.count_nonzero(call_totals)
+        put_cnt += np.count_nonzero(put_totals)
+
+    return (
+        float(call_price_sum / iterations),
+        float(put_price_sum / iterations),
+        call_cnt / iterations,
+        -put_cnt / iterations,
     )
 
-    # Calculate call and put values
-    call_totals = call_payoff(sums, call_strike)
-    put_totals = put_payoff(sums, put_strike)
 
-    # Average the totals
-    call_price = call_totals.mean()
-    put_price = put_totals.mean()
-    return call_price, put_price
+def option_pricing_next_table(
+    call_strike: float,
+    put_strike: float,
+    cards: Cards,
+    iterations: int = 100000,
+    chunk_size: int = 8192,
+    seed: Optional[int] = None,
+):
+    """
+    Price every possible next card from one set of draws, indexed by card.
+
+    Each branch removes one designated copy of its card from the deck and draws the remaining k - 1 cards as the
+    smallest keys among the others. With the same keys shared by every branch, that is the k - 1 smallest keys
+    overall, or the k smallest when the designated copy is among them. The branches are unbiased and their
+    differences carry no independent sampling noise. Cards no longer in the deck are None.
+    """
+    rng = np.random.default_rng(seed)
+    remaining_cards = np.array(cards.get_remaining_cards(), dtype=np.float32)
+    to_choose = cards.get_remaining_cards_to_choose() - 1
+    table: List[Optional[Tuple[float, float, float, float]]] = [None] * (MAX_CARD + 1)
+    if to_choose < 0:
+        return table
+
+    next_cards, designated = np.unique(remaining_cards, return_index=True)
+    chosen_sum = cards.get_chosen_cards_sum()
+    keys = np.empty((min(chunk_size, iterations), remaining_cards.size), dtype=np.float32)
+    call_price_sum = np.zeros(next_cards.size)
+    put_price_sum = np.zeros(next_cards.size)
+    call_cnt = np.zeros(next_cards.size, dtype=np.int64)
+    put_cnt = np.zeros(next_cards.size, dtype=np.int64)
+    for start in range(0, iterations, keys.shape[0]):
+        paths = min(keys.shape[0], iterations - start)
+        if to_choose == 0:
+            sums = np.tile(np.add(next_cards, chosen_sum, dtype=np.float64), (paths, 1))
+        else:
+            chunk_keys = keys[:paths]
+            rng.random(dtype=np.float32, out=chunk_keys)
+            thresholds = np.partition(chunk_keys, [to_choose - 1, to_choose], axis=1)
+            first = chunk_keys <= thresholds[:, to_choose - 1: to_choose]
+            first_sums = np.add(first.astype(np.float32) @ remaining_cards, chosen_sum, dtype=np.float64)
+            next_sums = np.add(
+                (chunk_keys <= thresholds[:, to_choose: to_choose + 1]).astype(np.float32) @ remaining_cards,
+                chosen_sum,
+                dtype=np.float64,
+            )
+            sums = np.where(first[:, designated], next_sums[:, None], first_sums[:, None] + next_cards)
+
+        call_totals = call_payoff(sums, call_strike)
+        put_totals = put_payoff(sums, put_strike)
+        call_price_sum += call_totals.sum(axis=0)
+        put_price_sum += put_totals.sum(axis=0)
+        call_cnt += np.count_nonzero(call_totals, axis=0)
+        put_cnt += np.count_nonzero(put_totals, axis=0)
+
+    for i, card in enumerate(next_cards):
+        table[int(card)] = (
+            float(call_price_sum[i] / iterations),
+            float(put_price_sum[i] / iterations),
+            float(call_cnt[i] / iterations),
+            float(-put_cnt[i] / iterations),
+        )
+    return table
+
 
+def final_sum_distribution(cards: Cards):
+    """
+    Exact distribution of the sum of all chosen cards once the deck is dealt.
 
-def option_pricing_cpp(cards: Cards, threads: int = 8, iterations: int = 300000):
+    Counts the ways of drawing the remaining cards by expanding the generating function prod(1 + y * x^card) over the
+    remaining deck, so the result does not depend on any sampling. Returns the possible final sums and their
+    probabilities.
+    """
+    to_choose = cards.get_remaining_cards_to_choose()
+    width = MAX_CARD * to_choose + 1
+
+    # ways[j * width + s] is the number of ways to draw j cards summing to s. A card only ever moves a valid entry to
+    # a later row, so shifting the flattened array never wraps a reachable sum into the wrong row.
+    ways = np.zeros((to_choose + 1) * width)
+    ways[0] = 1.0
+    for card, count in enumerate(cards.get_remaining_counts()):
+        offset = width + card
+        for _ in range(count if offset < ways.size else 0):
+            ways[offset:] += ways[: ways.size - offset]
+
+    ways = ways[to_choose * width:]
+    probabilities = ways / ways.sum()
+    sums = np.arange(width) + cards.get_chosen_cards_sum()
+    return sums, probabilities
+
+
+def option_pricing_exact(cards: Cards, call_strike: float = 150, put_strike: float = 130):
+    """
+    Price the call and put from the exact final sum distribution.
+
+    Follows the option_pricing_cpp contract: the deltas are the probabilities of finishing in the money, with the
+    put delta negated.
+    """
+    sums, probabilities = final_sum_distribution(cards)
+    call_payoffs = call_payoff(sums, call_strike)
+    put_payoffs = put_payoff(sums, put_strike)
+    call_price = float(call_payoffs @ probabilities)
+    put_price = float(put_payoffs @ probabilities)
+    call_delta = float(probabilities[call_payoffs > 0].sum())
+    put_delta = -float(probabilities[put_payoffs > 0].sum())
+    return call_price, put_price, call_delta, put_delta
+
+
+def option_pricing_exact_next_table(cards: Cards, call_strike: float = 150, put_strike: float = 130):
+    """
+    Exact prices for every possible next card, indexed by card. Cards no longer in the deck are None.
+    """
+    table: List[Optional[Tuple[float, float, float, float]]] = [None] * (MAX_CARD + 1)
+    if cards.get_remaining_cards_to_choose() == 0:
+        return table
+    for next_card, count in enumerate(cards.get_remaining_counts()):
+        if count == 0:
+            continue
+        next_cards = cards.copy()
+        next_cards.choose_card(next_card)
+        table[next_card] = option_pricing_exact(next_cards, call_strike, put_strike)
+    return table
+
+
+def option_pricing_cpp(cards: Cards, threads: int = 8, iterations: int = 300000, binary: str = "./a.out"):
     with subprocess.Popen(
-        ["./a.out", str(threads), str(iterations)],
+        [binary, str(threads), str(iterations)],
         stdin=subprocess.PIPE,
         stdout=subprocess.PIPE,
         text=True,
@@ -57,9 +230,11 @@ def option_pricing_cpp(cards: Cards, threads: int = 8, iterations: int = 300000)
         return call_price, put_price, call_delta, put_delta
 
 
-def option_pricing_next_cpp(cards: Cards, next_card: int, threads: int = 4, iterations: int = 300000):
+def option_pricing_next_cpp(
+    cards: Cards, next_card: int, threads: int = 4, iterations: int = 300000, binary: str = "./a.out"
+):
     with subprocess.Popen(
-        ["./a.out", str(threads), str(iterations)],
+        [binary, str(threads), str(iterations)],
         stdin=subprocess.PIPE,
         stdout=subprocess.PIPE,
         text=True,
@@ -75,34 +250,263 @@ def option_pricing_next_cpp(cards: Cards, next_card: int, threads: int = 4, iter
         return call_price, put_price, call_delta, put_delta
 
 
-def compile_option_pricing_cpp():
-    with subprocess.Popen(
-        ["g++", "-std=c++20", "-O3", "option_pricing.cpp"],
-        stdin=subprocess.PIPE,
-        stdout=subprocess.PIPE,
-        text=True,
-    ) as process:
-        pass
+class OptionPricingServer:
+    """
+    A long lived option pricing binary running in --server mode.
+
+    Requests are framed as a fixed header followed by one byte per chosen card, and each response carries the id of its
+    request, so any number of requests can be outstanding at once. Responses are read on a background thread and
+    delivered through futures.
+    """
+
+    REQUEST = struct.Struct("<IIHBBf")
+    RESPONSE = struct.Struct("<III")
+    KIND_PRICE = 0
+    KIND_NEXT_TABLE = 1
+    STATUS_OK = 0
+
+    def __init__(self, binary: str = "./a.out") -> None:
+        self.process = subprocess.Popen(
+            [binary, "--server"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        self.lock = threading.Lock()
+        self.pending: Dict[int, Tuple[Future, int]] = {}
+        self.next_id = 0
+        self.reader_thread = threading.Thread(target=self.read_responses, daemon=True)
+        self.reader_thread.start()
+
+    def submit(
+        self,
+        chosen_cards: List[float],
+        threads: int,
+        iterations: int,
+        kind: int = KIND_PRICE,
+        target_error: float = 0.0,
+    ) -> Future:
+        future = Future()
+        cards = bytes(int(card) for card in chosen_cards)
+        with self.lock:
+            request_id = self.next_id
+            self.next_id = (self.next_id + 1) & 0xFFFFFFFF
+            self.pending[request_id] = (future, kind)
+            try:
+                self.process.stdin.write(
+                    self.REQUEST.pack(request_id, iterations, threads, kind, len(cards), target_error) + cards
+                )
+                self.process.stdin.flush()
+            except (BrokenPipeError, ValueError) as error:
+                del self.pending[request_id]
+                future.set_exception(RuntimeError(f"Option pricing server is not running: {error}"))
+        return future
+
+    def read_responses(self):
+        while True:
+            data = self.process.stdout.read(self.RESPONSE.size)
+            if len(data) < self.RESPONSE.size:
+                break
+            request_id, status, value_count = self.RESPONSE.unpack(data)
+            data = self.process.stdout.read(8 * value_count)
+            if len(data) < 8 * value_count:
+                break
+            values = struct.unpack(f"<{value_count}d", data)
+            with self.lock:
+                future, kind = self.pending.pop(request_id, (None, None))
+            if future is None:
+                continue
+            if status != self.STATUS_OK:
+                future.set_exception(ValueError(f"Option pricing server rejected request {request_id}"))
+            elif kind == self.KIND_NEXT_TABLE:
+                future.set_result(
+                    [None if np.isnan(values[i]) else values[i: i + 4] for i in range(0, value_count, 4)]
+                )
+            else:
+                future.set_result(values)
+
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        for future, kind in pending.values():
+            future.set_exception(RuntimeError("Option pricing server exited"))
+
+    def option_pricing(self, cards: Cards, threads: int = 8, iterations: int = 300000):
+        return self.submit(cards._chosen_cards, threads, iterations).result()[:4]
+
+    def option_pricing_with_error(
+        self, cards: Cards, threads: int = 8, iterations: int = 300000, target_error: float = 0.0
+    ):
+        """
+        Price until the standard error of both options is at most target_error, using at most iterations shuffles
+        per thread. Returns the four prices followed by the call and put standard errors.
+        """
+        return self.submit(cards._chosen_cards, threads, iterations, target_error=target_error).result()
+
+    def option_pricing_next(self, cards: Cards, next_card: int, threads: int = 4, iterations: int = 300000):
+        return self.submit(cards._chosen_cards + [next_card], threads, iterations).result()[:4]
+
+    def option_pricing_next_table(self, cards: Cards, threads: int = 4, iterations: int = 300000):
+        """
+        Price every next card from shared draws, see option_pricing_next_table.
+        """
+        return self.submit(cards._chosen_cards, threads, iterations, self.KIND_NEXT_TABLE).result()
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+        self.reader_thread.join()
+
+
+class OptionPricingBuild:
+    """
+    A cached build of option_pricing.cpp.
+
+    The binary is named after a hash of the source, the compiler and its flags, so an unchanged pricer is reused
+    across restarts and a stale binary is never picked up. Builds go to a temporary file that is renamed into place
+    once the compiler succeeds, so a half written binary is never visible.
+    """
+
+    def __init__(
+        self,
+        source: str = CPP_SOURCE,
+        build_dir: str = CPP_BUILD_DIR,
+        compiler: str = CPP_COMPILER,
+        flags: Optional[List[str]] = None,
+    ) -> None:
+        self.source = source
+        self.build_dir = build_dir
+        self.compiler = compiler
+        self.flags = CPP_FLAGS if flags is None else flags
+        with open(self.source, "rb") as file:
+            digest = hashlib.sha256(file.read())
+        digest.update(" ".join([self.compiler] + self.flags).encode())
+        self.key = digest.hexdigest()[:16]
+        self.path = os.path.join(self.build_dir, f"option_pricing-{self.key}")
+        self.error: Optional[Exception] = None
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        if os.path.exists(self.path):
+            self.done.set()
+
+    def is_ready(self) -> bool:
+        return self.done.is_set() and self.error is None
+
+    def start(self):
+        """
+        Build in the background, returns immediately.
+        """
+        if not self.done.is_set():
+            threading.Thread(target=self.build, daemon=True).start()
+
+    def build(self) -> str:
+        """
+        Build unless a cached binary exists, blocks until the binary is ready.
+        """
+        with self.lock:
+            if self.done.is_set():
+                return self.wait()
+            try:
+                os.makedirs(self.build_dir, exist_ok=True)
+                temp_path = f"{self.path}.{os.getpid()}.tmp"
+                logger.info(f"Compiling {self.source} to {self.path}")
+                start_time = time.time()
+                result = subprocess.run(
+                    [self.compiler] + self.flags + [self.source, "-o", temp_path],
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    text=True,
+                )
+                if result.returncode != 0:
+                    raise RuntimeError(f"Compiling {self.source} failed:\n{result.stderr}")
+                os.replace(temp_path, self.path)
+                logger.info(f"Compiled {self.path} in {time.time() - start_time:.2f} seconds")
+            except Exception as error:
+                self.error = error
+            finally:
+                self.done.set()
+        return self.wait()
+
+    def wait(self, timeout: Optional[float] = None) -> str:
+        """
+        Wait for a build started elsewhere and return the path of the binary.
+        """
+        if not self.done.wait(timeout):
+            raise TimeoutError(f"Compiling {self.source} did not finish in {timeout} seconds")
+        if self.error is not None:
+            raise self.error
+        return self.path
+
+
+def compile_option_pricing_cpp() -> str:
+    return OptionPricingBuild().build()
+
+
+def test_option_pricing_numpy():
+    cards = Cards()
+    cards.set_chosen_cards([13.0, 12.0, 1.0, 5.0, 6.0, 7.0, 8.0, 9.0, 10.0, 2.0])
+    call_price, put_price, call_delta, put_delta = option_pricing(150, 130, cards, 200000, chunk_size=5000, seed=0)
+    call_exact, put_exact, call_delta_exact, put_delta_exact = option_pricing_exact(cards)
+    assert abs(call_price - call_exact) < 0.05
+    assert abs(put_price - put_exact) < 0.05
+    assert abs(call_delta - call_delta_exact) < 0.01
+    assert abs(put_delta - put_delta_exact) < 0.01
+
+
+def test_option_pricing_next_table():
+    cards = Cards()
+    cards.set_chosen_cards([13.0] * 4 + [12.0] * 4 + [11.0] * 4 + [10.0] * 3)
+    table = option_pricing_next_table(150, 130, cards, 100000, seed=0)
+    exact_table = option_pricing_exact_next_table(cards)
+    assert table[12] is None and exact_table[12] is None
+    for card in [1, 10]:
+        for price, exact_price in zip(table[card], exact_table[card]):
+            assert abs(price - exact_price) < 0.1
+
+
+def test_option_pricing_exact_empty_deck():
+    cards = Cards()
+    sums, probabilities = final_sum_distribution(cards)
+    assert abs(probabilities.sum() - 1.0) < 1e-12
+    assert abs(sums @ probabilities - cards.get_theoretical_price()) < 1e-9
+
+    # 150 and 130 are symmetric around the theo of 140
+    call_price, put_price, call_delta, put_delta = option_pricing_exact(cards)
+    assert abs(call_price - put_price) < 1e-9
+    assert abs(call_delta + put_delta) < 1e-12
+
+
+def test_option_pricing_exact_last_card():
+    cards = Cards()
+    chosen_cards = [13.0] * 4 + [12.0] * 4 + [11.0] * 4 + [10.0] * 4 + [1.0] * 3
+    cards.set_chosen_cards(chosen_cards)
+    remaining_cards = cards.get_remaining_cards()
+    finals = [sum(chosen_cards) + card for card in remaining_cards]
+    call_price, put_price, call_delta, put_delta = option_pricing_exact(cards, 150, 130)
+    assert abs(call_price - sum(max(final - 150, 0) for final in finals) / len(finals)) < 1e-9
+    assert abs(call_delta - sum(final > 150 for final in finals) / len(finals)) < 1e-12
+    assert put_price == 0.0
 
 
 if __name__ == "__main__":
-    compile_option_pricing_cpp()
+    binary = compile_option_pricing_cpp()
     start_time = time.time()
     cards = Cards(20)
 
     cards.set_chosen_cards([])
 
-    call_price, put_price, call_delta, put_delta = option_pricing_cpp(cards)
+    call_price, put_price, call_delta, put_delta = option_pricing_cpp(cards, binary=binary)
     end_time = time.time()
-    call_price_py, put_price_py = option_pricing(150, 130, cards)
+    call_price_py, put_price_py, call_delta_py, put_delta_py = option_pricing(150, 130, cards)
+    call_price_exact, put_price_exact, call_delta_exact, put_delta_exact = option_pricing_exact(cards)
     print("Time taken:", end_time - start_time, "seconds")
 
     print("Theo: ", cards.get_theoretical_price())
 
     print("cpp 150 Call: ", call_price)
     print("py  150 Call: ", call_price_py)
+    print("exact 150 Call: ", call_price_exact)
     print("cpp 130 Put:", put_price)
     print("py  130 Put:", put_price_py)
+    print("exact 130 Put:", put_price_exact)
 
     print(
         "Call Delta:",
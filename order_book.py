@@ -15,9 +15,17 @@
 #         }
 #     ]
 # }
-from typing import List
+import logging
+import time
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
 from pydantic import BaseModel, RootModel
 
+from model import Side
+
+logger = logging.getLogger(__name__)
+
 
 class BuyOrder(BaseModel):
     price: float
@@ -41,3 +49,226 @@ class OrderBook(BaseModel):
     midPrice: float
     buy: BuyOrderList
     sell: SellOrderList
+
+
+class Level(NamedTuple):
+    price: float
+    volume: int
+
+
+class Book(NamedTuple):
+    """
+    A polled order book decoded without validation, bids and asks each from best to worst.
+    """
+
+    product: str
+    tickSize: float
+    midPrice: float
+    bids: List[Level]
+    asks: List[Level]
+
+
+class TickOrderBook:
+    """
+    Order book of one product kept in place, with the volume of every price level in arrays indexed by tick.
+
+    Snapshots and level updates write into the arrays and move the best bid and ask indices, so reading the top of
+    the book, the mid or the depth near the touch neither sorts nor allocates. A tick of -1 marks an empty side.
+    """
+
+    def __init__(self, product: str, tick_size: float, max_price: float = 400.0) -> None:
+        self.product = product
+        self.tick_size = tick_size
+        size = int(round(max_price / tick_size)) + 1
+        self.bid_volumes = np.zeros(size, dtype=np.int64)
+        self.ask_volumes = np.zeros(size, dtype=np.int64)
+        self.bid_user_volumes = np.zeros(size, dtype=np.int64)
+        self.ask_user_volumes = np.zeros(size, dtype=np.int64)
+        self.best_bid_tick = -1
+        self.best_ask_tick = -1
+        self.exchange_mid_price: Optional[float] = None
+        self.version = 0
+        self.update_time = 0.0
+        # Lowest and highest tick touched since the last snapshot, so a snapshot only clears that range
+        self._low_tick = size
+        self._high_tick = -1
+
+    def to_tick(self, price: float) -> int:
+        return int(round(price / self.tick_size))
+
+    def _ensure_size(self, tick: int):
+        size = self.bid_volumes.size
+        if tick < size:
+            return
+        new_size = max(tick + 1, size * 2)
+        for name in ("bid_volumes", "ask_volumes", "bid_user_volumes", "ask_user_volumes"):
+            array = np.zeros(new_size, dtype=np.int64)
+            array[:size] = getattr(self, name)
+            setattr(self, name, array)
+
+    def set_level(self, side: Side, price: float, volume: int, user_volume: int = 0):
+        """
+        Set the total volume resting at one price, zero removes the level.
+        """
+        tick = self.to_tick(price)
+        if tick < 0:
+            logger.warning(f"Ignoring {side.value} level at negative price {price} on {self.product}")
+            return
+        self._ensure_size(tick)
+        self._low_tick = min(self._low_tick, tick)
+        self._high_tick = max(self._high_tick, tick)
+        if side == Side.BUY:
+            self.bid_volumes[tick] = volume
+            self.bid_user_volumes[tick] = user_volume
+            if volume > 0:
+                if tick > self.best_bid_tick:
+                    self.best_bid_tick = tick
+            elif tick == self.best_bid_tick:
+                self.best_bid_tick = self._next_bid(tick)
+        else:
+            self.ask_volumes[tick] = volume
+            self.ask_user_volumes[tick] = user_volume
+            if volume > 0:
+                if self.best_ask_tick == -1 or tick < self.best_ask_tick:
+                    self.best_ask_tick = tick
+            elif tick == self.best_ask_tick:
+                self.best_ask_tick = self._next_ask(tick)
+        self.version += 1
+        self.update_time = time.time()
+
+    def _next_bid(self, tick: int) -> int:
+        levels = np.flatnonzero(self.bid_volumes[self._low_tick:tick])
+        return int(levels[-1]) + self._low_tick if levels.size else -1
+
+    def _next_ask(self, tick: int) -> int:
+        levels = np.flatnonzero(self.ask_volumes[tick + 1:self._high_tick + 1])
+        return int(levels[0]) + tick + 1 if levels.size else -1
+
+    def clear(self):
+        if self._high_tick >= self._low_tick:
+            for array in (self.bid_volumes, self.ask_volumes, self.bid_user_volumes, self.ask_user_volumes):
+                array[self._low_tick:self._high_tick + 1] = 0
+        self._low_tick = self.bid_volumes.size
+        self._high_tick = -1
+        self.best_bid_tick = -1
+        self.best_ask_tick = -1
+
+    def _load_side(self, side: Side, prices: List[float], volumes: List[int], user_volumes: List[int]):
+        """
+        Write every level of one side at once after clear, instead of one set_level per level.
+        """
+        if not prices:
+            return
+        ticks = np.rint(np.array(prices) / self.tick_size).astype(np.int64)
+        valid = ticks >= 0
+        if not valid.all():
+            logger.warning(f"Ignoring {side.value} levels at negative prices on {self.product}")
+            ticks = ticks[valid]
+            volumes = np.array(volumes)[valid]
+            user_volumes = np.array(user_volumes)[valid]
+            if ticks.size == 0:
+                return
+        self._ensure_size(int(ticks.max()))
+        self._low_tick = min(self._low_tick, int(ticks.min()))
+        self._high_tick = max(self._high_tick, int(ticks.max()))
+        if side == Side.BUY:
+            self.bid_volumes[ticks] = volumes
+            self.bid_user_volumes[ticks] = user_volumes
+            levels = np.flatnonzero(self.bid_volumes[self._low_tick:self._high_tick + 1])
+            self.best_bid_tick = int(levels[-1]) + self._low_tick if levels.size else -1
+        else:
+            self.ask_volumes[ticks] = volumes
+            self.ask_user_volumes[ticks] = user_volumes
+            levels = np.flatnonzero(self.ask_volumes[self._low_tick:self._high_tick + 1])
+            self.best_ask_tick = int(levels[0]) + self._low_tick if levels.size else -1
+
+    def apply_stream_snapshot(self, payload: Dict):
+        """
+        Replace the book with an order book stream message, where levels are keyed by price.
+        """
+        self.clear()
+        for side, levels in ((Side.BUY, payload["buyOrders"]), (Side.SELL, payload["sellOrders"])):
+            self._load_side(
+                side,
+                [float(price) for price in levels],
+                [level["marketVolume"] for level in levels.values()],
+                [level.get("userVolume", 0) for level in levels.values()],
+            )
+        self.exchange_mid_price = payload.get("midPrice")
+        self.version += 1
+        self.update_time = time.time()
+
+    def apply_order_book(self, order_book: Book):
+        """
+        Replace the book with a polled order book.
+        """
+        self.clear()
+        for side, levels in ((Side.BUY, order_book.bids), (Side.SELL, order_book.asks)):
+            self._load_side(side, [level.price for level in levels], [level.volume for level in levels], [0] * len(levels))
+        self.exchange_mid_price = order_book.midPrice
+        self.version += 1
+        self.update_time = time.time()
+
+    def best_bid(self) -> Optional[float]:
+        return None if self.best_bid_tick == -1 else self.best_bid_tick * self.tick_size
+
+    def best_ask(self) -> Optional[float]:
+        return None if self.best_ask_tick == -1 else self.best_ask_tick * self.tick_size
+
+    def best_bid_volume(self) -> int:
+        return 0 if self.best_bid_tick == -1 else int(self.bid_volumes[self.best_bid_tick])
+
+    def best_ask_volume(self) -> int:
+        return 0 if self.best_ask_tick == -1 else int(self.ask_volumes[self.best_ask_tick])
+
+    def mid(self) -> Optional[float]:
+        if self.best_bid_tick == -1 or self.best_ask_tick == -1:
+            return None
+        return (self.best_bid_tick + self.best_ask_tick) * self.tick_size / 2
+
+    def depth(self, side: Side, ticks: int) -> int:
+        """
+        Total volume within ticks of the best price on one side, the best level included.
+        """
+        if side == Side.BUY:
+            if self.best_bid_tick == -1:
+                return 0
+            return int(self.bid_volumes[max(0, self.best_bid_tick - ticks):self.best_bid_tick + 1].sum())
+        if self.best_ask_tick == -1:
+            return 0
+        return int(self.ask_volumes[self.best_ask_tick:self.best_ask_tick + ticks + 1].sum())
+
+    def levels(self, side: Side) -> List[Tuple[float, int]]:
+        """
+        Every non-empty level of one side from best to worst, for display.
+        """
+        volumes = self.bid_volumes if side == Side.BUY else self.ask_volumes
+        ticks = np.flatnonzero(volumes)
+        if side == Side.BUY:
+            ticks = ticks[::-1]
+        return [(int(tick) * self.tick_size, int(volumes[tick])) for tick in ticks]
+
+
+def test_tick_order_book():
+    book = TickOrderBook("FUTURE", 0.5, max_price=10.0)
+    book.apply_stream_snapshot(
+        {
+            "productsymbol": "FUTURE",
+            "buyOrders": {"4.5": {"marketVolume": 3, "userVolume": 1}, "4.0": {"marketVolume": 2, "userVolume": 0}},
+            "sellOrders": {"5.5": {"marketVolume": 7, "userVolume": 0}},
+            "midPrice": 5.0,
+        }
+    )
+    assert (book.best_bid(), book.best_bid_volume(), book.best_ask(), book.mid()) == (4.5, 3, 5.5, 5.0)
+    assert book.depth(Side.BUY, 1) == 5
+
+    book.set_level(Side.BUY, 4.5, 0)
+    assert book.best_bid() == 4.0
+    book.set_level(Side.SELL, 5.0, 1)
+    assert book.best_ask() == 5.0 and book.depth(Side.SELL, 1) == 8
+    book.set_level(Side.SELL, 30.0, 2)
+    assert book.levels(Side.SELL) == [(5.0, 1), (5.5, 7), (30.0, 2)]
+
+    book.apply_order_book(Book("FUTURE", 0.5, 1.0, [Level(1.0, 4)], []))
+    assert (book.best_bid(), book.best_ask(), book.mid()) == (1.0, None, None)
+    assert book.levels(Side.SELL) == []
@@ -0,0 +1,205 @@
+import logging
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+from codec import Order
+from model import Side
+from risk import RiskGate
+from util import to_ticks
+
+logger = logging.getLogger(__name__)
+
+# An insert that has not been acknowledged by then is assumed lost and sent again
+ACK_TIMEOUT = 2.0
+
+
+class Quote:
+    __slots__ = ("price", "volume", "order_id", "send_time")
+
+    def __init__(self, price: float, volume: int, send_time: float) -> None:
+        self.price = price
+        self.volume = volume
+        self.order_id: Optional[str] = None
+        self.send_time = send_time
+
+
+class OrderManager:
+    """
+    Tracks the quote resting on each product and side, and only talks to the exchange when the quote changes.
+
+    quote diffs the wanted price and volume against the resting order: an unchanged quote sends nothing, a changed one
+    cancels the resting order by id, or the whole side while its insert is unacknowledged, and inserts the new one.
+    Order ids come from the insert acknowledgements the exchange passes to on_order, matched to the quote in ticks, since
+    the exchange may echo a rounded price. With min_requote_interval set, a
+    quote changed sooner than that after the last insert is left as it is until a later call.
+    """
+
+    def __init__(self, exchange, min_requote_interval: float = 0.0) -> None:
+        self.exchange = exchange
+        self.min_requote_interval = min_requote_interval
+        self.quotes: Dict[Tuple[str, Side], Quote] = {}
+        self.insert_count = 0
+        self.cancel_count = 0
+        self.skipped_count = 0
+        self.throttled_count = 0
+        self.risk: Optional[RiskGate] = None
+        self._lock = threading.Lock()
+
+    def quote(self, product: str, side: Side, price: float, volume: int):
+        if self.risk is not None:
+            # The new quote replaces the resting one, so only the position counts against the limit
+            volume = self.risk.check(product, side, volume, resting=0)
+            if volume <= 0:
+                if not self.risk.halted():
+                    self.pull(product, side)
+                return
+        now = time.time()
+        with self._lock:
+            resting = self.quotes.get((product, side))
+            if resting is not None:
+                acknowledged = resting.order_id is not None or now - resting.send_time < ACK_TIMEOUT
+                if acknowledged and self._same_price(product, resting.price, price) and resting.volume == volume:
+                    self.skipped_count += 1
+                    return
+                if now - resting.send_time < self.min_requote_interval:
+                    self.throttled_count += 1
+                    return
+
+        if resting is not None:
+            self.cancel_count += 1
+            if resting.order_id is not None:
+                self.exchange.delete_order(resting.order_id)
+            else:
+                self.exchange.delete_orders(product, side)
+        with self._lock:
+            self.quotes[(product, side)] = Quote(price, volume, now)
+        self.insert_count += 1
+        self.exchange.insert_order(product, price=price, volume=volume, side=side, risk_checked=True)
+
+    def pull(self, product: str, side: Side):
+        """
+        Pull the quote on one side of a product, if one is resting.
+        """
+        with self._lock:
+            resting = self.quotes.pop((product, side), None)
+        if resting is None:
+            return
+        self.cancel_count += 1
+        if resting.order_id is not None:
+            self.exchange.delete_order(resting.order_id)
+        else:
+            self.exchange.delete_orders(product, side)
+
+    def cancel(self, product: str):
+        """
+        Pull both quotes of a product, without a request when neither is resting.
+        """
+        with self._lock:
+            resting = (product, Side.BUY) in self.quotes or (product, Side.SELL) in self.quotes
+        if not resting:
+            self.skipped_count += 1
+            return
+        self.cancel_count += 1
+        self.exchange.delete_orders(product)
+
+    def forget(self, product: str, side: Optional[Side] = None):
+        """
+        Stop tracking the quotes of a product, called whenever its orders are cancelled by criteria.
+        """
+        with self._lock:
+            for quote_side in (Side.BUY, Side.SELL) if side is None else (side,):
+                self.quotes.pop((product, quote_side), None)
+
+    def resting_volume(self, product: str, side: Side) -> int:
+        with self._lock:
+            resting = self.quotes.get((product, side))
+            return 0 if resting is None else resting.volume
+
+    def resting_price(self, product: str, side: Side) -> Optional[float]:
+        with self._lock:
+            resting = self.quotes.get((product, side))
+            return None if resting is None else resting.price
+
+    def _same_price(self, product: str, price: float, other: float) -> bool:
+        response = self.exchange.products.get(product)
+        if response is None:
+            return to_ticks(price) == to_ticks(other)
+        return to_ticks(price, response.tickSize) == to_ticks(other, response.tickSize)
+
+    def on_order(self, order: Order, ioc: bool):
+        if ioc:
+            return
+        with self._lock:
+            resting = self.quotes.get((order.product, order.side))
+            if resting is None or resting.order_id is not None:
+                return
+            if not self._same_price(order.product, resting.price, order.price) or resting.volume != order.volume:
+                return
+            if order.filled >= order.volume:
+                # Nothing rests, so the next quote goes out again
+                del self.quotes[(order.product, order.side)]
+            else:
+                resting.order_id = order.id
+
+
+class RecordingExchange:
+    """
+    Stand-in for Exchange that records requests and acknowledges inserts with increasing ids.
+    """
+
+    def __init__(self) -> None:
+        from model import ProductResponse
+
+        self.requests = []
+        self.products = {"FUTURE": ProductResponse(symbol="FUTURE", tickSize=0.2, startingPrice=100, contractSize=1)}
+        self.orders = OrderManager(self)
+
+    def insert_order(self, instrument_id: str, *, price: float, volume: int, side: Side, risk_checked=False):
+        self.requests.append(("insert", instrument_id, side, price))
+        order = Order(str(len(self.requests)), "ACTIVE", instrument_id, side, price, volume, 0)
+        self.orders.on_order(order, False)
+        return order
+
+    def delete_order(self, order_id: str):
+        self.requests.append(("cancel", order_id))
+
+    def delete_orders(self, instrument_id: str, side: Optional[Side] = None):
+        self.orders.forget(instrument_id, side)
+        self.requests.append(("cancel", instrument_id, side))
+
+
+def test_order_manager_sends_only_changes():
+    exchange = RecordingExchange()
+    orders = exchange.orders
+    for _ in range(100):
+        orders.quote("FUTURE", Side.BUY, 100.0, 200)
+    orders.quote("FUTURE", Side.BUY, 101.0, 200)
+    orders.cancel("FUTURE")
+    orders.cancel("FUTURE")
+    assert exchange.requests == [
+        ("insert", "FUTURE", Side.BUY, 100.0),
+        ("cancel", "1"),
+        ("insert", "FUTURE", Side.BUY, 101.0),
+        ("cancel", "FUTURE", None),
+    ]
+    assert (orders.insert_count, orders.skipped_count) == (2, 100)
+
+    orders.min_requote_interval = 60.0
+    orders.quote("FUTURE", Side.SELL, 102.0, 200)
+    orders.quote("FUTURE", Side.SELL, 103.0, 200)
+    assert exchange.requests[-1] == ("insert", "FUTURE", Side.SELL, 102.0) and orders.throttled_count == 1
+
+
+def test_order_manager_matches_rounded_acknowledgements():
+    exchange = RecordingExchange()
+    orders = exchange.orders
+    # 6 * 0.2, as round_down_to_tick gives it, echoed by the exchange as 1.2
+    orders.quote("FUTURE", Side.BUY, 6 * 0.2, 10)
+    orders.quote("150 CALL", Side.BUY, 3 * 0.1, 10)
+    orders.quotes[("FUTURE", Side.BUY)].order_id = None
+    orders.quotes[("150 CALL", Side.BUY)].order_id = None
+    orders.on_order(Order("7", "ACTIVE", "FUTURE", Side.BUY, 1.2, 10, 0), False)
+    orders.on_order(Order("8", "ACTIVE", "150 CALL", Side.BUY, 0.3, 10, 0), False)
+    assert orders.quotes[("FUTURE", Side.BUY)].order_id == "7"
+    assert orders.quotes[("150 CALL", Side.BUY)].order_id == "8"
@@ -0,0 +1,244 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import OrderedDict
+from enum import Enum
+from typing import Callable, Hashable, List, Optional, Tuple
+
+from cards import Cards
+
+logger = logging.getLogger(__name__)
+
+
+class JobKind(Enum):
+    CURRENT = 0
+    NEXT_TABLE = 1
+
+
+class PricingJob:
+    """
+    One pricing request for a snapshot of the cards, tagged with the card state generation it was submitted in.
+    """
+
+    __slots__ = ("kind", "cards", "generation", "submit_time")
+
+    def __init__(self, kind: JobKind, cards: Cards, generation: int) -> None:
+        self.kind = kind
+        self.cards = cards
+        self.generation = generation
+        self.submit_time = time.time()
+
+
+class PricingScheduler:
+    """
+    Priority queue of pricing jobs where the current state always runs before next card tables.
+
+    Advancing the generation drops every queued job, jobs that went stale while waiting are skipped and results of
+    jobs that went stale while running are refused by publish, so only the current state ever reaches the quotes.
+    """
+
+    def __init__(self) -> None:
+        self.generation = 0
+        self.dropped_count = 0
+        self.refused_count = 0
+        self._heap: List[Tuple[int, int, PricingJob]] = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+
+    def advance(self) -> int:
+        with self._condition:
+            self.generation += 1
+            self.dropped_count += len(self._heap)
+            self._heap.clear()
+            return self.generation
+
+    def submit(self, kind: JobKind, cards: Cards) -> PricingJob:
+        with self._condition:
+            job = PricingJob(kind, cards.copy(), self.generation)
+            heapq.heappush(self._heap, (kind.value, next(self._sequence), job))
+            self._condition.notify()
+            return job
+
+    def get(self, timeout: Optional[float] = None) -> Optional[PricingJob]:
+        """
+        Block until a job of the current generation is queued and return it, or None after timeout.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while True:
+                while self._heap:
+                    _, _, job = heapq.heappop(self._heap)
+                    if job.generation == self.generation:
+                        return job
+                    self.dropped_count += 1
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._condition.wait(remaining)
+
+    def is_current(self, job: PricingJob) -> bool:
+        return job.generation == self.generation
+
+    def publish(self, job: PricingJob, apply: Callable[[], None]) -> bool:
+        """
+        Apply the result of job only if its generation is still current, atomically with respect to advance.
+        """
+        with self._condition:
+            if job.generation != self.generation:
+                self.refused_count += 1
+                logger.info(f"Refused {job.kind.name} result of generation {job.generation}, now {self.generation}")
+                return False
+            apply()
+        if job.kind == JobKind.CURRENT:
+            logger.info(f"Published current prices {(time.time() - job.submit_time) * 1000:.2f} ms after submission")
+        return True
+
+    def pending(self) -> int:
+        with self._condition:
+            return len(self._heap)
+
+
+class PriceCache:
+    """
+    Bounded least recently used cache of (call, put, call_delta, put_delta) keyed by Cards.state_key.
+    """
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self.hit_count = 0
+        self.miss_count = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Tuple[float, float, float, float]]:
+        with self._lock:
+            prices = self._entries.get(key)
+            if prices is None:
+                self.miss_count += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hit_count += 1
+            return prices
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def put(self, key: Hashable, prices: Tuple[float, float, float, float]) -> None:
+        with self._lock:
+            self._entries[key] = prices
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+
+class Lookahead:
+    """
+    Frontier of deck states whose next card tables are worth pricing ahead of time, most probable state first.
+
+    The root is the current state, a state one card deeper has depth 1 and so on. Only states shallower than max_depth
+    are expanded, and expansion stops once budget seconds of pricing have been spent on the current generation.
+    """
+
+    def __init__(self, max_depth: int, budget: float) -> None:
+        self.max_depth = max_depth
+        self.budget = budget
+        self.generation = -1
+        self.spent = 0.0
+        self._heap: List[Tuple[float, int, int, Cards]] = []
+        self._sequence = itertools.count()
+
+    def restart(self, cards: Cards, generation: int) -> None:
+        self.generation = generation
+        self.spent = 0.0
+        self._heap.clear()
+        self.push_children(cards, 1.0, 0)
+
+    def push_children(self, cards: Cards, probability: float, depth: int) -> None:
+        """
+        Queue every next state of cards for expansion, weighted by the probability of reaching it.
+        """
+        if depth + 1 >= self.max_depth or cards.get_remaining_cards_to_choose() <= 1:
+            return
+        counts = cards.get_remaining_counts()
+        remaining = sum(counts)
+        for card, count in enumerate(counts):
+            if count == 0:
+                continue
+            next_cards = cards.copy()
+            next_cards.choose_card(float(card))
+            next_probability = probability * count / remaining
+            heapq.heappush(self._heap, (-next_probability, next(self._sequence), depth + 1, next_cards))
+
+    def pending(self, generation: int) -> bool:
+        return generation == self.generation and self.spent < self.budget and bool(self._heap)
+
+    def pop(self) -> Tuple[float, int, Cards]:
+        negative_probability, _, depth, cards = heapq.heappop(self._heap)
+        return -negative_probability, depth, cards
+
+
+def test_current_runs_first():
+    scheduler = PricingScheduler()
+    cards = Cards()
+    scheduler.submit(JobKind.NEXT_TABLE, cards)
+    scheduler.submit(JobKind.CURRENT, cards)
+    assert scheduler.get(0).kind == JobKind.CURRENT
+    assert scheduler.get(0).kind == JobKind.NEXT_TABLE
+    assert scheduler.get(0) is None
+
+
+def test_stale_jobs_are_dropped_and_refused():
+    scheduler = PricingScheduler()
+    cards = Cards()
+    running = scheduler.submit(JobKind.CURRENT, cards)
+    assert scheduler.get(0) is running
+    scheduler.submit(JobKind.NEXT_TABLE, cards)
+
+    cards.choose_card(13.0)
+    scheduler.advance()
+    assert scheduler.dropped_count == 1
+    assert scheduler.get(0) is None
+
+    published = []
+    assert not scheduler.publish(running, lambda: published.append(running))
+    assert scheduler.refused_count == 1
+
+    current = scheduler.submit(JobKind.CURRENT, cards)
+    cards.choose_card(12.0)
+    assert current.cards.get_chosen_cards_num() == 1
+    assert scheduler.publish(scheduler.get(0), lambda: published.append(current))
+    assert published == [current]
+
+
+def test_price_cache_evicts_least_recently_used():
+    cache = PriceCache(2)
+    cache.put("a", (1.0, 1.0, 0.0, 0.0))
+    cache.put("b", (2.0, 2.0, 0.0, 0.0))
+    assert cache.get("a") == (1.0, 1.0, 0.0, 0.0)
+    cache.put("c", (3.0, 3.0, 0.0, 0.0))
+    assert "a" in cache and "b" not in cache and "c" in cache
+    assert cache.get("b") is None
+    assert (cache.hit_count, cache.miss_count) == (1, 1)
+
+
+def test_lookahead_most_probable_first():
+    cards = Cards()
+    cards.set_chosen_cards([1.0, 1.0, 1.0])
+    lookahead = Lookahead(max_depth=2, budget=1.0)
+    lookahead.restart(cards, 0)
+    probabilities = []
+    while lookahead.pending(0):
+        probability, depth, next_cards = lookahead.pop()
+        assert depth == 1 and next_cards.get_chosen_cards_num() == 4
+        probabilities.append(probability)
+    assert len(probabilities) == 13
+    assert probabilities == sorted(probabilities, reverse=True)
+    assert abs(sum(probabilities) - 1.0) < 1e-12
+    assert probabilities[-1] == 1 / 49
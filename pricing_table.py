@@ -0,0 +1,168 @@
+import argparse
+import logging
+import os
+import time
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from cards import Cards
+from option_pricing import MAX_CARD, option_pricing_exact
+
+logger = logging.getLogger(__name__)
+
+PRICING_TABLE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "build")
+DEFAULT_DEPTH = 6
+
+
+def encode_state(counts: Sequence[int]) -> int:
+    """
+    Encode the remaining count of every card value as one base 5 integer, the key of the table.
+    """
+    key = 0
+    for count in counts[MAX_CARD:0:-1]:
+        key = key * 5 + count
+    return key
+
+
+def iterate_states(depth: int) -> Iterator[List[float]]:
+    """
+    Every distinct set of chosen cards with at most depth cards, as a sorted list of chosen cards.
+    """
+    def expand(card: int, chosen: List[float]):
+        yield chosen
+        if len(chosen) == depth:
+            return
+        for next_card in range(card, MAX_CARD + 1):
+            if chosen.count(float(next_card)) < Cards.all_counts[next_card]:
+                yield from expand(next_card, chosen + [float(next_card)])
+
+    yield from expand(1, [])
+
+
+class PricingTable:
+    """
+    Prices of every deck state up to some depth for one pair of strikes, memory mapped from disk.
+
+    Keys are the encoded remaining deck in ascending order and values the (call, put, call_delta, put_delta) of each
+    state, so a lookup is a binary search that only touches a few pages of the file.
+    """
+
+    def __init__(self, keys: np.ndarray, values: np.ndarray, call_strike: float, put_strike: float) -> None:
+        self.keys = keys
+        self.values = values
+        self.call_strike = call_strike
+        self.put_strike = put_strike
+
+    @staticmethod
+    def path(call_strike: float, put_strike: float, directory: str = PRICING_TABLE_DIR) -> str:
+        return os.path.join(directory, f"pricing_table_{call_strike:g}_{put_strike:g}")
+
+    @classmethod
+    def load(
+        cls, call_strike: float = 150, put_strike: float = 130, directory: str = PRICING_TABLE_DIR
+    ) -> Optional["PricingTable"]:
+        path = cls.path(call_strike, put_strike, directory)
+        if not os.path.exists(f"{path}.keys.npy") or not os.path.exists(f"{path}.values.npy"):
+            logger.info(f"No pricing table at {path}")
+            return None
+        # Plain ndarray views over the mapping, np.memmap indexing is several times slower for single lookups
+        keys = np.load(f"{path}.keys.npy", mmap_mode="r").view(np.ndarray)
+        values = np.load(f"{path}.values.npy", mmap_mode="r").view(np.ndarray)
+        logger.info(f"Loaded pricing table {path} with {keys.size} states")
+        return cls(keys, values, call_strike, put_strike)
+
+    @classmethod
+    def build(
+        cls,
+        depth: int = DEFAULT_DEPTH,
+        call_strike: float = 150,
+        put_strike: float = 130,
+        directory: str = PRICING_TABLE_DIR,
+    ) -> "PricingTable":
+        """
+        Price every state with at most depth chosen cards with the exact engine and write the table to disk.
+        """
+        start_time = time.time()
+        keys = []
+        values = []
+        for chosen_cards in iterate_states(depth):
+            cards = Cards()
+            cards.set_chosen_cards(chosen_cards)
+            keys.append(encode_state(cards.get_remaining_counts()))
+            values.append(option_pricing_exact(cards, call_strike, put_strike))
+        order = np.argsort(keys)
+        keys = np.array(keys, dtype=np.int64)[order]
+        values = np.array(values, dtype=np.float64)[order]
+
+        os.makedirs(directory, exist_ok=True)
+        path = cls.path(call_strike, put_strike, directory)
+        # Write next to the target and rename, so a running bot never maps a half written table
+        for suffix, array in ((".keys.npy", keys), (".values.npy", values)):
+            temp_path = f"{path}.{os.getpid()}.tmp.npy"
+            np.save(temp_path, array)
+            os.replace(temp_path, path + suffix)
+        logger.info(f"Built pricing table {path} with {keys.size} states in {time.time() - start_time:.2f} seconds")
+        return cls.load(call_strike, put_strike, directory)
+
+    def get(self, cards: Cards) -> Optional[Tuple[float, float, float, float]]:
+        key = encode_state(cards.get_remaining_counts())
+        index = int(self.keys.searchsorted(key))
+        if index == self.keys.size or self.keys[index] != key:
+            return None
+        return tuple(self.values[index].tolist())
+
+    def get_next_table(self, cards: Cards) -> Optional[List[Optional[Tuple[float, float, float, float]]]]:
+        """
+        Prices of every next card, indexed by card, or None unless every next card is in the table.
+        """
+        table: List[Optional[Tuple[float, float, float, float]]] = [None] * (MAX_CARD + 1)
+        if cards.get_remaining_cards_to_choose() == 0:
+            return table
+        for next_card, count in enumerate(cards.get_remaining_counts()):
+            if count == 0:
+                continue
+            next_cards = cards.copy()
+            next_cards.choose_card(next_card)
+            table[next_card] = self.get(next_cards)
+            if table[next_card] is None:
+                return None
+        return table
+
+
+def test_encode_state():
+    cards = Cards()
+    assert encode_state(cards.get_remaining_counts()) == encode_state([0] + [4] * 13)
+    cards.choose_card(13.0)
+    other = Cards()
+    other.choose_card(12.0)
+    assert encode_state(cards.get_remaining_counts()) != encode_state(other.get_remaining_counts())
+
+
+def test_pricing_table(tmp_path):
+    table = PricingTable.build(2, directory=str(tmp_path))
+    assert table.keys.size == 1 + 13 + 13 * 14 // 2
+
+    cards = Cards()
+    cards.set_chosen_cards([13.0, 2.0])
+    assert table.get(cards) == option_pricing_exact(cards)
+    cards.choose_card(2.0)
+    assert table.get(cards) is None
+
+    cards = Cards()
+    cards.choose_card(1.0)
+    next_cards = cards.copy()
+    next_cards.choose_card(2.0)
+    assert table.get_next_table(cards)[2] == table.get(next_cards)
+    cards.choose_card(1.0)
+    assert table.get_next_table(cards) is None
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Warm the on-disk pricing table")
+    parser.add_argument("--depth", type=int, default=DEFAULT_DEPTH, help="Price every state with up to this many cards")
+    parser.add_argument("--call-strike", type=float, default=150)
+    parser.add_argument("--put-strike", type=float, default=130)
+    args = parser.parse_args()
+    PricingTable.build(args.depth, args.call_strike, args.put_strike)
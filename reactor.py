@@ -0,0 +1,141 @@
+import heapq
+import itertools
+import logging
+import queue
+import time
+from collections import defaultdict
+from enum import Enum
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class EventType(Enum):
+    NEWS = 0
+    CARDS = 1
+    PRICES = 2
+    STATE = 3
+    STOP = 4
+    POSITIONS = 5
+
+
+# Only the latest of these matters, so a burst of them is dispatched once
+COALESCED_EVENTS = {EventType.NEWS, EventType.PRICES, EventType.POSITIONS}
+
+
+class Timer:
+    __slots__ = ("when", "callback", "cancelled")
+
+    def __init__(self, when: float, callback: Callable[[], None]) -> None:
+        self.when = when
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Reactor:
+    """
+    Single threaded event loop: other threads post events, handlers and timers run on the thread calling run.
+
+    The loop sleeps until the next event or timer, so nothing happens unless an input changed or a timer expired.
+    call_at and call_later must only be called from handlers and timers, i.e. from the reactor thread.
+    """
+
+    def __init__(self) -> None:
+        self.event_count = 0
+        self.timer_count = 0
+        self._events: queue.SimpleQueue = queue.SimpleQueue()
+        self._timers: List[Tuple[float, int, Timer]] = []
+        self._sequence = itertools.count()
+        self._handlers: Dict[EventType, List[Callable[[Any], None]]] = defaultdict(list)
+        self._stopped = False
+
+    def subscribe(self, event_type: EventType, handler: Callable[[Any], None]):
+        self._handlers[event_type].append(handler)
+
+    def post(self, event_type: EventType, data: Any = None):
+        self._events.put((event_type, data))
+
+    def call_at(self, when: float, callback: Callable[[], None]) -> Timer:
+        timer = Timer(when, callback)
+        heapq.heappush(self._timers, (when, next(self._sequence), timer))
+        return timer
+
+    def call_later(self, delay: float, callback: Callable[[], None]) -> Timer:
+        return self.call_at(time.time() + delay, callback)
+
+    def stop(self):
+        self.post(EventType.STOP)
+
+    def run(self):
+        self._stopped = False
+        while not self._stopped:
+            self.run_once()
+
+    def run_once(self, timeout: Optional[float] = None):
+        """
+        Wait for events until the next timer is due or timeout passes, then dispatch the events and due timers.
+        """
+        while self._timers and self._timers[0][2].cancelled:
+            heapq.heappop(self._timers)
+        if self._timers:
+            until_timer = max(0.0, self._timers[0][0] - time.time())
+            timeout = until_timer if timeout is None else min(timeout, until_timer)
+
+        events = []
+        try:
+            events.append(self._events.get(timeout=timeout))
+            while True:
+                events.append(self._events.get_nowait())
+        except queue.Empty:
+            pass
+
+        last_index = {event_type: index for index, (event_type, _) in enumerate(events)}
+        for index, (event_type, data) in enumerate(events):
+            if event_type in COALESCED_EVENTS and last_index[event_type] != index:
+                continue
+            if event_type == EventType.STOP:
+                self._stopped = True
+                return
+            self.event_count += 1
+            for handler in self._handlers[event_type]:
+                self._dispatch(handler, data)
+
+        now = time.time()
+        while self._timers and self._timers[0][0] <= now:
+            _, _, timer = heapq.heappop(self._timers)
+            if not timer.cancelled:
+                self.timer_count += 1
+                self._dispatch(lambda _: timer.callback(), None)
+
+    @staticmethod
+    def _dispatch(handler: Callable[[Any], None], data: Any):
+        try:
+            handler(data)
+        except Exception as error:
+            logger.exception(f"Reactor handler failed: {error}")
+
+
+def test_reactor_coalesces_and_runs_timers():
+    reactor = Reactor()
+    received = []
+    reactor.subscribe(EventType.PRICES, lambda data: received.append(("prices", data)))
+    reactor.subscribe(EventType.CARDS, lambda data: received.append(("cards", data)))
+    reactor.post(EventType.PRICES, 1)
+    reactor.post(EventType.CARDS, [13])
+    reactor.post(EventType.PRICES, 2)
+    reactor.run_once(timeout=0)
+    assert received == [("cards", [13]), ("prices", 2)]
+
+    fired = []
+    reactor.call_later(0.0, lambda: fired.append("now"))
+    reactor.call_later(0.0, lambda: fired.append("cancelled")).cancel()
+    reactor.call_later(60.0, lambda: fired.append("later"))
+    reactor.run_once(timeout=0)
+    assert fired == ["now"]
+
+    reactor.stop()
+    reactor.run()
+    assert reactor.event_count == 2 and reactor.timer_count == 1
@@ -0,0 +1,122 @@
+import logging
+from typing import Callable, Optional
+
+from connectivity import ReferenceData
+from model import Side
+
+logger = logging.getLogger(__name__)
+
+
+class RiskGate:
+    """
+    Clips or rejects orders locally against the exchange position limits, before they cost a round trip.
+
+    An order may only fill up to the limit on its side, counting the position and the volume already resting on that
+    side: a buy is clipped to longLimit - position - resting bids, a sell to shortLimit + position - resting asks.
+    Nothing is allowed while the exchange says it is not accepting orders; before its first status is known orders
+    pass, and the exchange itself rejects them if it must. Limits, positions and resting volume are all read
+    from local caches, so a check makes no request.
+    """
+
+    def __init__(
+        self,
+        reference: ReferenceData,
+        position: Callable[[str], int],
+        resting_volume: Callable[[str, Side], int],
+    ) -> None:
+        self.reference = reference
+        self.position = position
+        self.resting_volume = resting_volume
+        self.checked_count = 0
+        self.clipped_count = 0
+        self.rejected_count = 0
+        self.halted_count = 0
+
+    def halted(self) -> bool:
+        return self.reference.accepting_orders() is False
+
+    def check(self, product: str, side: Side, volume: int, resting: Optional[int] = None) -> int:
+        """
+        Return the volume that can be sent, 0 when the order must not be sent. resting overrides the volume resting
+        on that side, e.g. 0 for a quote that replaces the resting one.
+        """
+        self.checked_count += 1
+        if self.halted():
+            self.halted_count += 1
+            return 0
+        limit = self.reference.position_limit(product)
+        if limit is None:
+            return volume
+        if resting is None:
+            resting = self.resting_volume(product, side)
+        position = self.position(product)
+        if side == Side.BUY:
+            room = abs(limit.longLimit) - position - resting
+        else:
+            room = abs(limit.shortLimit) + position - resting
+        if room <= 0:
+            self.rejected_count += 1
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Rejected {side.value} {volume} {product}, position {position}, resting {resting}")
+            return 0
+        if volume > room:
+            self.clipped_count += 1
+            return room
+        return volume
+
+
+class LimitsReference:
+    """
+    Stand-in for ReferenceData with fixed limits.
+    """
+
+    def __init__(self, accepting_orders: Optional[bool]) -> None:
+        from model import PositionLimit
+
+        self.limits = {"FUTURE": PositionLimit(shortLimit=100, longLimit=100)}
+        self.accepting = accepting_orders
+
+    def accepting_orders(self) -> Optional[bool]:
+        return self.accepting
+
+    def position_limit(self, product: str):
+        return self.limits.get(product)
+
+
+def test_risk_gate_clips_to_limits():
+    positions = {"FUTURE": 60}
+    resting = {("FUTURE", Side.BUY): 30}
+    reference = LimitsReference(accepting_orders=True)
+    gate = RiskGate(
+        reference, lambda product: positions.get(product, 0), lambda product, side: resting.get((product, side), 0)
+    )
+
+    assert gate.check("FUTURE", Side.BUY, 200) == 10
+    assert gate.check("FUTURE", Side.BUY, 200, resting=0) == 40
+    assert gate.check("FUTURE", Side.SELL, 200) == 160
+    positions["FUTURE"] = 100
+    assert gate.check("FUTURE", Side.BUY, 5) == 0
+    assert gate.check("150 CALL", Side.BUY, 500) == 500
+    reference.accepting = False
+    assert gate.check("FUTURE", Side.SELL, 5) == 0
+    reference.accepting = None
+    assert gate.check("FUTURE", Side.SELL, 5) == 5
+    assert (gate.clipped_count, gate.rejected_count, gate.halted_count) == (3, 1, 1)
+
+
+def test_hedge_passes_while_quotes_rest_at_the_limit():
+    from exchange import Exchange
+
+    exchange = Exchange.__new__(Exchange)
+    exchange.ledger = None
+    positions = {"FUTURE": 0}
+    sent = []
+    exchange.risk = RiskGate(
+        LimitsReference(accepting_orders=True), lambda product: positions.get(product, 0), lambda product, side: 100
+    )
+    exchange.gateway = type("Gateway", (), {"insert_ioc_order": lambda self, *args: sent.append(args)})()
+
+    # Quotes of the full limit rest on both sides, yet the hedge only adds to the position
+    assert exchange.risk.check("FUTURE", Side.SELL, 20) == 0
+    assert exchange.insert_ioc_order("FUTURE", 99.0, 20, Side.SELL) == 20
+    assert sent == [("FUTURE", 99.0, 20, Side.SELL)]
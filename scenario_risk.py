@@ -0,0 +1,153 @@
+import logging
+import time
+from typing import Dict, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from cards import Cards
+from option_pricing import option_pricing_exact
+from pricing_scheduler import PriceCache
+
+logger = logging.getLogger(__name__)
+
+StateKey = Tuple[int, ...]
+
+
+class PortfolioRisk(NamedTuple):
+    delta: float
+    gamma: float
+    worst_loss: float
+
+
+class Scenarios(NamedTuple):
+    """
+    Price moves of the future, call and put in every scenario, one row per scenario, and the risk of one unit of each.
+    """
+
+    moves: np.ndarray
+    deltas: np.ndarray
+    gammas: np.ndarray
+
+
+class ScenarioRisk:
+    """
+    Portfolio risk over every next card and every next two cards.
+
+    For a deck state the price moves of the future, call and put in each scenario are built once, from the branch
+    prices the pricer caches while looking ahead, and kept until the deck changes. The per unit delta and gamma come
+    from a probability weighted quadratic fit of each price move against the future move, so they are sensitivities
+    to the future price, not probabilities of finishing in the money. assess is then a few dot products over the
+    scenarios, and the worst-case loss the largest loss over them.
+    """
+
+    def __init__(self, cache: PriceCache, call_strike: float = 150, put_strike: float = 130) -> None:
+        self.cache = cache
+        self.call_strike = call_strike
+        self.put_strike = put_strike
+        self.build_count = 0
+        self.priced_count = 0
+        # One tuple, so a reader on another thread never sees a key with the scenarios of another state
+        self._built: Optional[Tuple[StateKey, Scenarios]] = None
+
+    def assess(self, cards: Cards, positions: Dict[str, int], symbols: Tuple[str, str, str]) -> PortfolioRisk:
+        """
+        Risk of the positions in the (future, call, put) symbols.
+        """
+        scenarios = self.scenarios(cards)
+        volumes = np.array([positions.get(symbol, 0) for symbol in symbols], dtype=float)
+        if scenarios.moves.shape[0] == 0:
+            return PortfolioRisk(0.0, 0.0, 0.0)
+        pnl = scenarios.moves @ volumes
+        return PortfolioRisk(
+            float(scenarios.deltas @ volumes),
+            float(scenarios.gammas @ volumes),
+            max(0.0, -float(pnl.min())),
+        )
+
+    def scenarios(self, cards: Cards) -> Scenarios:
+        key = cards.state_key
+        built = self._built
+        if built is not None and built[0] == key:
+            return built[1]
+        start_time = time.perf_counter()
+        scenarios = self.build(cards)
+        self._built = (key, scenarios)
+        self.build_count += 1
+        logger.debug(f"Built {scenarios.moves.shape[0]} scenarios in {time.perf_counter() - start_time:.4f}s")
+        return scenarios
+
+    def build(self, cards: Cards) -> Scenarios:
+        current = self.values(cards)
+        rows = []
+        weights = []
+        horizons = min(2, cards.get_remaining_cards_to_choose())
+        frontier = [(cards, 1.0)]
+        for _ in range(horizons):
+            next_frontier = []
+            for state, probability in frontier:
+                counts = state.get_remaining_counts()
+                remaining = sum(counts)
+                for card, count in enumerate(counts):
+                    if count == 0:
+                        continue
+                    next_state = state.copy()
+                    next_state.choose_card(float(card))
+                    next_probability = probability * count / remaining
+                    next_frontier.append((next_state, next_probability))
+                    rows.append(self.values(next_state))
+                    # Each horizon weighs as much in the fit as the other
+                    weights.append(next_probability / horizons)
+            frontier = next_frontier
+
+        if not rows:
+            return Scenarios(np.zeros((0, 3)), np.zeros(3), np.zeros(3))
+        moves = np.array(rows) - current
+        weights = np.array(weights)
+        future_moves = moves[:, 0]
+        design = np.stack([np.ones_like(future_moves), future_moves, 0.5 * future_moves**2], axis=1)
+        weighted = design * weights[:, None]
+        coefficients = np.linalg.lstsq(weighted.T @ design, weighted.T @ moves, rcond=None)[0]
+        return Scenarios(moves, coefficients[1], coefficients[2])
+
+    def values(self, cards: Cards) -> Tuple[float, float, float]:
+        """
+        Future, call and put values of a deck state, priced exactly when the pricer has not cached it yet.
+        """
+        prices = self.cache.get(cards.state_key)
+        if prices is None:
+            prices = option_pricing_exact(cards, self.call_strike, self.put_strike)
+            self.cache.put(cards.state_key, prices)
+            self.priced_count += 1
+        return cards.get_theoretical_price(), prices[0], prices[1]
+
+
+def test_scenario_risk():
+    cards = Cards()
+    cards.set_chosen_cards([float(card) for card in [13, 12, 1, 7, 9, 10, 2, 4, 11, 6, 8, 5, 3, 13, 12, 1]])
+    risk = ScenarioRisk(PriceCache(4096))
+    symbols = ("FUTURE", "150 CALL", "130 PUT")
+
+    future = risk.assess(cards, {"FUTURE": 10}, symbols)
+    assert abs(future.delta - 10) < 1e-9 and abs(future.gamma) < 1e-9 and future.worst_loss > 0
+
+    # A long call gains when the future rises and its delta is between 0 and 1 per unit
+    call = risk.assess(cards, {"150 CALL": 1}, symbols)
+    assert 0 < call.delta < 1 and call.gamma > 0
+    put = risk.assess(cards, {"130 PUT": 1}, symbols)
+    assert -1 < put.delta < 0
+
+    # Selling the call delta in futures hedges the first-order moves
+    hedged = risk.assess(cards, {"150 CALL": 100, "FUTURE": -round(100 * call.delta)}, symbols)
+    assert abs(hedged.delta) < 1
+    assert risk.build_count == 1
+
+    start_time = time.perf_counter()
+    for _ in range(1000):
+        risk.assess(cards, {"FUTURE": 3, "150 CALL": -20, "130 PUT": 15}, symbols)
+    assert (time.perf_counter() - start_time) / 1000 < 1e-3
+
+    cards.choose_card(9.0)
+    cards.choose_card(9.0)
+    cards.choose_card(9.0)
+    cards.choose_card(10.0)
+    assert risk.assess(cards, {"150 CALL": 1}, symbols) == PortfolioRisk(0.0, 0.0, 0.0)
@@ -1,74 +1,189 @@
-import queue
 import threading
 import time
-from typing import Optional
+from typing import Callable, List, Optional
 from cards import Cards
+from codec import Order
 from exchange import Exchange
 from model import Side
 from option_pricing import (
-    compile_option_pricing_cpp,
-    option_pricing_cpp,
-    option_pricing_next_cpp,
+    OptionPricingBuild,
+    OptionPricingServer,
+    PricingEngine,
+    option_pricing,
+    option_pricing_exact,
+    option_pricing_exact_next_table,
+    option_pricing_next_table,
 )
+from pricing_scheduler import JobKind, Lookahead, PriceCache, PricingScheduler
+from pricing_table import PricingTable
+from scenario_risk import PortfolioRisk, ScenarioRisk
 from util import round_down_to_tick, round_up_to_tick
 import logging
 
 logger = logging.getLogger(__name__)
 
+# A hedge not acknowledged by then is assumed lost
+HEDGE_ACK_TIMEOUT = 2.0
+
 
 class Pricer:
 
-    def __init__(self, cards: Cards, thread_count: int, iteration_count: int) -> None:
-        compile_option_pricing_cpp()
+    def __init__(
+        self,
+        cards: Cards,
+        thread_count: int,
+        iteration_count: int,
+        engine: PricingEngine = PricingEngine.EXACT,
+        table: Optional[PricingTable] = None,
+        lookahead_depth: int = 2,
+        lookahead_budget: float = 5.0,
+        cache_size: int = 4096,
+    ) -> None:
+        self.engine = engine
+        self.table = table
+        self.build: Optional[OptionPricingBuild] = None
+        self.server: Optional[OptionPricingServer] = None
+        if self.engine == PricingEngine.CPP:
+            self.build = OptionPricingBuild()
+            self.build.start()
+        self.scheduler = PricingScheduler()
+        self.listeners: List[Callable[[], None]] = []
         self.reset()
         self.cards = cards
-        self.next_cards = [None] * 14
+        self.cache = PriceCache(cache_size)
+        self.lookahead = Lookahead(lookahead_depth, lookahead_budget)
         self.thread_count = thread_count
         self.iteration_count = iteration_count
-        self.queue: queue.Queue[int] = queue.Queue()
+        self.target_error = 0.0
         self.pricer_thread = threading.Thread(
             target=self.option_pricing_cpp_thread, daemon=True
         )
         self.pricer_thread.start()
 
     def option_pricing_cpp_thread(self):
+        if self.build is not None:
+            self.start_server()
         while True:
-            next_card = self.queue.get()
-            if next_card == -1:
-                self.call, self.put, self.call_delta, self.put_delta = (
-                    option_pricing_cpp(
-                        self.cards, self.thread_count, self.iteration_count
-                    )
-                )
-            elif self.cards.get_chosen_cards_num() < 20:
-                self.next_cards[int(next_card)] = option_pricing_next_cpp(
-                    self.cards, next_card, self.thread_count, self.iteration_count
-                )
-            self.queue.task_done()
-
-    def pricing(self):
-        if self.cards.get_chosen_cards_num() == 0:
-            self.queue.put(-1)
-            self.pricing_next()
+            speculate = self.lookahead.pending(self.scheduler.generation)
+            job = self.scheduler.get(timeout=0 if speculate else None)
+            try:
+                if job is None:
+                    self.speculate()
+                elif job.kind == JobKind.CURRENT:
+                    prices = self.option_pricing(job.cards)
+                    self.cache.put(job.cards.state_key, prices[:4])
+                    self.scheduler.publish(job, lambda: self.set_prices(*prices))
+                else:
+                    self.cache_next_table(job.cards)
+                    self.lookahead.restart(job.cards, job.generation)
+            except Exception as error:
+                # This is the only pricing thread, so a failed job is dropped and the thread carries on
+                logger.exception(f"Pricing job failed: {error}")
+                if self.server is not None and self.server.process.poll() is not None:
+                    logger.warning("Option pricing server exited, restarting it")
+                    self.start_server()
+
+    def start_server(self):
+        """
+        Start the pricing server once the build is done, falling back to exact pricing when the build failed.
+        """
+        try:
+            self.server = OptionPricingServer(self.build.wait())
+        except Exception as error:
+            logger.exception(f"Starting the option pricing server failed, pricing exactly instead: {error}")
+            self.server = None
+            self.engine = PricingEngine.EXACT
+
+    def cache_next_table(self, cards: Cards):
+        """
+        Price every next state of cards that is not cached yet. Prices depend only on the deck, so results of stale
+        generations are cached too.
+        """
+        if cards.get_remaining_cards_to_choose() == 0:
+            return
+        next_keys = {}
+        for card, count in enumerate(cards.get_remaining_counts()):
+            if count > 0:
+                next_cards = cards.copy()
+                next_cards.choose_card(float(card))
+                next_keys[card] = next_cards.state_key
+        if all(key in self.cache for key in next_keys.values()):
             return
+        next_table = self.option_pricing_next_table(cards)
+        for card, key in next_keys.items():
+            if next_table[card] is not None:
+                self.cache.put(key, tuple(next_table[card][:4]))
+
+    def speculate(self):
+        """
+        Price the next card table of the most probable state on the lookahead frontier.
+        """
+        probability, depth, cards = self.lookahead.pop()
+        start_time = time.perf_counter()
+        self.cache_next_table(cards)
+        self.lookahead.spent += time.perf_counter() - start_time
+        self.lookahead.push_children(cards, probability, depth)
+
+    def option_pricing(self, cards: Cards):
+        """
+        Returns the four prices followed by the call and put standard errors, which are None when unknown.
+        """
+        cached = self.table.get(cards) if self.table is not None else None
+        if cached is not None:
+            return cached + (0.0, 0.0)
+        if self.engine == PricingEngine.EXACT:
+            return option_pricing_exact(cards) + (0.0, 0.0)
+        if self.engine == PricingEngine.NUMPY:
+            return option_pricing(150, 130, cards, self.iteration_count) + (
+                None,
+                None,
+            )
+        return self.server.option_pricing_with_error(
+            cards, self.thread_count, self.iteration_count, self.target_error
+        )
 
-        cache = self.next_cards[int(self.cards._chosen_cards[0])]
-        if cache is not None:
-            self.call, self.put, self.call_delta, self.put_delta = cache
-            self.next_cards = [None] * 14
+    def option_pricing_next_table(self, cards: Cards):
+        cached = self.table.get_next_table(cards) if self.table is not None else None
+        if cached is not None:
+            return cached
+        if self.engine == PricingEngine.EXACT:
+            return option_pricing_exact_next_table(cards)
+        if self.engine == PricingEngine.NUMPY:
+            return option_pricing_next_table(150, 130, cards, self.iteration_count)
+        return self.server.option_pricing_next_table(
+            cards, self.thread_count, self.iteration_count
+        )
+
+    def set_prices(self, call, put, call_delta, put_delta, call_error, put_error):
+        self.call = call
+        self.put = put
+        self.call_delta = call_delta
+        self.put_delta = put_delta
+        self.call_error = call_error
+        self.put_error = put_error
+        if call is not None:
+            for listener in self.listeners:
+                listener()
+
+    def pricing(self):
+        cached = self.table.get(self.cards) if self.table is not None else None
+        if cached is None:
+            cached = self.cache.get(self.cards.state_key)
+        if cached is not None:
+            self.set_prices(*cached[:4], 0.0, 0.0)
         else:
-            self.queue.put(-1)
+            self.scheduler.submit(JobKind.CURRENT, self.cards)
         self.pricing_next()
 
     def pricing_next(self):
-        for next_card in set(self.cards.get_remaining_cards()):
-            self.queue.put(next_card)
+        self.scheduler.submit(JobKind.NEXT_TABLE, self.cards)
 
     def reset(self):
-        self.call = None
-        self.put = None
-        self.call_delta = None
-        self.put_delta = None
+        """
+        Start a new card state generation: queued jobs are dropped and running ones can no longer publish.
+        """
+        self.scheduler.advance()
+        self.set_prices(None, None, None, None, None, None)
 
 
 class Strategy:
@@ -85,7 +200,7 @@ class Strategy:
     def make_market(self):
         theo = self.theo_price
         if theo is None:
-            self.exchange.delete_orders(self.symbol)
+            self.exchange.orders.cancel(self.symbol)
             return
 
         bid_price = round_down_to_tick(
@@ -96,19 +211,8 @@ class Strategy:
         )
         bid_price = max(0, bid_price)
         ask_price = max(bid_price + self.tick_size, ask_price)
-        self.exchange.insert_order(
-            instrument_id=self.symbol,
-            price=bid_price,
-            volume=self.position_limit * 2,
-            side=Side.BUY,
-        )
-
-        self.exchange.insert_order(
-            instrument_id=self.symbol,
-            price=ask_price,
-            volume=self.position_limit * 2,
-            side=Side.SELL,
-        )
+        self.exchange.orders.quote(self.symbol, Side.BUY, bid_price, self.position_limit * 2)
+        self.exchange.orders.quote(self.symbol, Side.SELL, ask_price, self.position_limit * 2)
 
         self.bid_price = bid_price
         self.ask_price = ask_price
@@ -117,7 +221,7 @@ class Strategy:
         self.theo_price = None
         self.bid_price = None
         self.ask_price = None
-        self.exchange.delete_orders(self.symbol)
+        self.exchange.orders.cancel(self.symbol)
         self.reset_time = time.time()
 
 
@@ -141,7 +245,7 @@ class Future(Strategy):
         if time.time() - self.reset_time <= self.interval:
             super().make_market()
         else:
-            self.exchange.delete_orders(self.symbol)
+            self.exchange.orders.cancel(self.symbol)
 
 
 class Call(Strategy):
@@ -172,7 +276,7 @@ class Call(Strategy):
         if time.time() - self.reset_time <= self.interval:
             super().make_market()
         else:
-            self.exchange.delete_orders(self.symbol)
+            self.exchange.orders.cancel(self.symbol)
 
 
 class Put(Strategy):
@@ -203,10 +307,20 @@ class Put(Strategy):
         if time.time() - self.reset_time <= self.interval:
             super().make_market()
         else:
-            self.exchange.delete_orders(self.symbol)
+            self.exchange.orders.cancel(self.symbol)
 
 
 class Hedger:
+    """
+    Keeps the total delta inside [-band, band] by selling or buying the future with IOC orders.
+
+    hedge can be called as often as wanted, it reads positions from the local ledger, which books fills from the trade
+    stream as they happen, and only sends when the delta is outside the band and no hedge is in flight. A hedge is in
+    flight until on_positions, called on every position change of the ledger, finds its acknowledgement booked there,
+    or until HEDGE_ACK_TIMEOUT passes. Without a ledger positions are requested from the exchange, and the
+    acknowledgement reaching on_order ends it.
+    """
+
     def __init__(
         self,
         exchange: Exchange,
@@ -214,71 +328,128 @@ class Hedger:
         future: Future,
         call: Call,
         put: Put,
-        interval: float,
+        band: float,
         credit: float = 0.5
     ) -> None:
         self.exchange = exchange
         self.pricer = pricer
-        self.hedge_interval = interval
+        self.band = band
         self.future = future
         self.call = call
         self.put = put
         self.credit = credit
-        self.has_hedged = False
-        self.reset()
-
-    def compute_total_delta(self) -> Optional[float]:
+        self.hedge_count = 0
+        self.in_flight_time: Optional[float] = None
+        self.scenario_risk = ScenarioRisk(pricer.cache)
+        # Last risk computed on the trading thread, read by the UI so it never prices the cards it is changing
+        self.risk: Optional[PortfolioRisk] = None
+        exchange.order_listeners.append(self.on_order)
+
+    def compute_risk(self) -> Optional[PortfolioRisk]:
         positions = self.exchange.get_positions()
-        call_delta = self.pricer.call_delta
-        put_delta = self.pricer.put_delta
         if positions is None:
-            logger.warn("Hedging failed, get positions failed")
+            logger.warning("Computing risk failed, get positions failed")
             return None
-        if call_delta is None:
-            logger.warn("Hedging failed, call delta is None")
-            return None
-        if put_delta is None:
-            logger.warn("Hedging failed, put delta is None")
+        self.risk = self.scenario_risk.assess(
+            self.future.cards, positions, (self.future.symbol, self.call.symbol, self.put.symbol)
+        )
+        return self.risk
+
+    def compute_total_delta(self) -> Optional[float]:
+        """
+        Delta of the whole portfolio to the future over the next card scenarios.
+        """
+        risk = self.compute_risk()
+        if risk is None:
             return None
+        return risk.delta
 
-        total_delta = (
-            positions.get(self.future.symbol, 0)
-            + positions.get(self.call.symbol, 0) * call_delta
-            + positions.get(self.put.symbol, 0) * put_delta
-        )
-        return total_delta
+    def on_order(self, order: Order, ioc: bool):
+        if ioc and order.product == self.future.symbol and self.exchange.ledger is None:
+            self.in_flight_time = None
+
+    def on_positions(self):
+        # Read from the ledger rather than from the acknowledgement, so the fill is in the positions hedge reads next
+        ledger = self.exchange.ledger
+        if self.in_flight_time is not None and ledger is not None and not ledger.awaiting_ack(self.future.symbol):
+            self.in_flight_time = None
 
     def hedge(self, theo: float):
-        if time.time() - self.reset_time <= self.hedge_interval:
-            return
-        if self.has_hedged:
-            return
+        if self.in_flight_time is not None:
+            if time.time() - self.in_flight_time < HEDGE_ACK_TIMEOUT:
+                return
+            logger.warning("Hedge was not acknowledged, hedging again")
+            self.in_flight_time = None
 
         total_delta = self.compute_total_delta()
         if total_delta is None:
             return
-
-        total_delta = int(total_delta)
-
-        if total_delta == 0:
-            logger.info("Hedging delta is 0, no need to hedge")
-            self.has_hedged = True
+        total_delta = round(total_delta)
+        if total_delta == 0 or abs(total_delta) <= self.band:
             return
+
         tick_size = self.future.tick_size
         logger.info(f"Hedging total_delta {total_delta}")
+        # Set before sending, the acknowledgement can arrive on a gateway thread before insert_ioc_order returns
+        self.in_flight_time = time.time()
         if total_delta < 0:
             bid_price = round_up_to_tick(theo + tick_size * self.credit, tick_size)
             logger.info(f"Hedging by buying FUTURE at price {bid_price}")
-            self.exchange.insert_ioc_order(
-                "FUTURE", price=bid_price, volume=(-1 * total_delta), side=Side.BUY
+            sent = self.exchange.insert_ioc_order(
+                self.future.symbol, price=bid_price, volume=(-1 * total_delta), side=Side.BUY
             )
         else:
             ask_price = round_down_to_tick(theo - tick_size * self.credit, tick_size)
             logger.info(f"Hedging by selling FUTURE at price {ask_price}")
-            self.exchange.insert_ioc_order(
-                "FUTURE", price=ask_price, volume=total_delta, side=Side.SELL
+            sent = self.exchange.insert_ioc_order(
+                self.future.symbol, price=ask_price, volume=total_delta, side=Side.SELL
             )
-
-    def reset(self):
-        self.reset_time = time.time()
-        self.has_hedged = False
+        if sent <= 0:
+            self.in_flight_time = None
+            return
+        self.hedge_count += 1
+
+
+class HedgeExchange:
+    """
+    Stand-in for Exchange with a ledger, recording the hedges sent.
+    """
+
+    def __init__(self) -> None:
+        from ledger import PositionLedger
+
+        self.hedges = []
+        self.order_listeners = []
+        self.ledger = PositionLedger(lambda: {})
+        self.ledger.reconcile()
+
+    def insert_ioc_order(self, instrument_id: str, price: float, volume: int, side: Side) -> int:
+        self.ledger.on_send(instrument_id, side, price, volume, True)
+        self.hedges.append((side, volume))
+        return volume
+
+
+def test_hedger_waits_for_the_ledger():
+    from types import SimpleNamespace
+
+    from codec import Order
+    from pricing_scheduler import PriceCache
+
+    exchange = HedgeExchange()
+    future = SimpleNamespace(symbol="FUTURE", tick_size=0.1)
+    hedger = Hedger(exchange, SimpleNamespace(cache=PriceCache(16)), future, None, None, band=2)
+    # Short 10 delta of options, hedged by the future
+    hedger.compute_total_delta = lambda: exchange.ledger.position("FUTURE") - 10
+    hedger.hedge(100.0)
+    assert exchange.hedges == [(Side.BUY, 10)]
+
+    # Only the ledger ends a hedge in flight, so the order its listeners run in does not matter: a trade booked
+    # before the acknowledgement keeps the hedge in flight, and the acknowledgement of a partial fill ends it
+    exchange.ledger.on_trade("FUTURE", Side.BUY, 100.0, 6)
+    hedger.on_positions()
+    hedger.hedge(100.0)
+    assert exchange.hedges == [(Side.BUY, 10)]
+    exchange.ledger.on_order(Order("1", "CANCELLED", "FUTURE", Side.BUY, 100.1, 10, 6), True)
+    hedger.on_positions()
+    hedger.hedge(100.0)
+    assert exchange.hedges == [(Side.BUY, 10), (Side.BUY, 4)]
@@ -1,43 +1,170 @@
 from typing import List
-from model import NewsResponse
+
+from news import NewsCursor
+from reactor import EventType, Reactor, Timer
+from strategy import Strategy
 from trade_config import ManualNewsState, Mode, TradeConfig
 
+NEWS_POLL_INTERVAL = 0.2
+HEDGE_CHECK_INTERVAL = 0.5
 
-def news_to_cards(news: List[NewsResponse]) -> List[int]:
-    cards = []
-    for new in news:
-        res = new.to_card()
-        if res is not None:
-            cards.append(res)
-    return cards
 
+class Trader:
+    """
+    Runs the strategies on a reactor: quotes when the cards, prices or UI state change, and pulls quotes when the
+    strategy intervals expire, instead of spinning over the exchange. While hedging is on, the delta is checked on
+    every price and position change and every HEDGE_CHECK_INTERVAL.
+    """
 
-def full_auto_trade(config: TradeConfig):
-    assert config.mode == Mode.FULL_AUTO
-    while True:
-        news = config.exchange.get_news()
-        cards = news_to_cards(news)
-        size = len(cards)
-        
-        if size != config.cards.get_chosen_cards_num():
-            config.update_cards(cards)
+    def __init__(self, config: TradeConfig) -> None:
+        self.config = config
+        self.reactor = Reactor()
+        self.cursor = NewsCursor()
+        self.timers: List[Timer] = []
+        config.reactor = self.reactor
+        config.pricer.listeners.append(lambda: self.reactor.post(EventType.PRICES))
+        self.reactor.subscribe(EventType.CARDS, self.on_cards)
+        self.reactor.subscribe(EventType.PRICES, self.on_prices)
+        self.reactor.subscribe(EventType.PRICES, lambda _: self.hedge())
+        self.reactor.subscribe(EventType.POSITIONS, self.on_positions)
+        ledger = config.exchange.ledger
+        if ledger is not None:
+            ledger.listeners.append(lambda: self.reactor.post(EventType.POSITIONS))
 
-        config.future.make_market(auto=True)
-        config.call.make_market(auto=True)
-        config.put.make_market(auto=True)
+    def run(self):
+        self.check_hedge()
+        self.reactor.run()
 
-        config.hedger.hedge(config.cards.get_theoretical_price())
+    def cancel_timers(self):
+        for timer in self.timers:
+            timer.cancel()
+        self.timers = []
 
-def manual_news_trade(config: TradeConfig):
-    assert config.mode == Mode.MANUAL_NEWS
-    while True:
-        match config.manul_news_state:
+    def on_cards(self, cards):
+        self.cancel_timers()
+        self.config.apply_cards(cards)
+        self.on_new_cards()
+
+    def on_new_cards(self):
+        pass
+
+    def on_prices(self, _):
+        pass
+
+    def on_positions(self, _):
+        self.config.hedger.on_positions()
+        self.hedge()
+
+    def hedging(self) -> bool:
+        return True
+
+    def hedge(self):
+        if self.hedging():
+            self.config.hedger.hedge(self.config.cards.get_theoretical_price())
+        else:
+            # Keeps the risk shown in the monitor current while not hedging
+            self.config.hedger.compute_risk()
+
+    def check_hedge(self):
+        # A hedge whose acknowledgement never came expires without an event, so check on a timer as well
+        self.hedge()
+        self.reactor.call_later(HEDGE_CHECK_INTERVAL, self.check_hedge)
+
+
+class AutoTrader(Trader):
+    """
+    Follows the news: every new card reprices and quotes until each strategy's interval expires, hedging throughout.
+    """
+
+    def __init__(self, config: TradeConfig) -> None:
+        super().__init__(config)
+        self.round_reset = False
+        self.cursor.on_reset(self.on_round_reset)
+        self.reactor.subscribe(EventType.NEWS, self.on_news)
+
+    def start(self):
+        self.on_new_cards()
+        feed = self.config.exchange.feed
+        if feed is not None:
+            feed.subscribe_news(lambda news: self.reactor.post(EventType.NEWS, news))
+            self.reactor.post(EventType.NEWS, feed.get_news())
+        else:
+            self.poll_news()
+
+    def poll_news(self):
+        # Without a feed there is no news event, so fetch the news on a timer
+        self.on_news(self.config.exchange.get_news())
+        self.reactor.call_later(NEWS_POLL_INTERVAL, self.poll_news)
+
+    def on_round_reset(self):
+        self.round_reset = True
+
+    def on_news(self, news):
+        # A new round and its first cards can arrive in one update, so reset the strategies only once for both
+        self.round_reset = False
+        if self.cursor.update(news) or self.round_reset:
+            self.on_cards(self.cursor.cards)
+
+    def on_new_cards(self):
+        for strategy in self.config.strategies:
+            strategy.make_market(auto=True)
+            self.expire(strategy)
+
+    def expire(self, strategy: Strategy):
+        # make_market(auto=True) pulls the quotes once the interval since the reset has passed
+        self.timers.append(
+            self.reactor.call_at(strategy.reset_time + strategy.interval, lambda: strategy.make_market(auto=True))
+        )
+
+    def on_prices(self, _):
+        self.config.call.make_market(auto=True)
+        self.config.put.make_market(auto=True)
+
+
+class ManualNewsTrader(Trader):
+    """
+    Follows the UI: cards are entered by hand, PAUSE stops quoting and hedging, TRADE only quotes, and HEDGE only
+    hedges.
+    """
+
+    def __init__(self, config: TradeConfig) -> None:
+        super().__init__(config)
+        self.reactor.subscribe(EventType.STATE, self.on_state)
+
+    def on_state(self, state: ManualNewsState):
+        self.cancel_timers()
+        match state:
             case ManualNewsState.PAUSE:
-                config.exchange.delete_all_orders()
+                self.config.exchange.delete_all_orders()
             case ManualNewsState.TRADE:
-                config.future.make_market()
-                config.call.make_market()
-                config.put.make_market()
+                self.on_new_cards()
             case ManualNewsState.HEDGE:
-                config.exchange.delete_all_orders()
-                config.hedger.hedge(config.cards.get_theoretical_price())
+                self.config.exchange.delete_all_orders()
+                self.hedge()
+
+    def hedging(self) -> bool:
+        return self.config.manul_news_state == ManualNewsState.HEDGE
+
+    def on_new_cards(self):
+        if self.config.manul_news_state == ManualNewsState.TRADE:
+            for strategy in self.config.strategies:
+                strategy.make_market()
+
+    def on_prices(self, _):
+        if self.config.manul_news_state == ManualNewsState.TRADE:
+            self.config.call.make_market()
+            self.config.put.make_market()
+
+
+def full_auto_trade(config: TradeConfig):
+    assert config.mode == Mode.FULL_AUTO
+    trader = AutoTrader(config)
+    trader.start()
+    trader.run()
+
+
+def manual_news_trade(config: TradeConfig):
+    assert config.mode == Mode.MANUAL_NEWS
+    trader = ManualNewsTrader(config)
+    trader.reactor.post(EventType.STATE, config.manul_news_state)
+    trader.run()
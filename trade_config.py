@@ -1,6 +1,7 @@
-from typing import List
+from typing import List, Optional
 from cards import Cards
 from exchange import Exchange
+from reactor import EventType, Reactor
 
 from strategy import Call, Future, Hedger, Pricer, Put, Strategy
 from enum import Enum
@@ -34,7 +35,6 @@ class TradeConfig:
         self.cards = cards
         self.pricer = pricer
         self.get_cards_value = None
-        self.pricer.pricing()
         self.future = future
         self.call = call
         self.put = put
@@ -42,12 +42,40 @@ class TradeConfig:
         self.strategies: List[Strategy] = [future, call, put]
         self.mode = mode
         self.manul_news_state: ManualNewsState = ManualNewsState.PAUSE
+        self.reactor: Optional[Reactor] = None
+        self.target_error_ratio = 0.25
+        self.update_target_error()
+        self.pricer.pricing()
+
+    def update_target_error(self):
+        """
+        Price options only as precisely as quoting needs: a fraction of the narrowest half spread.
+        """
+        half_spread = min(
+            self.call.credit * self.call.tick_size,
+            self.put.credit * self.put.tick_size,
+        )
+        self.pricer.target_error = self.target_error_ratio * half_spread
+
+    def set_manual_news_state(self, state: ManualNewsState):
+        self.manul_news_state = state
+        if self.reactor is not None:
+            self.reactor.post(EventType.STATE, state)
 
     def update_cards(self, cards=None):
+        """
+        Set the chosen cards and restart pricing and quoting. With a reactor running, the change is handed to it so it
+        happens on the trading thread.
+        """
         if cards is None:
-            self.cards.set_chosen_cards(self.get_cards_value())
-        else:
-            self.cards.set_chosen_cards(cards)
+            cards = self.get_cards_value()
+        if self.reactor is not None:
+            self.reactor.post(EventType.CARDS, list(cards))
+            return
+        self.apply_cards(cards)
+
+    def apply_cards(self, cards):
+        self.cards.set_chosen_cards(cards)
 
         self.pricer.reset()
         self.pricer.pricing()
@@ -55,5 +83,4 @@ class TradeConfig:
         self.future.reset()
         self.call.reset()
         self.put.reset()
-        self.hedger.reset()
 
@@ -27,7 +27,7 @@ class ManualNewsTradeControlUI:
         self.labels = ["PAUSE", "TRADE", "HEDGE"]
 
         def handle(attr: str, old_active: int, new_active: int):
-            self.config.manul_news_state = ManualNewsState(new_active)
+            self.config.set_manual_news_state(ManualNewsState(new_active))
 
         self.radio_button_group = RadioButtonGroup(
             labels=self.labels, active=config.manul_news_state.value
@@ -40,7 +40,7 @@ class ManualNewsTradeControlUI:
     def set_trade(self):
         logger.info("set_trade")
         self.radio_button_group.active = ManualNewsState.TRADE.value
-        self.config.manul_news_state = ManualNewsState.TRADE
+        self.config.set_manual_news_state(ManualNewsState.TRADE)
 
 
 class CardsUI:
@@ -125,7 +125,12 @@ class MonitorTable:
             "Put bid",
             "Call delta",
             "Put delta",
+            "Call error",
+            "Put error",
             "Total delta",
+            "Total gamma",
+            "Worst loss",
+            "PnL",
         ]
         self.source = ColumnDataSource(
             data=dict(field_name=self.field_name, value=[None] * len(self.field_name))
@@ -146,6 +151,7 @@ class MonitorTable:
         return self.data_table
 
     def update(self):
+        risk = self.config.hedger.risk
         new_data = dict(
             field_name=self.field_name,
             value=[
@@ -163,11 +169,22 @@ class MonitorTable:
                 self.config.put.bid_price,
                 self.config.pricer.call_delta,
                 self.config.pricer.put_delta,
-                self.config.hedger.compute_total_delta(),
+                self.config.pricer.call_error,
+                self.config.pricer.put_error,
+                None if risk is None else risk.delta,
+                None if risk is None else risk.gamma,
+                None if risk is None else risk.worst_loss,
+                self.pnl(),
             ],
         )
         self.source.data = new_data
 
+    def pnl(self):
+        ledger = self.config.exchange.ledger
+        if ledger is None:
+            return None
+        return ledger.pnl({strategy.symbol: strategy.theo_price for strategy in self.config.strategies})
+
 
 class ControlTable:
     def __init__(self, config: TradeConfig) -> None:
@@ -175,11 +192,12 @@ class ControlTable:
         self.field_name = [
             "Thread count",
             "Iteration count",
+            "Target error ratio",
             "Hedger credit",
             "Future credit",
             "Call credit",
             "Put credit",
-            "Hedge interval",
+            "Hedge band",
             "Future interval",
             "Call interval",
             "Put interval",
@@ -190,11 +208,12 @@ class ControlTable:
                 value=[
                     self.config.pricer.thread_count,
                     self.config.pricer.iteration_count,
+                    self.config.target_error_ratio,
                     self.config.hedger.credit,
                     self.config.future.credit,
                     self.config.call.credit,
                     self.config.put.credit,
-                    self.config.hedger.hedge_interval,
+                    self.config.hedger.band,
                     self.config.future.interval,
                     self.config.call.interval,
                     self.config.put.interval,
@@ -230,6 +249,8 @@ class ControlTable:
                     self.config.pricer.thread_count = new["value"][idx]
                 case "Iteration count":
                     self.config.pricer.iteration_count = new["value"][idx]
+                case "Target error ratio":
+                    self.config.target_error_ratio = new["value"][idx]
                 case "Hedger credit":
                     self.config.hedger.credit = new["value"][idx]
                 case "Future credit":
@@ -238,8 +259,8 @@ class ControlTable:
                     self.config.call.credit = new["value"][idx]
                 case "Put credit":
                     self.config.put.credit = new["value"][idx]
-                case "Hedge interval":
-                    self.config.hedger.hedge_interval = new["value"][idx]
+                case "Hedge band":
+                    self.config.hedger.band = new["value"][idx]
                 case "Future interval":
                     self.config.future.interval = new["value"][idx]
                 case "Call interval":
@@ -248,6 +269,7 @@ class ControlTable:
                     self.config.put.interval = new["value"][idx]
                 case _:
                     logger.warn(f"Invalid config field {field}")
+        self.config.update_target_error()
 
 
 class MainUI:
@@ -13,3 +13,10 @@ def round_up_to_tick(price: float, tick_size: float = 0.1):
     Rounds a price up to the nearest tick, e.g. if the tick size is 0.10, a price of 1.34 will get rounded to 1.40.
     """
     return ceil(price / tick_size) * tick_size
+
+
+def to_ticks(price: float, tick_size: float = 0.1) -> int:
+    """
+    The number of ticks in a price, e.g. 12 for 1.2000000000000002 with a tick size of 0.10, to compare prices exactly.
+    """
+    return round(price / tick_size)